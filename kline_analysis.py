@@ -1,11 +1,27 @@
 # -*- coding: utf-8 -*-
 # author: shubo
 
+import os
+import sys
 import time
 import json
+import queue
+import pickle
 import logging
+import threading
+import bisect
+import zlib
+import multiprocessing
+
+import pymongo
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 import kline_common
+import kline_config
+import kline_indicator
+import kline_rule
 import traceback
 
 class DayOpenData:
@@ -13,42 +29,114 @@ class DayOpenData:
         self.time = -1
         self.open = -1
         self.value = -1
+        # 当前计入的涨跌状态 None/UP/DOWN/FLAT
+        self.state = None
+        # 是否计入高于近期最高价的统计 None/True/False
+        self.above = None
 
-class DayOpenCache:
-    def __init__(self, db_conn):
+# 市场宽度统计，每个tick只更新这个交易对的状态，所有统计都是O(1)
+# 日线按东八区划分，每天只在跨日时切换一次
+# 分片模式下每个分片把自己的计数写到共享内存中的一段，读取时合并所有分片
+class MarketBreadth:
+    UP = 1
+    DOWN = 2
+    FLAT = 3
+
+    # 共享内存中每个分片的计数：上涨 下跌 平盘 高于近期最高价 参与统计 涨跌线累计
+    FIELDS = 6
+
+    def __init__(self, db_conn, shared=None, shard=0):
         self.db_conn = db_conn
+        self.shared = shared
+        self.shard = shard
         self.day_opens = {}
+        self.day_time = -1
+        self.next_day_time = -1
+        self.counts = {MarketBreadth.UP: 0, MarketBreadth.DOWN: 0, MarketBreadth.FLAT: 0}
+        self.above_count = 0
+        self.above_total = 0
+        # 之前所有交易日的涨跌家数差累计
+        self.ad_line_base = 0
 
-    def update(self, coin, cur_close):
-        cur_time = time.time()
-            
-        if coin not in self.day_opens:
-            day_time = self._get_day_time(cur_time)
-            
+    def update(self, tick, high=-1):
+        self._check_day(self._get_tick_time(tick))
+
+        data = self.day_opens.get(tick.symbol)
+        if data is None:
+            data = DayOpenData()
+            data.time = self.day_time
+            self.day_opens[tick.symbol] = data
+
+        # 当天第一根1min K线的开盘价就是日线开盘价
+        if data.open == -1 and tick.period == '1min' and tick.id == self.day_time:
+            data.open = tick.open
+
+        data.value = tick.close
+        self._update_state(data)
+
+        above = None
+        if high > 0:
+            above = tick.close > high
+        if above != data.above:
+            if data.above is not None:
+                self.above_total -= 1
+                self.above_count -= int(data.above)
+            if above is not None:
+                self.above_total += 1
+                self.above_count += int(above)
+            data.above = above
+        self._publish()
+
+    def on_day_bar(self, bar):
+        # 收到当天日线的提交事件时更新开盘价
+        self._check_day(bar.id)
+        if bar.id != self.day_time:
+            return
+        data = self.day_opens.get(bar.symbol)
+        if data is None:
+            data = DayOpenData()
+            self.day_opens[bar.symbol] = data
+        data.time = self.day_time
+        data.open = bar.open
+        self._update_state(data)
+        self._publish()
+
+    def warm_up(self, symbols, snapshot=None):
+        """
+        启动时并发读取所有交易对当天的开盘价，快照中当天的数据直接使用
+        """
+        self._check_day(time.time())
+        day_time = self.day_time
+        snapshot = snapshot or {}
+        day_snapshot = snapshot.get('day_opens', {})
+        if snapshot.get('day_time') == day_time:
+            self.ad_line_base = snapshot.get('ad_line_base', 0)
+
+        def load(coin):
+            if coin in day_snapshot and day_snapshot[coin][0] == day_time:
+                return day_snapshot[coin][1]
             collection = self.db_conn.get_collection(coin + '_1day')
             value = collection.find_one({ 'id': day_time})
-            if value :
-                data = DayOpenData()
-                data.time = day_time
-                data.open = value['open'] 
-                data.value = cur_close            
-                self.day_opens[coin] = data
-        else:
-            data = self.day_opens[coin]
-            data.value = cur_close
-            
-            day_time = self._get_day_time(cur_time)
-            
-            if day_time > data.open:
-                
-                collection = self.db_conn.get_collection(coin + '_1day')
-                value = collection.find_one({ 'id': day_time})
-                
-                if value :
-                    data.time = day_time
-                    data.open = value['open'] 
-                else :
-                    data.open = -1
+            if value:
+                return value['open']
+            return None
+
+        with ThreadPoolExecutor(max_workers=kline_config.WarmUpWorkers) as executor:
+            opens = list(executor.map(load, symbols))
+
+        for coin, day_open in zip(symbols, opens):
+            if day_open is None:
+                continue
+            data = DayOpenData()
+            data.time = day_time
+            data.open = day_open
+            self.day_opens[coin] = data
+        self._publish()
+
+    def to_snapshot(self):
+        return {'day_time': self.day_time,
+                'ad_line_base': self.ad_line_base,
+                'day_opens': dict((coin, (data.time, data.open)) for coin, data in self.day_opens.items())}
 
     def get_day_open(self, coin):
         if coin in self.day_opens:
@@ -56,21 +144,87 @@ class DayOpenCache:
             return data.open
         return -1
 
-    def get_up_ratio(self):
+    def get_count(self):
+        up, down, flat = self.get_up_down()
+        return up + down + flat
 
-        count = 0
-        up = 0
-        for key in self.day_opens:
-            item = self.day_opens[key]            
-            if item.open != -1 and item.value != -1:
-                count += 1
-                if item.value > item.open:
-                    up += 1
-        
+    def get_up_ratio(self):
+        up, down, flat = self.get_up_down()
+        count = up + down + flat
         if count < 20:
             return 0
-        
-        return up / count 
+        return up / count
+
+    def get_up_down(self):
+        if self.shared is not None:
+            return self._get_total(0), self._get_total(1), self._get_total(2)
+        return self.counts[MarketBreadth.UP], self.counts[MarketBreadth.DOWN], self.counts[MarketBreadth.FLAT]
+
+    def get_ad_line(self):
+        # 涨跌线：历史累计加上当天的上涨家数减下跌家数
+        if self.shared is not None:
+            return self._get_total(5) + self._get_total(0) - self._get_total(1)
+        return self.ad_line_base + self.counts[MarketBreadth.UP] - self.counts[MarketBreadth.DOWN]
+
+    def get_above_high_ratio(self):
+        # 收盘价高于近期最高价的交易对比例
+        above_count, above_total = self.above_count, self.above_total
+        if self.shared is not None:
+            above_count, above_total = self._get_total(3), self._get_total(4)
+        if above_total == 0:
+            return 0
+        return above_count / above_total
+
+    def _get_total(self, field):
+        return sum(self.shared[field::MarketBreadth.FIELDS])
+
+    def _publish(self):
+        if self.shared is None:
+            return
+        i = self.shard * MarketBreadth.FIELDS
+        self.shared[i:i + MarketBreadth.FIELDS] = [self.counts[MarketBreadth.UP], self.counts[MarketBreadth.DOWN],
+                                                   self.counts[MarketBreadth.FLAT], self.above_count,
+                                                   self.above_total, self.ad_line_base]
+
+    def _update_state(self, data):
+        state = None
+        if data.open != -1 and data.value != -1:
+            if data.value > data.open:
+                state = MarketBreadth.UP
+            elif data.value < data.open:
+                state = MarketBreadth.DOWN
+            else:
+                state = MarketBreadth.FLAT
+
+        if state != data.state:
+            if data.state is not None:
+                self.counts[data.state] -= 1
+            if state is not None:
+                self.counts[state] += 1
+            data.state = state
+
+    def _check_day(self, t):
+        if t < self.next_day_time:
+            return
+
+        day_time = self._get_day_time(t)
+        if self.day_time != -1:
+            # 跨日：结算前一天的涨跌线，所有交易对等待新的开盘价
+            self.ad_line_base += self.counts[MarketBreadth.UP] - self.counts[MarketBreadth.DOWN]
+            for data in self.day_opens.values():
+                data.time = day_time
+                data.open = -1
+                self._update_state(data)
+            logging.info('[breadth] new day %d ad_line : %d' % (day_time, self.ad_line_base))
+
+        self.day_time = day_time
+        self.next_day_time = day_time + 60 * 60 * 24
+        self._publish()
+
+    def _get_tick_time(self, tick):
+        if tick.ts > 0:
+            return tick.ts / 1000.0
+        return time.time()
     
     def _get_day_time(self, t):
 
@@ -81,40 +235,229 @@ class DayOpenCache:
 
         return t
 
+# 滑动窗口最大值，单调递减队列，每次添加均摊O(1)
+class RollingMax:
+    def __init__(self, window, sign=1):
+        self.window = window
+        # sign为-1时计算最小值
+        self.sign = sign
+        self.seq = 0
+        self.queue = collections.deque()
+        # 窗口内的原值，修正最后一个值时用来重建队列
+        self.values = collections.deque(maxlen=window)
+
+    def append(self, value):
+        value = value * self.sign
+        self.values.append(value)
+        while self.queue and self.queue[-1][1] <= value:
+            self.queue.pop()
+        self.queue.append((self.seq, value))
+        self.seq += 1
+        while self.queue[0][0] <= self.seq - 1 - self.window:
+            self.queue.popleft()
+
+    def replace_last(self, value):
+        value = value * self.sign
+        if not self.values:
+            return
+        old = self.values[-1]
+        self.values[-1] = value
+        seq = self.seq - 1
+        if value >= old:
+            # 变大时只影响队尾，按新值重新入队即可
+            if self.queue and self.queue[-1][0] == seq:
+                self.queue.pop()
+            while self.queue and self.queue[-1][1] <= value:
+                self.queue.pop()
+            self.queue.append((seq, value))
+            return
+        # 变小时之前被它弹出的值可能重新成为最大值，从窗口重建队列
+        self._rebuild()
+
+    def reset(self, values):
+        """
+        用按时间从旧到新的values替换整个窗口
+        """
+        self.values.clear()
+        for value in values[-self.window:]:
+            self.values.append(value * self.sign)
+        self._rebuild()
+
+    def _rebuild(self):
+        self.queue.clear()
+        seq = self.seq - len(self.values)
+        for value in self.values:
+            while self.queue and self.queue[-1][1] <= value:
+                self.queue.pop()
+            self.queue.append((seq, value))
+            seq += 1
+
+    def get(self, default=-1):
+        if not self.queue:
+            return default
+        return self.queue[0][1] * self.sign
+
+# 按列保存最近capacity根K线的环形缓冲区
+class BarRingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.pos = 0
+        self.id = np.zeros(capacity, dtype=np.int64)
+        self.open = np.zeros(capacity)
+        self.high = np.zeros(capacity)
+        self.low = np.zeros(capacity)
+        self.close = np.zeros(capacity)
+        self.amount = np.zeros(capacity)
+        self.vol = np.zeros(capacity)
+
+    def append(self, id, open, high, low, close, amount, vol):
+        self._set(self.pos, id, open, high, low, close, amount, vol)
+        self.pos = (self.pos + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def replace_last(self, id, open, high, low, close, amount, vol):
+        self._set(self.pos - 1, id, open, high, low, close, amount, vol)
+
+    def _set(self, i, id, open, high, low, close, amount, vol):
+        self.id[i] = id
+        self.open[i] = open
+        self.high[i] = high
+        self.low[i] = low
+        self.close[i] = close
+        self.amount[i] = amount
+        self.vol[i] = vol
+
+    def replace(self, id, open, high, low, close, amount, vol):
+        """
+        改写缓冲区中id对应的K线，不在缓冲区时返回False
+        """
+        index = np.flatnonzero(self.last(self.id, self.size) == id)
+        if len(index) == 0:
+            return False
+        self._set((self.pos - self.size + int(index[0])) % self.capacity, id, open, high, low, close, amount, vol)
+        return True
+
+    def last_id(self):
+        if self.size == 0:
+            return -1
+        return int(self.id[self.pos - 1])
+
+    def last(self, column, n):
+        """
+        最近n根K线的一列数据，按时间从旧到新
+        """
+        n = min(n, self.size)
+        start = self.pos - n
+        if start >= 0:
+            return column[start:self.pos]
+        return np.concatenate((column[start:], column[:self.pos]))
+
+    def highest_high(self, n):
+        if self.size == 0:
+            return -1
+        return float(self.last(self.high, n).max())
+
+    def lowest_low(self, n):
+        if self.size == 0:
+            return -1
+        return float(self.last(self.low, n).min())
+
+    def sum_volume(self, n):
+        return float(self.last(self.amount, n).sum())
+
 class ValueCache:
-    def __init__(self, db_conn, coin, period):
+    def __init__(self, db_conn, coin, period, cur_time=None, values=None, count=None):
         self.db_conn = db_conn
-        self.value_cache = []
-        self.count = self._create_count(period)
+        self.count = max(count or 0, self._create_count(period))
         self.coin = coin
         self.period = period
         self.time_step = self._create_time_step(period)
         self.collection = db_conn.get_collection(coin + '_' + period)
+        self.bars = BarRingBuffer(self.count)
+        self.high = RollingMax(self.count)
+        self.low = RollingMax(self.count, -1)
+
+        if cur_time is None:
+            cur_time = int(self.db_conn.hget(coin, 'cur_time_' + period))
+
+        if values is None:
+            # 一次范围查询读取最近count根K线
+            self.cur_time = -1
+            self.catch_up(cur_time)
+        else:
+            # 从快照恢复
+            self.cur_time = cur_time - 1
+            for v in values:
+                self.append(v)
+
+    def catch_up(self, t):
+        """
+        t为redis中的游标，读取上次之后新写入的K线，最多count根
+        """
+        if t - 1 <= self.cur_time:
+            return
+        start = max(self.cur_time + 1, t - 1 - self.time_step * (self.count - 1))
+        self.cur_time = t - 1
+        cursor = self.collection.find({'id': {'$gte': start, '$lte': self.cur_time}}).sort('id', pymongo.ASCENDING)
+        for v in cursor:
+            self.append(v)
+
+    def to_snapshot(self):
+        bars = self.bars
+        columns = [bars.last(c, bars.size).tolist() for c in
+                   (bars.id, bars.open, bars.high, bars.low, bars.close, bars.amount, bars.vol)]
+        values = [dict(zip(('id', 'open', 'high', 'low', 'close', 'amount', 'vol'), row)) for row in zip(*columns)]
+        return {'cur_time': self.cur_time, 'values': values}
 
-        t = self.db_conn.hget(coin, 'cur_time_' + period)
-        self.cur_time = int(t) - 1
-        tt = self.cur_time
-        for i in range(0,self.count):
-            tt -=  self.time_step * i
-            v = self.collection.find_one({ 'id': tt})
-            if v :
-                self.value_cache.append(v)
-
-    def update(self):
-        t = int(self.db_conn.hget(self.coin, 'cur_time_' + self.period))
-        if t > self.cur_time:
-            self.cur_time = t - 1
-            v = self.collection.find_one({ 'id': self.cur_time})
-            if v:
-                self.value_cache.insert(0,v)
-                del self.value_cache[-1]
+    def on_bar(self, bar):
+        """
+        处理K线提交事件，中间有缺失时从库里补读
+        """
+        if bar.id > self.cur_time + self.time_step and self.cur_time >= 0:
+            self.catch_up(bar.id)
+        self.cur_time = max(self.cur_time, bar.id)
+        self.append_bar(bar.id, bar.open, bar.high, bar.low, bar.close, bar.amount, bar.vol)
+
+    def append(self, v):
+        self.append_bar(v['id'], v['open'], v['high'], v['low'], v['close'],
+                        v.get('amount', 0), v.get('vol', 0))
+
+    def append_bar(self, id, open, high, low, close, amount, vol):
+        last_id = self.bars.last_id()
+        if id < last_id:
+            # 已经被后面的K线覆盖的修正，在缓冲区内时改写后重建滑动最值
+            if self.bars.replace(id, open, high, low, close, amount, vol):
+                self.high.reset(self.bars.last(self.bars.high, self.bars.size))
+                self.low.reset(self.bars.last(self.bars.low, self.bars.size))
+            return
+        if id == last_id:
+            # 同一根K线的更新
+            self.bars.replace_last(id, open, high, low, close, amount, vol)
+            self.high.replace_last(high)
+            self.low.replace_last(low)
+            return
+        self.bars.append(id, open, high, low, close, amount, vol)
+        self.high.append(high)
+        self.low.append(low)
 
     def get_high_in_past(self):
-        high = -1
-        for item in self.value_cache:
-            if item['high'] > high:
-                high = item['high']
-        return high
+        return self.high.get()
+
+    def get_low_in_past(self):
+        return self.low.get()
+
+    def get_high(self, n):
+        # 缓存长度的窗口用滑动最大值，其他长度直接在环形缓冲区里查找
+        if n >= self.count:
+            return self.high.get()
+        return self.bars.highest_high(n)
+
+    def get_low(self, n):
+        if n >= self.count:
+            return self.low.get()
+        return self.bars.lowest_low(n)
 
     def _create_time_step(self, period):
         if period == '1min':
@@ -156,13 +499,9 @@ class AllValueCache:
     def __init__(self, db_conn):
         self.db_conn = db_conn
         self.cache_dict = {}
-
-    def update(self, coin, period):
-        key = coin + '_' + period
-        if not key in self.cache_dict:
-            self.cache_dict[key] = ValueCache(self.db_conn, coin, period)
-        cache = self.cache_dict[key]
-        cache.update()
+        self.periods = []
+        # 每个周期至少缓存的K线数量
+        self.counts = {}
 
     def get_high_in_past(self, coin, period):
         key = coin + '_' + period
@@ -172,67 +511,497 @@ class AllValueCache:
         cache = self.cache_dict[key]
         return cache.get_high_in_past()
 
+    def get(self, coin, period):
+        return self.cache_dict.get(coin + '_' + period)
+
+    def warm_up(self, symbols, periods, snapshot=None):
+        """
+        启动时一次读取所有游标，再并发对每个集合做一次范围查询
+        有快照时从快照恢复，只补读快照之后新写入的K线
+        """
+        self.periods = periods
+        infos = dict(zip(symbols, self.db_conn.hgetall_many(symbols)))
+        snapshot = snapshot or {}
+
+        def create(coin, period):
+            cursor = int(infos[coin][b'cur_time_' + period.encode('utf-8')])
+            state = snapshot.get(coin + '_' + period)
+            count = self.counts.get(period)
+            if state is None:
+                return ValueCache(self.db_conn, coin, period, cursor, count=count)
+            cache = ValueCache(self.db_conn, coin, period, state['cur_time'] + 1, state['values'], count)
+            cache.catch_up(cursor)
+            return cache
+
+        futures = {}
+        with ThreadPoolExecutor(max_workers=kline_config.WarmUpWorkers) as executor:
+            for coin in symbols:
+                for period in periods:
+                    if b'cur_time_' + period.encode('utf-8') in infos[coin]:
+                        futures[coin + '_' + period] = executor.submit(create, coin, period)
+
+        for key, future in futures.items():
+            self.cache_dict[key] = future.result()
+
+    def to_snapshot(self):
+        return dict((key, cache.to_snapshot()) for key, cache in self.cache_dict.items())
+
+    def on_bar(self, bar):
+        key = bar.symbol + '_' + bar.period
+        cache = self.cache_dict.get(key)
+        if cache is not None:
+            cache.on_bar(bar)
+        elif bar.period in self.periods:
+            # 启动之后新加入的交易对
+            self.cache_dict[key] = ValueCache(self.db_conn, bar.symbol, bar.period, bar.id + 1,
+                                              count=self.counts.get(bar.period))
+
+    def resync(self):
+        # 事件订阅断开过，按redis游标补读期间漏掉的K线
+        coins = sorted(set(cache.coin for cache in self.cache_dict.values()))
+        infos = dict(zip(coins, self.db_conn.hgetall_many(coins)))
+        for cache in self.cache_dict.values():
+            t = infos[cache.coin].get(b'cur_time_' + cache.period.encode('utf-8'))
+            if t is not None:
+                cache.catch_up(int(t))
+
+
+# 一致性哈希把交易对分配到分片，分片数量变化时只有少量交易对需要迁移
+class ShardRing:
+    def __init__(self, count, replicas=256):
+        self.count = count
+        points = []
+        for shard in range(count):
+            for i in range(replicas):
+                points.append((zlib.crc32(('shard_%d_%d' % (shard, i)).encode('utf-8')), shard))
+        points.sort()
+        self.keys = [p[0] for p in points]
+        self.shards = [p[1] for p in points]
+
+    def get_shard(self, symbol):
+        i = bisect.bisect(self.keys, zlib.crc32(symbol.encode('utf-8'))) % len(self.keys)
+        return self.shards[i]
+
+# 分片进程从分发进程的队列读取tick，接口与TickSubscriber一致
+class QueueSubscriber:
+    def __init__(self, tick_queue):
+        self.tick_queue = tick_queue
+
+    def start(self):
+        pass
+
+    def read(self, block=True):
+        try:
+            if block:
+                return self.tick_queue.get(timeout=1)
+            return self.tick_queue.get_nowait()
+        except queue.Empty:
+            return []
+
+    def ack(self):
+        # 分发进程放入队列后已经确认
+        pass
+
+# 分片信息：分片编号、分片数量、tick队列、共享的市场宽度计数
+class ShardContext:
+    def __init__(self, index, count, tick_queue, shared):
+        self.index = index
+        self.count = count
+        self.tick_queue = tick_queue
+        self.shared = shared
+        self.ring = ShardRing(count)
+
+    def owns(self, symbol):
+        return self.ring.get_shard(symbol) == self.index
 
 # kline分析模块负责根据实时数据以及历史数据分析适合买入跟卖出的点
 class Main:
-    def __init__(self):
+    def __init__(self, consumer='analysis', shard=None):
         self.db_conn = kline_common.DBConnection()
-        self.day_open_cache = DayOpenCache(self.db_conn)
+        self.shard = shard
+        if shard is None:
+            self.subscriber = kline_common.TickSubscriber(self.db_conn, consumer)
+            self.breadth = MarketBreadth(self.db_conn)
+        else:
+            self.subscriber = QueueSubscriber(shard.tick_queue)
+            self.breadth = MarketBreadth(self.db_conn, shard.shared, shard.index)
+        self.binary = kline_config.TickEncoding == 'binary'
+        self.codec = kline_common.TickCodec(kline_common.SymbolTable(self.db_conn))
         self.all_cache = AllValueCache(self.db_conn)
+        self.indicators = kline_indicator.IndicatorCache(self.db_conn, list(kline_config.IndicatorPeriods))
+        self.periods = ['1min', '60min', '1day']
+        self.plan = None
+        self.snapshot_time = time.time()
+        self.bar_events = queue.Queue()
+        # 积压时合并tick，以及处理情况统计
+        self.conflation = kline_config.TickConflation
+        self.received = 0
+        self.coalesced = 0
+        self.evaluated = 0
+        self.max_delay = 0
+        self.report_time = time.time()
 
     def start(self):
         
         self.db_conn.start()
+        self._load_plan()
+        # 先订阅K线提交事件再预热，预热期间的事件不会丢失
+        self._start_bar_listener()
+        self.warm_up()
         self._run()
 
-    def _run(self):
-        pubsub = self.db_conn.subscribe('tick_data')
+    def _load_plan(self):
+        # 规则用到的周期、窗口长度和指标在预热之前加入缓存
+        self.plan = kline_rule.load_plan(self.db_conn)
+        for period in self.plan.get_periods():
+            if period not in self.periods:
+                self.periods.append(period)
+            if period not in self.indicators.periods:
+                self.indicators.periods.append(period)
+        self.all_cache.counts = self.plan.get_window_counts()
+        self.indicators.specs.update(self.plan.indicators)
 
-        for topic in pubsub.listen():
-            if topic['channel'] != b'tick_data':
-                continue
+    def _start_bar_listener(self):
+        thread = threading.Thread(target=self._listen_bars)
+        thread.daemon = True
+        thread.start()
 
-            if type(topic['data']) != bytes:
+    def _listen_bars(self):
+        while True:
+            try:
+                pubsub = self.db_conn.subscribe(kline_config.BarCommitChannel)
+                for topic in pubsub.listen():
+                    if topic['type'] != 'message':
+                        continue
+                    bar = self.codec.decode(topic['data'])
+                    if self.shard is None or self.shard.owns(bar.symbol):
+                        self.bar_events.put(bar)
+            except Exception as e:
+                logging.error('[analysis] bar listener error : ' + str(e))
+                # None表示需要按游标重新同步
+                self.bar_events.put(None)
+                time.sleep(1)
+
+    def _process_bar_events(self):
+        while True:
+            try:
+                bar = self.bar_events.get_nowait()
+            except queue.Empty:
+                break
+
+            if bar is None:
+                self.all_cache.resync()
                 continue
+
+            self.all_cache.on_bar(bar)
+            self.indicators.update(bar)
+            if bar.period == '1day':
+                self.breadth.on_day_bar(bar)
+
+    def warm_up(self):
+        start_time = time.time()
+        symbols = [s.decode('utf-8') for s in self.db_conn.lrange('symbols', 0, -1)]
+        if self.shard is not None:
+            symbols = [s for s in symbols if self.shard.owns(s)]
+        snapshot = self._load_snapshot()
+
+        self.all_cache.warm_up(symbols, self.periods, snapshot.get('caches'))
+        self.breadth.warm_up(symbols, snapshot.get('breadth'))
+        self.indicators.warm_up(symbols)
+
+        logging.info('[analysis] warm up %d caches snapshot:%s time : %f'
+                     % (len(self.all_cache.cache_dict), len(snapshot) > 0, time.time() - start_time))
+
+    def save_snapshot(self):
+        path = self._get_snapshot_path()
+        dir_name = os.path.dirname(path)
+        if dir_name != '' and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        snapshot = {'time': time.time(),
+                    'caches': self.all_cache.to_snapshot(),
+                    'breadth': self.breadth.to_snapshot()}
+        # 先写临时文件再替换，避免中途退出留下损坏的快照
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self.snapshot_time = time.time()
+
+    def _get_snapshot_path(self):
+        if self.shard is None:
+            return kline_config.SnapshotPath
+        return '%s.%d_%d' % (kline_config.SnapshotPath, self.shard.index, self.shard.count)
+
+    def _load_snapshot(self):
+        path = self._get_snapshot_path()
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logging.error('[analysis] load snapshot error : ' + str(e))
+            return {}
+
+        if time.time() - snapshot['time'] > kline_config.SnapshotMaxAge:
+            logging.info('[analysis] snapshot too old.')
+            return {}
+        return snapshot
+
+    def _run(self):
+        self.subscriber.start()
+
+        while True:
+            msgs = self._read_backlog()
+            # K线事件在处理tick之前应用，tick处理过程不做任何IO
+            self._process_bar_events()
+            if self.conflation:
+                self._process_conflated(msgs)
+            else:
+                for msg in msgs:
+                    try:
+                        self._on_message(msg)
+                        
+                    except Exception as e:
+                        #logging.error(str(e))
+                        msg = traceback.format_exc()
+                        print(msg)
+
+            # 整批处理完成后再确认
+            self.subscriber.ack()
+            self.received += len(msgs)
+            self._report()
+
+            if time.time() - self.snapshot_time > kline_config.SnapshotInterval:
+                self.save_snapshot()
+
+    def _read_backlog(self):
+        msgs = self.subscriber.read()
+        if not self.conflation:
+            return msgs
+        # 读满一批说明有积压，继续读取已经到达的数据直到读完或达到上限
+        batch = len(msgs)
+        while batch > 0 and len(msgs) < kline_config.ConflationMaxTicks:
+            more = self.subscriber.read(False)
+            batch = len(more)
+            msgs.extend(more)
+        return msgs
+
+    def _process_conflated(self, msgs):
+        """
+        同一根K线只处理最新的tick，每个交易对在一个周期里只计算一次规则
+        """
+        latest = {}
+        for msg in msgs:
+            if self.binary:
+                # 二进制记录前8个字节是交易对编号、周期和K线id
+                latest[msg[:8]] = msg
+            else:
+                tick = self._decode(msg)
+                if tick is not None:
+                    latest[(tick.symbol, tick.period, tick.id)] = tick
+
+        newest = {}
+        for item in latest.values():
             try:
-                data = json.loads(topic['data'])
-                if 'tick' not in data:
-                    continue
+                tick = self.codec.decode(item) if self.binary else item
+                self._update_tick(tick)
+                newest[tick.symbol] = tick
+            except Exception as e:
+                print(traceback.format_exc())
 
-                self._process_data(data)
-                
+        for tick in newest.values():
+            try:
+                self._evaluate(tick)
             except Exception as e:
-                #logging.error(str(e))
-                msg = traceback.format_exc()
-                print(msg)
-    
-    def _process_data(self, data):
-        #print(data)
-        splits = data['ch'].split('.')
-        coin = splits[1]
-        close = data['tick']['close']
-        self.day_open_cache.update(coin, close)
-        #print(self.day_open_cache.get_up_ratio())
-        self.all_cache.update(coin,'1min')
-        self.all_cache.update(coin,'60min')
-        self.all_cache.update(coin,'1day')
-		
+                print(traceback.format_exc())
+
+        self.coalesced += len(msgs) - len(latest)
+        self.evaluated += len(newest)
+        if len(newest) > 0:
+            self.max_delay = max(self.max_delay, time.time() - max(t.recv_ts for t in newest.values()))
+
+    def _report(self):
+        now = time.time()
+        if now - self.report_time < kline_config.ConflationReportInterval:
+            return
+        self.report_time = now
+        logging.info('[analysis] received:%d coalesced:%d evaluated:%d max delay:%f'
+                     % (self.received, self.coalesced, self.evaluated, self.max_delay))
+        self.received = 0
+        self.coalesced = 0
+        self.evaluated = 0
+        self.max_delay = 0
+
+    def _decode(self, msg):
+        if self.binary:
+            return self.codec.decode(msg)
+        data = json.loads(msg)
+        if 'tick' not in data:
+            return None
+        return kline_common.Tick.from_message(data, time.time())
+
+    def _on_message(self, msg):
+        tick = self._decode(msg)
+        if tick is not None:
+            self._process_tick(tick)
+            self.evaluated += 1
+
+    def _process_tick(self, tick):
+        self._update_tick(tick)
+        self._evaluate(tick)
+
+    def _update_tick(self, tick):
+        coin = tick.symbol
+        self.indicators.update(tick)
+
+        # 市场宽度中的高于近期最高价统计
         high = self.all_cache.get_high_in_past(coin,'1min')
         high1 = self.all_cache.get_high_in_past(coin,'60min')
         if high1 > high:
            high = high1
-        if close < high * 0.75:
-           logging.warning('[buy] in up -->' + coin + ':' + str(close) )
+        self.breadth.update(tick, high)
+        #print(self.breadth.get_up_ratio())
 
-        if self.day_open_cache.get_up_ratio() > 0.8:
-           day_open = self.day_open_cache.get_day_open(coin)
-           if close > day_open*1.015 and close < high * 0.8:
-               logging.warning('[buy] in down -->' + coin + ':' + str(close) )
+    def _evaluate(self, tick):
+        for name in self.plan.evaluate(lambda leaf: self._resolve(tick, leaf)):
+            logging.warning('[buy] ' + name + ' -->' + tick.symbol + ':' + str(tick.close) )
 
+    def _resolve(self, tick, leaf):
+        kind = leaf[0]
+        if kind == 'value':
+            name = leaf[1]
+            if name == 'close':
+                return tick.close
+            elif name == 'open':
+                return tick.open
+            elif name == 'day_open':
+                return self.breadth.get_day_open(tick.symbol)
+            elif name == 'up_ratio':
+                return self.breadth.get_up_ratio()
+            elif name == 'ad_line':
+                return self.breadth.get_ad_line()
+            else:
+                return self.breadth.get_above_high_ratio()
+        elif kind == 'window':
+            cache = self.all_cache.get(tick.symbol, leaf[2])
+            if cache is None:
+                return -1
+            if leaf[1] == 'high':
+                return cache.get_high(leaf[3])
+            return cache.get_low(leaf[3])
+        else:
+            value = self.indicators.get_value(tick.symbol, leaf[1], leaf[2])
+            if leaf[3] is not None and isinstance(value, tuple):
+                return value[leaf[3]]
+            return value
+
+
+
+def _run_shard(index, count, tick_queue, shared):
+    kline_common.init_logging('kline_analysis_%d' % index)
+    main = Main(shard=ShardContext(index, count, tick_queue, shared))
+    try:
+        main.start()
+    except KeyboardInterrupt:
+        logging.error('[analysis] shard %d exit .' % index)
+        main.save_snapshot()
+
+# 分片模式的分发进程：从tick流读取数据，按交易对分发给各个分片进程
+# 二进制记录开头就是交易对编号，不需要解码整条记录
+class Dispatcher:
+    def __init__(self, count, consumer='analysis'):
+        self.count = count
+        self.db_conn = kline_common.DBConnection()
+        self.subscriber = kline_common.TickSubscriber(self.db_conn, consumer)
+        self.binary = kline_config.TickEncoding == 'binary'
+        self.symbol_table = kline_common.SymbolTable(self.db_conn)
+        self.ring = ShardRing(count)
+        self.routes = {}
+        self.queues = [multiprocessing.Queue(kline_config.ShardQueueSize) for i in range(count)]
+        self.shared = multiprocessing.Array('d', count * MarketBreadth.FIELDS, lock=False)
+        self.processes = []
+        self.counts = [0] * count
+        # 没有分发的消息数量，未知的交易对编号由SymbolTable记录日志
+        self.skipped = 0
+        self.report_time = time.time()
+
+    def start(self):
+        for i in range(self.count):
+            process = multiprocessing.Process(target=_run_shard, args=(i, self.count, self.queues[i], self.shared))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.db_conn.start()
+        self.subscriber.start()
+        while True:
+            batches = [[] for i in range(self.count)]
+            for msg in self.subscriber.read():
+                shard = self._get_shard(msg)
+                if shard is None:
+                    self.skipped += 1
+                    continue
+                batches[shard].append(msg)
+
+            # 队列满时阻塞，处理慢的分片会让分发进程停止读取
+            for i, batch in enumerate(batches):
+                if len(batch) > 0:
+                    self.queues[i].put(batch)
+                    self.counts[i] += len(batch)
+            self.subscriber.ack()
+            self._report()
 
+    def _get_shard(self, msg):
+        """
+        tick所属的分片，订阅确认等没有频道的消息和未知的交易对编号返回None
+        """
+        if self.binary:
+            key = kline_common.TICK_SYMBOL.unpack_from(msg)[0]
+        else:
+            try:
+                key = json.loads(msg)['ch'].split('.')[1]
+            except (ValueError, KeyError, IndexError, AttributeError):
+                return None
+
+        shard = self.routes.get(key)
+        if shard is None:
+            symbol = self.symbol_table.get_symbol(key) if self.binary else key
+            if symbol is None:
+                return None
+            shard = self.ring.get_shard(symbol)
+            self.routes[key] = shard
+        return shard
+
+    def _report(self):
+        now = time.time()
+        if now - self.report_time < 60:
+            return
+        self.report_time = now
+        alive = sum(1 for p in self.processes if p.is_alive())
+        logging.info('[dispatcher] alive:%d/%d ticks:%s skipped:%d' % (alive, self.count, self.counts, self.skipped))
 
 if __name__ == "__main__":
+    # stream模式下用不同的消费者名称启动多个进程分摊数据
+    # python kline_analysis.py shard [count] 按交易对分片，由一个分发进程和count个分析进程处理
+    if len(sys.argv) > 1 and sys.argv[1] == 'shard':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else kline_config.AnalysisShards
+        kline_common.init_logging('kline_analysis_dispatcher')
+        try:
+            Dispatcher(count).start()
+        except KeyboardInterrupt:
+            logging.error('[dispatcher] exit .')
+        sys.exit(0)
+
+    consumer = 'analysis'
+    if len(sys.argv) > 1:
+        consumer = sys.argv[1]
+
     kline_common.init_logging('kline_analysis')
-    main = Main()
-    main.start()
+    main = Main(consumer)
+    try:
+        main.start()
+    except KeyboardInterrupt:
+        logging.error('[analysis] exit .')
+        main.save_snapshot()
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import os
+import sys
+import json
+import time
+import logging
+import pymongo
+import numpy as np
+
+import kline_codec
+import kline_common
+import kline_config
+import kline_resample
+
+# 本地列式K线归档，每个 <symbol>_<period> 一个目录:
+#   <field>.bin   定长列，按id递增追加
+#   meta.json     已完整写入的行数，读取时只使用这么多行
+# 追加时先写列文件再更新meta，中途退出留下的多余数据在下次追加前截掉
+# 读取使用numpy.memmap，不复制数据，按id二分查找时间范围
+# 归档不会修改已写入的数据，mongodb中补齐的已归档时间段之前的缺口需要删除归档重新导出
+# pack/unpack 把归档转成kline_codec压缩格式，用于备份和在机器之间传输
+
+DTYPES = {'id': np.int64, 'open': np.float64, 'close': np.float64, 'low': np.float64,
+          'high': np.float64, 'amount': np.float64, 'vol': np.float64, 'count': np.int64}
+
+class KlineArchive:
+    def __init__(self, symbol, period, root=None):
+        self.symbol = symbol
+        self.period = period
+        self.path = os.path.join(root or kline_config.ArchivePath, symbol + '_' + period)
+        self.rows = self._read_meta()
+        self.maps = None
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                return json.load(f)['rows']
+        except (IOError, ValueError):
+            return 0
+
+    def _write_meta(self, rows):
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'rows': rows, 'fields': kline_resample.FIELDS}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def _get_maps(self):
+        if self.maps is None:
+            self.maps = {}
+            for field in kline_resample.FIELDS:
+                if self.rows == 0:
+                    self.maps[field] = np.zeros(0, dtype=DTYPES[field])
+                else:
+                    self.maps[field] = np.memmap(os.path.join(self.path, field + '.bin'),
+                                                 dtype=DTYPES[field], mode='r', shape=(self.rows,))
+        return self.maps
+
+    def last_id(self):
+        if self.rows == 0:
+            return -1
+        return int(self._get_maps()['id'][-1])
+
+    def columns(self, start=None, end=None):
+        """
+        包含start不包含end的列数组，与kline_resample.load_bars的结果格式一致，不复制数据
+        """
+        maps = self._get_maps()
+        ids = maps['id']
+        lo = 0 if start is None else int(np.searchsorted(ids, start, 'left'))
+        hi = len(ids) if end is None else int(np.searchsorted(ids, end, 'left'))
+        return dict((field, maps[field][lo:hi]) for field in kline_resample.FIELDS)
+
+    def append(self, columns):
+        """
+        追加按id排序的列数组，只写入比已有数据更新的K线，返回写入的行数
+        """
+        ids = columns['id']
+        keep = ids > self.last_id()
+        count = int(keep.sum())
+        if count == 0:
+            return 0
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        for field in kline_resample.FIELDS:
+            file_path = os.path.join(self.path, field + '.bin')
+            size = self.rows * np.dtype(DTYPES[field]).itemsize
+            with open(file_path, 'ab') as f:
+                # 截掉上次没有完成的追加
+                if f.tell() != size:
+                    f.truncate(size)
+                np.ascontiguousarray(np.asarray(columns[field])[keep], dtype=DTYPES[field]).tofile(f)
+
+        self.maps = None
+        self.rows += count
+        self._write_meta(self.rows)
+        return count
+
+def pack(symbol, period, path):
+    columns = KlineArchive(symbol, period).columns()
+    data = kline_codec.encode(columns)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(columns['id']), len(data)
+
+def unpack(symbol, period, path):
+    """
+    把压缩文件中比归档更新的K线追加到归档，返回追加的数量
+    """
+    with open(path, 'rb') as f:
+        columns = kline_codec.decode(f.read())
+    return KlineArchive(symbol, period).append(columns)
+
+def export(db_conn, symbol, period, settle_bars=None, chunk=100000):
+    """
+    把mongodb中归档之后新增的K线追加到归档，最近settle_bars根可能还在变化的K线不归档
+    """
+    if settle_bars is None:
+        settle_bars = kline_config.ArchiveSettleBars
+    archive = KlineArchive(symbol, period)
+    step = kline_resample.get_period_step(period)
+    end = kline_resample.get_bar_time(int(time.time()), period) - step * (settle_bars - 1)
+    collection = db_conn.get_collection(symbol + '_' + period)
+
+    start = archive.last_id() + 1
+    if archive.rows == 0:
+        # 第一次导出从最早的K线开始
+        first = collection.find_one({}, {'_id': 0, 'id': 1}, sort=[('id', pymongo.ASCENDING)])
+        if first is None:
+            return 0
+        start = first['id']
+
+    total = 0
+    # 按时间分段读取，避免第一次导出时一次读入全部历史，没有数据的时间段直接跳过
+    while start < end:
+        chunk_end = min(end, start + step * chunk)
+        columns = kline_resample.load_bars(collection, start, chunk_end)
+        if len(columns['id']) > 0:
+            total += archive.append(columns)
+        start = chunk_end
+    return total
+
+def load_history(db_conn, symbol, period, start=None, end=None):
+    """
+    先读归档，归档之后的部分从mongodb读取
+    归档只追加last_id之后的K线，之后在mongodb中补齐的更早的缺口不会出现在结果中，
+    补齐缺口后需要删除对应的归档目录重新导出
+    """
+    archive = KlineArchive(symbol, period)
+    if archive.rows == 0:
+        return kline_resample.load_bars(db_conn.get_collection(symbol + '_' + period, False), start, end)
+
+    columns = archive.columns(start, end)
+    tail_start = archive.last_id() + 1
+    if end is not None and end <= tail_start:
+        return columns
+    if start is not None:
+        tail_start = max(tail_start, start)
+    tail = kline_resample.load_bars(db_conn.get_collection(symbol + '_' + period, False), tail_start, end)
+    if len(tail['id']) == 0:
+        return columns
+    return dict((field, np.concatenate((columns[field], tail[field]))) for field in kline_resample.FIELDS)
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_archive', True)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('export', 'scan', 'pack', 'unpack') or \
+            (sys.argv[1] in ('pack', 'unpack') and len(sys.argv) < 5):
+        print('usage: kline_archive.py export [symbol ...]')
+        print('       kline_archive.py scan symbol [period]')
+        print('       kline_archive.py pack symbol period file')
+        print('       kline_archive.py unpack symbol period file')
+        sys.exit(1)
+
+    if sys.argv[1] == 'pack':
+        rows, size = pack(sys.argv[2], sys.argv[3], sys.argv[4])
+        logging.info('[archive] pack %s_%s rows:%d size:%d' % (sys.argv[2], sys.argv[3], rows, size))
+    elif sys.argv[1] == 'unpack':
+        count = unpack(sys.argv[2], sys.argv[3], sys.argv[4])
+        logging.info('[archive] unpack %s_%s:%d' % (sys.argv[2], sys.argv[3], count))
+    elif sys.argv[1] == 'export':
+        db_conn = kline_common.DBConnection()
+        db_conn.start()
+        symbols = sys.argv[2:] or [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+        for symbol in symbols:
+            for period in kline_config.ArchivePeriods:
+                start_time = time.time()
+                count = export(db_conn, symbol, period)
+                logging.info('[archive] export %s_%s:%d time : %f' % (symbol, period, count, time.time() - start_time))
+    else:
+        period = sys.argv[3] if len(sys.argv) > 3 else '1min'
+        start_time = time.time()
+        columns = KlineArchive(sys.argv[2], period).columns()
+        size = sum(values.nbytes for values in columns.values())
+        high = float(columns['high'].max()) if len(columns['id']) > 0 else 0
+        elapsed = max(time.time() - start_time, 1e-6)
+        logging.info('[archive] scan %s_%s rows:%d high:%f time:%f MB/s:%f'
+                     % (sys.argv[2], period, len(columns['id']), high, elapsed, size / elapsed / 1024 / 1024))
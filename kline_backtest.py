@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import calendar
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import kline_rule
+import kline_common
+import kline_archive
+import kline_resample
+import kline_indicator
+
+# 历史回测：把每个交易对的1min K线读成数组，整条时间线向量化计算 kline_rule 编译的买入规则
+#
+# 用法: python kline_backtest.py [start_date] [symbol ...]
+#   start_date 形如 2017-01-01，默认从2017年开始
+#
+# 每根1min K线的收盘价当作一个tick，规则数据项与实时模块的对应关系：
+#   high low   最近n根K线的最高价/最低价，只包含这一分钟之前提交的K线，未走完的周期算作一根K线
+#   day_open   东八区当天第一根1min K线的开盘价
+#   up_ratio   每个交易对最后一次的涨跌状态在当前时刻的统计，跨日清零，与 MarketBreadth 一致
+#   指标       1min与实时结果相同，其他周期使用上一根走完的K线的值，实时模块使用未走完的合成K线，
+#              周期内的信号可能不同，需要逐分钟重算指标才能一致
+# ad_line above_ratio 只在实时模块中支持
+# 信号发出后HIT_HORIZON根K线内最高收盘价达到买入价的(1 + HIT_TARGET)算作命中
+
+START_TIME = 1483200000
+
+HIT_HORIZON = 60
+HIT_TARGET = 0.01
+
+MIN_BREADTH_COUNT = 20
+
+def load_columns(db_conn, symbol, period, start=None, end=None):
+    # 优先读取本地归档，归档之后的部分从mongodb读取
+    return kline_archive.load_history(db_conn, symbol, period, start, end)
+
+def segment_cummax(values, groups):
+    """
+    按连续分组计算组内的累计最大值，倍增扫描，循环次数为最长分组长度的对数
+    """
+    out = values.copy()
+    n = len(out)
+    d = 1
+    while d < n:
+        same = groups[d:] == groups[:-d]
+        if not same.any():
+            break
+        out[d:] = np.where(same, np.maximum(out[d:], out[:-d]), out[d:])
+        d *= 2
+    return out
+
+def sliding_windows(values, n):
+    """
+    长度为n的滑动窗口只读视图，numpy 1.20之前没有sliding_window_view
+    """
+    values = np.ascontiguousarray(values)
+    return np.lib.stride_tricks.as_strided(values, shape=(len(values) - n + 1, n),
+                                           strides=(values.strides[0], values.strides[0]), writeable=False)
+
+def rolling_max(values, n):
+    """
+    包含当前位置在内最近n个值的最大值，不足n个时取已有的值
+    """
+    if len(values) == 0:
+        return values.copy()
+    padded = np.r_[np.full(n - 1, values[0]), values]
+    return sliding_windows(padded, n).max(axis=1)
+
+def forward_max(values, n):
+    """
+    当前位置之后n个值的最大值，最后一个位置为nan
+    """
+    out = np.full(len(values), np.nan)
+    if len(values) < 2:
+        return out
+    padded = np.r_[values[1:], np.full(n - 1, np.nan)]
+    windows = sliding_windows(padded, n)
+    out[:-1] = np.nanmax(windows, axis=1)
+    return out
+
+def window_max(ids, values, period, n, sign=1):
+    """
+    每一分钟时period周期最近n根K线的最大值，与实时模块的ValueCache一致只使用这一分钟之前提交的1min K线:
+    当前周期之前已有的分钟合成一根未走完的K线，周期的第一分钟只有之前走完的K线，没有数据时为-1
+    sign为-1时计算最小值
+    """
+    out = np.full(len(values), -1.0)
+    if len(values) == 0:
+        return out
+    values = values * sign
+    groups = kline_resample.get_bar_time(ids, period)
+    first = np.r_[True, groups[1:] != groups[:-1]]
+    starts = np.flatnonzero(first)
+    index = np.cumsum(first) - 1
+    # 这一分钟之前当前周期已有部分的最大值
+    partial = np.r_[values[0], segment_cummax(values, groups)[:-1]]
+    # 走完的K线按周期取最大值后，最近n根和最近n-1根的最大值
+    bar_max = np.maximum.reduceat(values, starts)
+    prev = np.maximum(index - 1, 0)
+    full = rolling_max(bar_max, n)[prev]
+    if n > 1:
+        rest = np.maximum(partial, rolling_max(bar_max, n - 1)[prev])
+    else:
+        rest = partial
+    # 第一个周期之前没有走完的K线
+    rest = np.where(index > 0, rest, partial)
+    result = np.where(first, full, rest) * sign
+    return np.where(first & (index == 0), out, result)
+
+def indicator_values(columns, period, spec, index):
+    """
+    指标在每一分钟的值，1min以外的周期取上一根走完的K线
+    实时模块的指标包含未走完的合成K线，这里没有逐分钟重算，周期内的值与实时结果不同
+    """
+    if period == '1min':
+        value = kline_indicator.create(spec).batch(columns)
+        return value[index] if index is not None else value
+
+    bars = kline_resample.resample(columns, period)
+    value = kline_indicator.create(spec).batch(bars)
+    if index is not None:
+        value = value[index]
+    i = np.searchsorted(bars['id'], kline_resample.get_bar_time(columns['id'], period)) - 1
+    return np.where(i >= 0, value[np.maximum(i, 0)], np.nan)
+
+def resolve_leaf(columns, features, leaf, indicators):
+    kind = leaf[0]
+    if kind == 'value':
+        if leaf[1] in ('ad_line', 'above_ratio'):
+            raise kline_rule.RuleError(leaf[1] + ' is not supported in backtest')
+        return features[leaf[1]]
+    elif kind == 'window':
+        if leaf[1] == 'high':
+            return window_max(columns['id'], columns['high'], leaf[2], leaf[3])
+        return window_max(columns['id'], columns['low'], leaf[2], leaf[3], -1)
+    else:
+        return indicator_values(columns, leaf[1], indicators[leaf[2]], leaf[3])
+
+def build_features(columns):
+    """
+    由1min列数组计算规则用到的每分钟特征
+    """
+    ids = columns['id']
+    close = columns['close']
+    features = {'id': ids, 'close': close, 'open': columns['open']}
+    if len(ids) == 0:
+        features['day_open'] = close.copy()
+        return features
+
+    days = kline_resample.get_bar_time(ids, '1day')
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    lengths = np.diff(np.r_[starts, len(ids)])
+    features['day'] = days
+    features['day_open'] = np.repeat(columns['open'][starts], lengths)
+    features['future_high'] = forward_max(close, HIT_HORIZON)
+    return features
+
+def breadth_events(features):
+    """
+    交易对涨跌状态的变化事件 (时间, 上涨数变化, 总数变化)，用于合并成全市场的涨跌统计
+    """
+    ids = features['id']
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    up = (features['close'] > features['day_open']).astype(np.int64)
+    days = features['day']
+    first = np.r_[True, days[1:] != days[:-1]]
+    last = np.r_[days[1:] != days[:-1], True]
+    prev_up = np.r_[0, up[:-1]]
+    prev_up[first] = 0
+
+    # 每天第一根K线开始计数，跨日时撤销前一天最后的状态
+    times = np.r_[ids, days[last] + kline_resample.DAY]
+    up_delta = np.r_[up - prev_up, -up[last]]
+    count_delta = np.r_[first.astype(np.int64), -np.ones(int(last.sum()), dtype=np.int64)]
+    changed = (up_delta != 0) | (count_delta != 0)
+    return times[changed], up_delta[changed], count_delta[changed]
+
+class Breadth:
+    def __init__(self, events):
+        times = np.concatenate([e[0] for e in events]) if events else np.zeros(0, dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.up = np.cumsum(np.concatenate([e[1] for e in events])[order]) if events else times
+        self.count = np.cumsum(np.concatenate([e[2] for e in events])[order]) if events else times
+
+    def get_up_ratio(self, ids):
+        """
+        ids时刻所有事件生效后的上涨比例，交易对数量不足时为0
+        """
+        i = np.searchsorted(self.times, ids, 'right') - 1
+        valid = i >= 0
+        up = np.where(valid, self.up[np.maximum(i, 0)], 0)
+        count = np.where(valid, self.count[np.maximum(i, 0)], 0)
+        return np.where(count >= MIN_BREADTH_COUNT, up / np.maximum(count, 1), 0.0)
+
+_db_conn = None
+
+def _get_db_conn():
+    # 每个进程使用自己的数据库连接
+    global _db_conn
+    if _db_conn is None:
+        _db_conn = kline_common.DBConnection()
+        _db_conn.start(False, True)
+    return _db_conn
+
+def _load_symbol(symbol, start, end, leaves, indicators):
+    start_time = time.time()
+    columns = load_columns(_get_db_conn(), symbol, '1min', start, end)
+    features = build_features(columns)
+    features['events'] = breadth_events(features)
+    # up_ratio需要所有交易对的数据，在主进程中计算
+    features['leaves'] = {}
+    if len(columns['id']) > 0:
+        for leaf in leaves:
+            if leaf != ('value', 'up_ratio'):
+                features['leaves'][leaf] = resolve_leaf(columns, features, leaf, indicators)
+    features['load_time'] = time.time() - start_time
+    return features
+
+class SymbolResult:
+    def __init__(self, symbol, bars):
+        self.symbol = symbol
+        self.bars = bars
+        self.signals = {}
+        self.hits = {}
+
+def run(symbols, plan, start=START_TIME, end=None, workers=None):
+    start_time = time.time()
+    leaves = [leaf for slot, leaf in plan.leaves]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_load_symbol, symbol, start, end, leaves, plan.indicators) for symbol in symbols]
+        all_features = [f.result() for f in futures]
+    load_time = time.time() - start_time
+
+    breadth = Breadth([f['events'] for f in all_features if len(f['id']) > 0])
+
+    results = []
+    for symbol, features in zip(symbols, all_features):
+        result = SymbolResult(symbol, len(features['id']))
+        if result.bars > 0:
+            up_ratio = breadth.get_up_ratio(features['id'])
+            values = features['leaves']
+            signals = plan.evaluate_batch(lambda leaf: up_ratio if leaf == ('value', 'up_ratio') else values[leaf],
+                                          result.bars)
+            hit = features['future_high'] >= features['close'] * (1 + HIT_TARGET)
+            for name, signal in signals.items():
+                result.signals[name] = int(signal.sum())
+                result.hits[name] = int((signal & hit).sum())
+        results.append(result)
+
+    logging.info('[backtest] symbols:%d bars:%d load time:%f total time : %f'
+                 % (len(symbols), sum(r.bars for r in results), load_time, time.time() - start_time))
+    return results
+
+def report(results):
+    totals = {}
+    for r in results:
+        for name, count in r.signals.items():
+            logging.info('[backtest] %s %s bars:%d signals:%d hits:%d'
+                         % (r.symbol, name, r.bars, count, r.hits[name]))
+            total = totals.setdefault(name, [0, 0])
+            total[0] += count
+            total[1] += r.hits[name]
+
+    for name, (count, hits) in totals.items():
+        rate = hits / count if count > 0 else 0
+        logging.info('[backtest] total %s signals:%d hits:%d hit rate:%f' % (name, count, hits, rate))
+
+def _parse_date(text):
+    # 东八区日期
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d')) - 60 * 60 * 8
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_backtest', True)
+
+    start = START_TIME
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0][:1].isdigit():
+        start = _parse_date(args[0])
+        args = args[1:]
+
+    db_conn = kline_common.DBConnection()
+    db_conn.start(True, False)
+
+    symbols = args
+    if len(symbols) == 0:
+        symbols = [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+
+    report(run(symbols, kline_rule.load_plan(db_conn), start))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import bson
+import zlib
+import struct
+import logging
+import numpy as np
+
+import kline_common
+import kline_resample
+
+# 一段按id排序的K线列数组的压缩编码，编解码全部是numpy向量运算
+#   id     二阶差分，zigzag后varint，连续K线的二阶差分都是0，每根1字节
+#   价格   能用10^k整数精确表示时按整数差分varint，否则与上一个值的位异或，按字节重排后zlib压缩
+#   成交量 同价格，两种方式都可用时取较小的，count 差分varint
+# 成交额等价格乘数量的值尾数接近随机，无损压缩只能节省很少的空间
+# 格式: 头部(版本, 行数) 之后每一列 (编码方式, k, 字节数) + 数据
+
+VERSION = 1
+
+HEADER = struct.Struct('<BI')
+COLUMN = struct.Struct('<BBI')
+
+METHOD_DOD = 0
+METHOD_DELTA = 1
+METHOD_SCALED = 2
+METHOD_SHUFFLE = 3
+
+# 整数化尝试的最大小数位数
+MAX_SCALE = 12
+
+def zigzag(values):
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def unzigzag(values):
+    values = values.astype(np.uint64)
+    return ((values >> np.uint64(1)).view(np.int64)) ^ -(values & np.uint64(1)).view(np.int64)
+
+def varint_encode(values):
+    """
+    uint64数组编码成varint字节，每个字节低7位为数据，最高位表示后面还有字节
+    """
+    values = values.astype(np.uint64)
+    if len(values) == 0:
+        return b''
+    # 每个值需要的字节数
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+
+    width = int(sizes.max())
+    shifts = np.arange(width, dtype=np.uint64) * np.uint64(7)
+    data = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    index = np.arange(width)
+    data |= np.where(index < sizes[:, None] - 1, 0x80, 0).astype(np.uint8)
+    return data[index < sizes[:, None]].tobytes()
+
+def varint_decode(data, count):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 0x80)
+    if len(ends) != count:
+        raise ValueError('varint count mismatch %d != %d' % (len(ends), count))
+    starts = np.r_[0, ends[:-1] + 1]
+    # 每个字节在所属值中的位置
+    pos = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7f).astype(np.uint64) << (pos.astype(np.uint64) * np.uint64(7))
+    return np.bitwise_or.reduceat(parts, starts)
+
+def _find_scale(values):
+    """
+    values * 10^k 为整数且除回去与原值完全相同的最小k，找不到时返回None
+    """
+    # nan inf和-0.0不能用整数表示
+    if not np.all(np.isfinite(values)) or np.any(np.signbit(values) & (values == 0)):
+        return None
+    for k in range(MAX_SCALE + 1):
+        scale = 10.0 ** k
+        scaled = np.round(values * scale)
+        if np.any(np.abs(scaled) >= 2 ** 53):
+            return None
+        if np.array_equal((scaled / scale).view(np.int64), values.view(np.int64)):
+            return k
+    return None
+
+def _encode_column(values, integer):
+    if integer:
+        return METHOD_DELTA, 0, varint_encode(zigzag(np.diff(values, prepend=0)))
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    # 相近的浮点数符号位、指数和高位尾数相同，异或后按字节位置重排，高位字节大多为0
+    bits = values.view(np.uint64)
+    xor = bits ^ np.r_[np.uint64(0), bits[:-1]]
+    result = (METHOD_SHUFFLE, 0, zlib.compress(xor.view(np.uint8).reshape(-1, 8).T.tobytes()))
+    k = _find_scale(values)
+    if k is not None:
+        ints = np.round(values * 10.0 ** k).astype(np.int64)
+        data = varint_encode(zigzag(np.diff(ints, prepend=0)))
+        if len(data) <= len(result[2]):
+            result = (METHOD_SCALED, k, data)
+    return result
+
+def _decode_column(method, k, data, count):
+    if method == METHOD_SHUFFLE:
+        planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(8, count)
+        xor = np.ascontiguousarray(planes.T).view(np.uint64).reshape(count)
+        return np.bitwise_xor.accumulate(xor).view(np.float64)
+    raw = varint_decode(data, count)
+    if method == METHOD_DOD:
+        return np.cumsum(np.cumsum(unzigzag(raw)))
+    if method == METHOD_DELTA:
+        return np.cumsum(unzigzag(raw))
+    if method == METHOD_SCALED:
+        return np.cumsum(unzigzag(raw)) / 10.0 ** k
+    raise ValueError('unknown column method %d' % method)
+
+def encode(columns):
+    """
+    kline_resample.load_bars格式的列数组编码成bytes
+    """
+    ids = np.asarray(columns['id'], dtype=np.int64)
+    parts = [HEADER.pack(VERSION, len(ids))]
+    for field in kline_resample.FIELDS:
+        if field == 'id':
+            method, k, data = METHOD_DOD, 0, varint_encode(zigzag(np.diff(np.diff(ids, prepend=0), prepend=0)))
+        else:
+            method, k, data = _encode_column(np.asarray(columns[field]), field == 'count')
+        parts.append(COLUMN.pack(method, k, len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def decode(data):
+    """
+    encode的逆过程，返回与kline_resample.load_bars相同格式的列数组
+    """
+    version, count = HEADER.unpack_from(data, 0)
+    if version != VERSION:
+        raise ValueError('unknown codec version %d' % version)
+    offset = HEADER.size
+    columns = {}
+    for field in kline_resample.FIELDS:
+        method, k, size = COLUMN.unpack_from(data, offset)
+        offset += COLUMN.size
+        values = _decode_column(method, k, data[offset:offset + size], count)
+        offset += size
+        if field in ('id', 'count'):
+            columns[field] = values.astype(np.int64)
+        else:
+            columns[field] = values.astype(np.float64)
+    return columns
+
+def describe(data):
+    """
+    每一列的 (字段, 编码方式, k, 字节数)
+    """
+    offset = HEADER.size
+    result = []
+    for field in kline_resample.FIELDS:
+        method, k, size = COLUMN.unpack_from(data, offset)
+        offset += COLUMN.size + size
+        result.append((field, method, k, size))
+    return result
+
+def raw_size(columns):
+    return len(columns['id']) * 8 * len(kline_resample.FIELDS)
+
+def same_columns(a, b):
+    # 按位比较，nan与-0.0也要一致
+    return all(np.asarray(a[f]).tobytes() == np.asarray(b[f]).tobytes() for f in kline_resample.FIELDS)
+
+if __name__ == "__main__":
+    # python kline_codec.py symbol [period] 统计真实K线数据的压缩率和编解码速度
+    kline_common.init_logging('kline_codec', True)
+
+    if len(sys.argv) < 2:
+        print('usage: kline_codec.py symbol [period]')
+        sys.exit(1)
+
+    import kline_archive
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+
+    symbol = sys.argv[1]
+    period = sys.argv[2] if len(sys.argv) > 2 else '1min'
+    columns = kline_archive.load_history(db_conn, symbol, period)
+    columns = dict((field, np.array(values)) for field, values in columns.items())
+    docs = kline_resample.to_documents(columns)
+    bson_size = sum(len(bson.encode(doc)) for doc in docs)
+    size = raw_size(columns)
+
+    start_time = time.time()
+    data = encode(columns)
+    encode_time = max(time.time() - start_time, 1e-6)
+
+    start_time = time.time()
+    result = decode(data)
+    decode_time = max(time.time() - start_time, 1e-6)
+
+    logging.info('[codec] %s_%s bars:%d bson:%d raw:%d encoded:%d ratio bson:%f raw:%f same:%s'
+                 % (symbol, period, len(docs), bson_size, size, len(data), bson_size / max(len(data), 1),
+                    size / max(len(data), 1), same_columns(columns, result)))
+    for field, method, k, column_size in describe(data):
+        logging.info('[codec] %s method:%d k:%d bytes/bar:%f' % (field, method, k, column_size / max(len(docs), 1)))
+    logging.info('[codec] encode MB/s:%f decode MB/s:%f'
+                 % (size / encode_time / 1024 / 1024, size / decode_time / 1024 / 1024))
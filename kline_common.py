@@ -5,6 +5,7 @@ import os
 import gzip
 import time
 import json
+import struct
 import redis
 import pymongo
 import threading
@@ -47,27 +48,91 @@ def init_logging(module_name, console=False):
         ch.setFormatter(formatter)
         logger.addHandler(ch)
 
+# 只有新值更大时才写入，返回写入前的值，保证游标只会前进
+HSET_MAX_SCRIPT = """
+local cur = redis.call('hget', KEYS[1], ARGV[1])
+if (not cur) or tonumber(cur) < tonumber(ARGV[2]) then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+return cur
+"""
+
+# 按名称分配交易对编号，编号从1开始连续分配
+SYMBOL_ID_SCRIPT = """
+local id = redis.call('hget', KEYS[1], ARGV[1])
+if id then
+    return tonumber(id)
+end
+id = redis.call('hlen', KEYS[1]) + 1
+redis.call('hset', KEYS[1], ARGV[1], id)
+return id
+"""
+
 class DBConnection:
     def start(self, use_redis = True, use_db = True):
         if use_db:
             self.client = pymongo.MongoClient(kline_config.DBIP,kline_config.DBPort)
             self.db = self.client[kline_config.DBName]
+            # 已经检查过索引的集合
+            self.indexed = set()
             if kline_config.DBUser != '':
                 self.db.authenticate(kline_config.DBUser,kline_config.DBPasswd)
         if use_redis:
             self.redis = redis.Redis(host=kline_config.RedisIP, port=kline_config.RedisPort, db=0)
+            self._hset_max = self.redis.register_script(HSET_MAX_SCRIPT)
+            self._symbol_id = self.redis.register_script(SYMBOL_ID_SCRIPT)
 
     def get_collection(self, name, idunique=True):
+        if kline_config.KlineStorage == 'bucket':
+            import kline_store
+            names = kline_store.parse_name(name)
+            if names is not None:
+                collection = self.db[kline_config.KlineBucketCollection]
+                self._ensure_index(kline_config.KlineBucketCollection, kline_store.ensure_index, collection)
+                return kline_store.BucketCollection(collection, names[0], names[1])
+
         collection = self.db[name]
         if idunique:
-            collection.ensure_index('id', unique=True)     
+            self._ensure_index(name, lambda c: c.ensure_index('id', unique=True), collection)
         return collection
 
+    def _ensure_index(self, name, create, collection):
+        # 每个集合只在第一次使用时检查索引
+        if name not in self.indexed:
+            create(collection)
+            self.indexed.add(name)
+
     def hset(self, hash, key, value):
         self.redis.hset(hash, key, value)
 
+    def hset_max(self, hash, key, value, pipe=None):
+        return self._hset_max(keys=[hash], args=[key, value], client=pipe)
+
+    def get_symbol_id(self, hash, symbol):
+        return int(self._symbol_id(keys=[hash], args=[symbol]))
+
+    def hgetall(self, hash):
+        return self.redis.hgetall(hash)
+
     def hget(self, hash, key):
         return self.redis.hget(hash,key)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, value):
+        self.redis.set(key, value)
+
+    def hgetall_many(self, hashes):
+        # 一次往返读取多个hash，返回与hashes顺序一致的字典列表
+        pipe = self.pipeline()
+        for hash in hashes:
+            pipe.hgetall(hash)
+        return pipe.execute()
+
+    def pipeline(self):
+        # 用法: with db_conn.pipeline() as pipe: ... pipe.execute()
+        return self.redis.pipeline(transaction=False)
         
     def hexists(self, hash, key):
         return self.redis.hexists(hash,key)
@@ -87,6 +152,13 @@ class DBConnection:
     def llen(self, list_name):
         return self.redis.llen(list_name)
 
+    def lpop_all(self, list_name):
+        # 在事务中读取并清空列表，读取期间新加入的数据不会丢失
+        pipe = self.redis.pipeline()
+        pipe.lrange(list_name, 0, -1)
+        pipe.delete(list_name)
+        return pipe.execute()[0]
+
     def publish(self, topic, message):
         self.redis.publish(topic, message)
 
@@ -95,6 +167,237 @@ class DBConnection:
         pubsub.subscribe(topic)
         return pubsub
 
+    def xadd(self, stream, fields, maxlen=None):
+        return self.redis.xadd(stream, fields, maxlen=maxlen, approximate=True)
+
+    def xgroup_create(self, stream, group):
+        try:
+            self.redis.xgroup_create(stream, group, id='$', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            # 消费组已经存在
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def xreadgroup(self, group, consumer, stream, count, block=None, start_id='>'):
+        # 返回 [(消息id, 字段字典)]
+        result = self.redis.xreadgroup(group, consumer, {stream: start_id}, count=count, block=block)
+        if not result:
+            return []
+        return result[0][1]
+
+    def xack(self, stream, group, ids):
+        if len(ids) > 0:
+            self.redis.xack(stream, group, *ids)
+
+PERIOD_CODES = {'1min': 1, '5min': 2, '15min': 3, '30min': 4, '60min': 5, '1day': 6, '1week': 7}
+PERIOD_NAMES = dict((v, k) for k, v in PERIOD_CODES.items())
+
+class Tick:
+    __slots__ = ('symbol', 'period', 'id', 'open', 'high', 'low', 'close',
+                 'amount', 'vol', 'count', 'ts', 'recv_ts')
+
+    def __init__(self, symbol='', period='1min', id=0, open=0.0, high=0.0, low=0.0, close=0.0,
+                 amount=0.0, vol=0.0, count=0, ts=0, recv_ts=0.0):
+        self.symbol = symbol
+        self.period = period
+        self.id = id
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.amount = amount
+        self.vol = vol
+        self.count = count
+        self.ts = ts
+        self.recv_ts = recv_ts
+
+    @staticmethod
+    def from_message(data, recv_ts=0.0):
+        # market.<symbol>.kline.<period>
+        splits = data['ch'].split('.')
+        tick = data['tick']
+        return Tick(splits[1], splits[3], tick['id'], tick['open'], tick['high'], tick['low'],
+                    tick['close'], tick.get('amount', 0.0), tick.get('vol', 0.0), tick.get('count', 0),
+                    data.get('ts', 0), recv_ts)
+
+# 交易对名称与编号的对应表，保存在redis中由各进程共享
+class SymbolTable:
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.hash = 'symbol_ids'
+        self.ids = {}
+        self.names = {}
+        # 重新加载后仍然找不到的编号 -> 上次查找的时间
+        self.missing = {}
+
+    def get_id(self, symbol):
+        id = self.ids.get(symbol)
+        if id is None:
+            id = self.db_conn.get_symbol_id(self.hash, symbol)
+            self.ids[symbol] = id
+            self.names[id] = symbol
+        return id
+
+    def get_symbol(self, id):
+        symbol = self.names.get(id)
+        if symbol is None:
+            # 其他进程新分配的编号，重新加载整个表，找不到的编号一段时间内不再重复加载
+            now = time.time()
+            last = self.missing.get(id)
+            if last is not None and now - last < kline_config.SymbolReloadInterval:
+                return None
+            self.reload()
+            symbol = self.names.get(id)
+            if symbol is None:
+                if last is None:
+                    logging.warning('[symbol] unknown symbol id : %s' % id)
+                self.missing[id] = now
+        return symbol
+
+    def reload(self):
+        for k, v in self.db_conn.hgetall(self.hash).items():
+            symbol = k.decode('utf-8')
+            self.ids[symbol] = int(v)
+            self.names[int(v)] = symbol
+            self.missing.pop(int(v), None)
+
+# 定长二进制tick记录：交易对编号 周期 K线id 开高低收 成交量 成交额 笔数 交易所时间(毫秒) 接收时间
+TICK_RECORD = struct.Struct('<HBxIddddddIqd')
+# 记录开头的交易对编号，按交易对分发时只解析这一项
+TICK_SYMBOL = struct.Struct('<H')
+
+class TickCodec:
+    def __init__(self, symbol_table):
+        self.symbol_table = symbol_table
+
+    def encode(self, tick):
+        return TICK_RECORD.pack(self.symbol_table.get_id(tick.symbol), PERIOD_CODES[tick.period],
+                                tick.id, tick.open, tick.high, tick.low, tick.close,
+                                tick.amount, tick.vol, tick.count, tick.ts, tick.recv_ts)
+
+    def decode(self, data):
+        values = TICK_RECORD.unpack(data)
+        return Tick(self.symbol_table.get_symbol(values[0]), PERIOD_NAMES[values[1]], *values[2:])
+
+# 写入K线并推进游标后发布K线提交事件，分析模块据此更新缓存而不用每个tick查询redis
+# 事件使用与tick相同的二进制记录
+class BarPublisher:
+    def __init__(self, db_conn):
+        self.codec = TickCodec(SymbolTable(db_conn))
+        self.channel = kline_config.BarCommitChannel
+        # 每页数据只发布最新的若干根，分析模块的缓存窗口不会超过这个数量
+        self.max_count = kline_config.BarCommitMax
+
+    def publish(self, pipe, symbol, period, bars):
+        now = time.time()
+        for bar in bars[-self.max_count:]:
+            tick = Tick(symbol, period, bar['id'], bar['open'], bar['high'], bar['low'], bar['close'],
+                        bar.get('amount', 0.0), bar.get('vol', 0.0), bar.get('count', 0), 0, now)
+            pipe.publish(self.channel, self.codec.encode(tick))
+
+# tick数据的发布，pubsub模式兼容旧版本，stream模式使用redis streams持久保存
+class TickPublisher:
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.use_stream = kline_config.TickTransport == 'stream'
+
+    def publish(self, msg):
+        if self.use_stream:
+            self.db_conn.xadd(kline_config.TickStream, {'d': msg}, kline_config.TickStreamMaxLen)
+        else:
+            self.db_conn.publish('tick_data', msg)
+
+# tick数据的批量读取
+# stream模式下同一个消费组里的多个消费者分摊数据，处理完调用ack确认
+class TickSubscriber:
+    def __init__(self, db_conn, consumer):
+        self.db_conn = db_conn
+        self.consumer = consumer
+        self.use_stream = kline_config.TickTransport == 'stream'
+        self.batch_size = kline_config.TickBatchSize
+        self.stream = kline_config.TickStream
+        self.group = kline_config.TickStreamGroup
+        self.pubsub = None
+        self.pending_ids = []
+        # 重启后先处理上次没有确认的消息
+        self.start_id = '0'
+
+    def start(self):
+        if self.use_stream:
+            self.db_conn.xgroup_create(self.stream, self.group)
+        else:
+            self.pubsub = self.db_conn.subscribe('tick_data')
+
+    def read(self, block=True):
+        """
+        block为False时只读取已经到达的数据
+        """
+        if self.use_stream:
+            return self._read_stream(block)
+        return self._read_pubsub(block)
+
+    def ack(self):
+        if self.use_stream:
+            self.db_conn.xack(self.stream, self.group, self.pending_ids)
+        self.pending_ids = []
+
+    def _read_stream(self, block):
+        entries = self.db_conn.xreadgroup(self.group, self.consumer, self.stream,
+                                          self.batch_size, 1000 if block else None, self.start_id)
+        if self.start_id != '>':
+            # 读取未确认的消息时从上一批之后继续，没有确认之前再用同一个id会读到相同的消息
+            if len(entries) == 0:
+                self.start_id = '>'
+            else:
+                self.start_id = entries[-1][0]
+
+        msgs = []
+        for entry_id, fields in entries:
+            self.pending_ids.append(entry_id)
+            # 已经被裁剪掉的消息重读时fields为None，随这一批确认后跳过
+            if fields is None:
+                continue
+            if b'd' in fields:
+                msgs.append(fields[b'd'])
+        return msgs
+
+    def _read_pubsub(self, block):
+        msgs = []
+        timeout = 1 if block else 0
+        while len(msgs) < self.batch_size:
+            topic = self.pubsub.get_message(timeout=timeout)
+            if topic is None:
+                break
+            # 第一条之后只读取已经到达的数据
+            timeout = 0
+            if topic['type'] != 'message' or topic['channel'] != b'tick_data':
+                continue
+            if type(topic['data']) != bytes:
+                continue
+            msgs.append(topic['data'])
+        return msgs
+
+# 原始数据帧记录格式：接收时间(double) 长度(uint32) gzip数据
+FRAME_HEADER = struct.Struct('<dI')
+
+class FrameRecorder:
+    def __init__(self, path):
+        dir_name = os.path.dirname(path)
+        if dir_name != '' and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.file = open(path, 'ab', buffering=1024 * 1024)
+        self.flush_time = time.time()
+
+    def write(self, frame, recv_time):
+        self.file.write(FRAME_HEADER.pack(recv_time, len(frame)))
+        self.file.write(frame)
+        if recv_time - self.flush_time > 1:
+            self.flush_time = recv_time
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
 class DataConnection:
     
     DISCONNECTED = 0
@@ -113,6 +416,12 @@ class DataConnection:
         self.on_message_stop = None
         self.on_send_failed = None
         self.on_message = None
+        self.recorder = None
+
+    def capture(self, path):
+        # 记录收到的原始数据帧，用于离线回放
+        logging.info('[connect] capture to ' + path)
+        self.recorder = FrameRecorder(path)
 
     def start(self, receive_raw=False):
         self._receive_raw = receive_raw
@@ -125,7 +434,7 @@ class DataConnection:
         self._connect_status = DataConnection.CONNECTING
         
         headers = httputil.HTTPHeaders({'Content-Type': 'application/json'})
-        request = httpclient.HTTPRequest(url = "wss://api.huobi.br.com/ws",
+        request = httpclient.HTTPRequest(url = kline_config.WSUrl,
                                          connect_timeout=self.connect_timeout,
                                          request_timeout=self.request_timeout,
                                          headers=headers)
@@ -163,6 +472,9 @@ class DataConnection:
 
     def _stop(self):
         self._connect_status = DataConnection.STOPED
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
         if self._ws_connection != None:
             self._ws_connection.close()
             self._ws_connection = None
@@ -258,6 +570,9 @@ class DataConnection:
             self._reconnect()
                
     def _on_message(self, message):
+        if self.recorder is not None:
+            self.recorder.write(message, time.time())
+
         try:
             result = gzip.decompress(message).decode('utf-8')
  
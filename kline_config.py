@@ -10,5 +10,98 @@ DBPasswd='klineapp'
 RedisIP='localhost'
 RedisPort=6379
 LogPath='./Logs/'
+# 行情websocket地址，离线压测时可以指向kline_mockserver
+WSUrl='wss://api.huobi.br.com/ws'
+# 不为空时记录websocket原始数据帧，用于回放测试
+CapturePath=''
 
-    
\ No newline at end of file
+# 5min到1week的K线来源：local 由1min数据本地合成，upstream 从交易所拉取
+KlinePeriodSource='local'
+
+# 抓取任务并发窗口
+TaskWindowMin=2
+TaskWindowMax=32
+TaskTimeout=10
+TaskMaxRetry=3
+TaskLatencyTarget=2
+
+# 异步写库
+WriterWorkers=4
+WriterQueueSize=64
+WriterReportInterval=60
+
+# tick数据传输：stream 使用redis streams消费组，pubsub 兼容旧版本
+TickTransport='stream'
+TickStream='tick_stream'
+TickStreamMaxLen=100000
+TickStreamGroup='kline_analysis'
+TickBatchSize=100
+# tick数据编码：binary 定长二进制记录，json 原始行情文本
+TickEncoding='binary'
+# 未知的交易对编号至少间隔多少秒才重新加载编号表
+SymbolReloadInterval=10
+
+# 分析模块启动预热与快照
+WarmUpWorkers=16
+SnapshotPath='./Snapshot/kline_analysis.pkl'
+SnapshotInterval=60
+SnapshotMaxAge=3600
+
+# K线提交事件
+BarCommitChannel='bar_commit'
+BarCommitMax=20
+
+# K线存储方式：collection 每个交易对每个周期一个集合，bucket 全部放在KlineBucketCollection中按天/周分桶
+KlineStorage = 'collection'
+KlineBucketCollection = 'klines'
+# 新建桶时与其他写入者冲突的重试次数
+KlineBucketRetry = 3
+
+# 本地列式K线归档，最近ArchiveSettleBars根K线不归档
+ArchivePath = './Archive/'
+ArchivePeriods = ['1min', '60min']
+ArchiveSettleBars = 2
+
+# 技术指标
+IndicatorPeriods = ['1min', '60min']
+IndicatorWarmUpBars = 300
+
+# 买入规则：file 从RulePath读取，redis 从RuleKey读取
+RuleSource = 'file'
+RulePath = './kline_rules.json'
+RuleKey = 'kline_rules'
+
+# 分析模块分片模式：分片进程数量，每个分片队列最多缓存的tick批次
+AnalysisShards = 4
+ShardQueueSize = 100
+
+# 分析模块积压时合并同一根K线的tick，一次最多读取的tick数量
+TickConflation = True
+ConflationMaxTicks = 10000
+ConflationReportInterval = 60
+
+# 实时模块订阅中断检测：阈值为推送间隔平均值的StaleFactor倍，限制在[StaleMinSeconds, StaleMaxSeconds]
+StaleFactor = 10
+StaleMinSeconds = 30
+StaleMaxSeconds = 600
+SubAckTimeout = 10
+StaleResubMax = 20
+StaleCheckInterval = 5
+StaleReportInterval = 60
+StalenessHash = 'kline_staleness'
+
+# 实时模块由订阅推送合成1min K线并写库，存储模块只补拉缺口
+LiveBars = True
+# K线结束后等待这么多秒还没有新推送就直接提交
+LiveBarGrace = 5
+# 1min游标落后超过这个秒数时存储模块恢复拉取1min数据
+LiveBarLagLimit = 180
+KlineGapList = 'kline_gap_tasks'
+# 存储模块补齐缺口后通知实时模块重建合成周期
+KlineRepairList = 'kline_repaired'
+
+# 存储模块按K线结束时间调度拉取：结束后延迟秒数，按交易对分散的最大秒数，超过多少秒算延迟执行
+SchedulerDelay = 2
+SchedulerJitter = 10
+SchedulerLateLimit = 30
+SchedulerReportInterval = 60
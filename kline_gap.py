@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import bson
+import logging
+import pymongo
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import kline_common
+import kline_resample
+
+# 交易所单次请求最多返回的K线数量
+MAX_TASK_COUNT = 300
+
+# 只包含int32 id字段的文档：长度(4) 类型(1) 'id\0'(3) 值(4) 结束(1)
+ID_DOC_DTYPE = np.dtype([('size', '<i4'), ('type', 'u1'), ('name', 'S3'), ('id', '<i4'), ('end', 'u1')])
+
+class GapResult:
+    def __init__(self, symbol, period):
+        self.symbol = symbol
+        self.period = period
+        self.count = 0
+        self.missing = 0
+        # 缺失区间列表 [(第一根缺失的id, 最后一根缺失的id)]
+        self.runs = []
+        # 合并后的拉取区间列表 [(start_time, end_time)]，与KlineTask的时间含义一致
+        self.tasks = []
+
+def load_ids(collection, start=None, end=None):
+    """
+    通过id索引读取所有K线时间，返回排序后的numpy数组
+    """
+    if hasattr(collection, 'load_ids'):
+        # 分桶存储
+        return collection.load_ids(start, end)
+
+    query = {}
+    cond = {}
+    if start is not None:
+        cond['$gte'] = int(start)
+    if end is not None:
+        cond['$lt'] = int(end)
+    if cond:
+        query['id'] = cond
+
+    cursor = collection.find_raw_batches(query, {'_id': 0, 'id': 1}).sort('id', pymongo.ASCENDING)
+    parts = []
+    for batch in cursor:
+        parts.append(_decode_ids(batch))
+
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(parts)
+
+def _decode_ids(batch):
+    # 所有id都是int32时直接按固定布局解析，避免逐条构造python对象
+    if len(batch) % ID_DOC_DTYPE.itemsize == 0:
+        docs = np.frombuffer(batch, dtype=ID_DOC_DTYPE)
+        if np.all(docs['size'] == ID_DOC_DTYPE.itemsize) and np.all(docs['type'] == 0x10):
+            return docs['id'].astype(np.int64)
+    return np.array([doc['id'] for doc in bson.decode_all(batch)], dtype=np.int64)
+
+def get_first_id(period, init_time=None, start=None):
+    """
+    应该存在的第一根K线的id，init_time为kline_init写入的交易对初始时间，与start取较晚的一个
+    """
+    times = []
+    if init_time is not None:
+        times.append(int(time.mktime(time.strptime(init_time, '%Y-%m-%d %H:%M:%S'))))
+    if start is not None:
+        times.append(int(start))
+    if len(times) == 0:
+        return None
+    t = max(times)
+    first = int(kline_resample.get_bar_time(t, period))
+    if first < t:
+        first += kline_resample.get_period_step(period)
+    return first
+
+def find_runs(ids, step, first=None):
+    """
+    根据排序后的id找出中间缺失的区间，first不为None时还检查first到第一根K线之间的缺失
+    """
+    if first is not None and len(ids) > 0:
+        # 在第一根应该存在的K线之前放一个哨兵
+        ids = np.r_[first - step, ids[ids >= first]]
+    if len(ids) < 2:
+        return []
+    deltas = np.diff(ids)
+    holes = np.flatnonzero(deltas > step)
+    return list(zip((ids[holes] + step).tolist(), (ids[holes + 1] - step).tolist()))
+
+def plan_tasks(runs, step, max_count=MAX_TASK_COUNT):
+    """
+    把缺失区间合并成最少数量的拉取区间，每个区间不超过max_count根K线
+    从左往右贪心覆盖，每个区间从第一根还没覆盖的缺失K线开始
+    """
+    tasks = []
+    span = (max_count - 1) * step
+    i = 0
+    run_start = None
+    while i < len(runs):
+        if run_start is None:
+            run_start = runs[i][0]
+        window_start = run_start
+        window_end = window_start + span
+        last = window_start
+        run_start = None
+        while i < len(runs) and runs[i][0] <= window_end:
+            if runs[i][1] > window_end:
+                # 这一段超出了当前区间，剩下的部分从下个区间开始
+                last = window_end
+                run_start = window_end + step
+                break
+            last = runs[i][1]
+            i += 1
+        tasks.append((window_start - 1, last))
+    return tasks
+
+def scan_collection(db_conn, symbol, period, end, start=None, init_time=None):
+    result = GapResult(symbol, period)
+    step = kline_resample.get_period_step(period)
+
+    # 只检查游标之前的数据
+    ids = load_ids(db_conn.get_collection(symbol + '_' + period), start, end)
+
+    result.count = len(ids)
+    first = get_first_id(period, init_time, start)
+    result.runs = find_runs(ids, step, first)
+    if len(ids) == 0 and first is not None and first < end:
+        # 游标已经前进但是一根K线都没有
+        result.runs = [(first, int(kline_resample.get_bar_time(end - 1, period)))]
+    result.missing = sum((b - a) // step + 1 for a, b in result.runs)
+    result.tasks = plan_tasks(result.runs, step)
+    return result
+
+def scan(db_conn, symbols, periods, start=None, workers=16):
+    """
+    并行扫描所有交易对所有周期的数据缺口
+    """
+    start_time = time.time()
+    infos = dict(zip(symbols, db_conn.hgetall_many(symbols)))
+    init_times = dict((symbol, info[b'init_time'].decode('utf-8') if b'init_time' in info else None)
+                      for symbol, info in infos.items())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_collection, db_conn, symbol, period,
+                                   int(infos[symbol][b'cur_time_' + period.encode('utf-8')]), start,
+                                   init_times[symbol])
+                   for symbol in symbols for period in periods]
+        results = [f.result() for f in futures]
+
+    missing = sum(r.missing for r in results)
+    tasks = sum(len(r.tasks) for r in results)
+    logging.info('[gap] scan %d collections missing:%d tasks:%d time : %f'
+                 % (len(results), missing, tasks, time.time() - start_time))
+    return results
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_gap', True)
+
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+
+    symbols = sys.argv[1:]
+    if len(symbols) == 0:
+        symbols = [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+
+    periods = ['1min', '5min', '15min', '30min', '60min', '1day', '1week']
+    for r in scan(db_conn, symbols, periods):
+        if r.missing > 0:
+            logging.info('[gap] %s_%s count:%d missing:%d runs:%d tasks:%d'
+                         % (r.symbol, r.period, r.count, r.missing, len(r.runs), len(r.tasks)))
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import math
+import time
+import logging
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import kline_common
+import kline_config
+import kline_archive
+import kline_resample
+
+# 技术指标，每个指标有两种计算方式：
+#   update(bar) 实时模式，每根K线或每个tick O(1)更新，同一根K线的多次更新会覆盖上一次的结果
+#   batch(columns) 批量模式，由kline_resample.load_bars读出的列数组计算全部历史
+# 两种模式的浮点运算顺序完全一致，同样的输入得到逐位相同的结果，实盘信号与回测一致：
+#   窗口类指标(SMA/标准差/布林带/VWAP)用前缀和相减，批量模式用np.cumsum，它和逐个累加的顺序相同
+#   递推类指标(EMA/MACD/RSI/ATR)批量模式调用同一个标量递推函数
+# 没有足够数据时结果为nan
+
+NAN = float('nan')
+
+def ema_step(prev, x, alpha):
+    if prev is None:
+        return x
+    return prev + alpha * (x - prev)
+
+def ema_run(values, alpha):
+    out = np.empty(len(values))
+    prev = None
+    for i, x in enumerate(values.tolist()):
+        prev = ema_step(prev, x, alpha)
+        out[i] = prev
+    return out
+
+def window_sum(values, n):
+    out = np.full(len(values), NAN)
+    if len(values) >= n:
+        c = np.cumsum(values)
+        out[n - 1:] = c[n - 1:] - np.r_[0.0, c[:-n]]
+    return out
+
+# 单个数值的指数平均，未提交的值可以被同一根K线的新数据覆盖
+class EmaState:
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.prev = None
+        self.value = None
+
+    def commit(self):
+        self.prev = self.value
+
+    def update(self, x):
+        self.value = ema_step(self.prev, x, self.alpha)
+        return self.value
+
+# 最近n个值的和，保存已提交的前缀和，当前值为最新前缀和减去n根之前的前缀和
+class WindowSum:
+    def __init__(self, n, width=1):
+        self.n = n
+        self.prefix = collections.deque([(0.0,) * width], maxlen=n)
+        self.cur = None
+
+    def commit(self):
+        if self.cur is not None:
+            self.prefix.append(self.cur)
+            self.cur = None
+
+    def update(self, values):
+        self.cur = tuple(a + b for a, b in zip(self.prefix[-1], values))
+        if len(self.prefix) < self.n:
+            return None
+        return tuple(a - b for a, b in zip(self.cur, self.prefix[0]))
+
+class Indicator:
+    def __init__(self):
+        self.last_id = None
+        self.value = NAN
+
+    def update(self, bar):
+        """
+        bar为有id/open/high/low/close/amount/vol属性的对象，例如kline_common.Tick
+        """
+        if self.last_id is not None:
+            if bar.id < self.last_id:
+                return self.value
+            if bar.id > self.last_id:
+                self._commit()
+        self.last_id = bar.id
+        self.value = self._update(bar)
+        return self.value
+
+    def _commit(self):
+        raise NotImplementedError
+
+    def _update(self, bar):
+        raise NotImplementedError
+
+    def batch(self, columns):
+        raise NotImplementedError
+
+class EMA(Indicator):
+    def __init__(self, n):
+        Indicator.__init__(self)
+        self.alpha = 2.0 / (n + 1)
+        self.ema = EmaState(self.alpha)
+
+    def _commit(self):
+        self.ema.commit()
+
+    def _update(self, bar):
+        return self.ema.update(bar.close)
+
+    def batch(self, columns):
+        return ema_run(columns['close'], self.alpha)
+
+# 窗口内收盘价以第一根K线的收盘价为基准计算，减小前缀和的数值范围
+class SMA(Indicator):
+    def __init__(self, n):
+        Indicator.__init__(self)
+        self.n = n
+        self.base = None
+        self.base_id = None
+        self.sums = WindowSum(n)
+
+    def _commit(self):
+        self.sums.commit()
+
+    def _delta(self, bar):
+        # 第一根K线还没走完时基准跟着更新
+        if self.base_id is None or self.base_id == bar.id:
+            self.base = bar.close
+            self.base_id = bar.id
+        return bar.close - self.base
+
+    def _update(self, bar):
+        s = self.sums.update((self._delta(bar),))
+        if s is None:
+            return NAN
+        return self.base + s[0] / self.n
+
+    def batch(self, columns):
+        close = columns['close']
+        if len(close) == 0:
+            return np.zeros(0)
+        base = close[0]
+        return base + window_sum(close - base, self.n) / self.n
+
+# 总体标准差
+class StdDev(SMA):
+    def __init__(self, n):
+        SMA.__init__(self, n)
+        self.sums = WindowSum(n, 2)
+
+    def _update(self, bar):
+        d = self._delta(bar)
+        s = self.sums.update((d, d * d))
+        if s is None:
+            return NAN
+        return self._std(s[0], s[1])[1]
+
+    def _std(self, s1, s2):
+        mean = s1 / self.n
+        var = s2 / self.n - mean * mean
+        if var < 0:
+            var = 0.0
+        return mean, math.sqrt(var)
+
+    def batch(self, columns):
+        close = columns['close']
+        if len(close) == 0:
+            return np.zeros(0)
+        d = close - close[0]
+        mean = window_sum(d, self.n) / self.n
+        var = window_sum(d * d, self.n) / self.n - mean * mean
+        return np.sqrt(np.where(var < 0, 0.0, var))
+
+# 返回 (中轨, 上轨, 下轨)
+class Bollinger(StdDev):
+    def __init__(self, n=20, k=2.0):
+        StdDev.__init__(self, n)
+        self.k = k
+
+    def _update(self, bar):
+        d = self._delta(bar)
+        s = self.sums.update((d, d * d))
+        if s is None:
+            return (NAN, NAN, NAN)
+        mean, std = self._std(s[0], s[1])
+        mid = self.base + mean
+        return (mid, mid + self.k * std, mid - self.k * std)
+
+    def batch(self, columns):
+        close = columns['close']
+        if len(close) == 0:
+            return (np.zeros(0), np.zeros(0), np.zeros(0))
+        mid = SMA.batch(self, columns)
+        std = StdDev.batch(self, columns)
+        return (mid, mid + self.k * std, mid - self.k * std)
+
+# 返回 (MACD, 信号线, 柱)
+class MACD(Indicator):
+    def __init__(self, fast=12, slow=26, signal=9):
+        Indicator.__init__(self)
+        self.fast = EmaState(2.0 / (fast + 1))
+        self.slow = EmaState(2.0 / (slow + 1))
+        self.signal = EmaState(2.0 / (signal + 1))
+
+    def _commit(self):
+        self.fast.commit()
+        self.slow.commit()
+        self.signal.commit()
+
+    def _update(self, bar):
+        macd = self.fast.update(bar.close) - self.slow.update(bar.close)
+        signal = self.signal.update(macd)
+        return (macd, signal, macd - signal)
+
+    def batch(self, columns):
+        close = columns['close']
+        macd = ema_run(close, self.fast.alpha) - ema_run(close, self.slow.alpha)
+        signal = ema_run(macd, self.signal.alpha)
+        return (macd, signal, macd - signal)
+
+# Wilder平滑的RSI，第一根K线没有涨跌幅
+class RSI(Indicator):
+    def __init__(self, n=14):
+        Indicator.__init__(self)
+        self.gain = EmaState(1.0 / n)
+        self.loss = EmaState(1.0 / n)
+        self.prev_close = None
+        self.close = None
+
+    def _commit(self):
+        self.gain.commit()
+        self.loss.commit()
+        self.prev_close = self.close
+
+    def _update(self, bar):
+        self.close = bar.close
+        if self.prev_close is None:
+            return NAN
+        diff = bar.close - self.prev_close
+        gain = self.gain.update(diff if diff > 0 else 0.0)
+        loss = self.loss.update(-diff if diff < 0 else 0.0)
+        return rsi_value(gain, loss)
+
+    def batch(self, columns):
+        close = columns['close']
+        out = np.full(len(close), NAN)
+        if len(close) < 2:
+            return out
+        diff = close[1:] - close[:-1]
+        gain = ema_run(np.where(diff > 0, diff, 0.0), self.gain.alpha)
+        loss = ema_run(np.where(diff < 0, -diff, 0.0), self.loss.alpha)
+        out[1:] = [rsi_value(g, l) for g, l in zip(gain.tolist(), loss.tolist())]
+        return out
+
+def rsi_value(gain, loss):
+    if loss == 0:
+        return 100.0 if gain > 0 else 50.0
+    return 100.0 - 100.0 / (1.0 + gain / loss)
+
+# Wilder平滑的平均真实波幅
+class ATR(Indicator):
+    def __init__(self, n=14):
+        Indicator.__init__(self)
+        self.tr = EmaState(1.0 / n)
+        self.prev_close = None
+        self.close = None
+
+    def _commit(self):
+        self.tr.commit()
+        self.prev_close = self.close
+
+    def _update(self, bar):
+        self.close = bar.close
+        tr = bar.high - bar.low
+        if self.prev_close is not None:
+            tr = max(tr, abs(bar.high - self.prev_close), abs(bar.low - self.prev_close))
+        return self.tr.update(tr)
+
+    def batch(self, columns):
+        high = columns['high']
+        low = columns['low']
+        tr = high - low
+        if len(tr) > 1:
+            prev_close = columns['close'][:-1]
+            tr[1:] = np.maximum(np.maximum(tr[1:], np.abs(high[1:] - prev_close)), np.abs(low[1:] - prev_close))
+        return ema_run(tr, self.tr.alpha)
+
+# 最近n根K线的成交量加权均价，vol为成交额，amount为成交量
+class VWAP(Indicator):
+    def __init__(self, n):
+        Indicator.__init__(self)
+        self.sums = WindowSum(n, 2)
+
+    def _commit(self):
+        self.sums.commit()
+
+    def _update(self, bar):
+        s = self.sums.update((bar.vol, bar.amount))
+        if s is None or s[1] <= 0:
+            return NAN
+        return s[0] / s[1]
+
+    def batch(self, columns):
+        vol = window_sum(columns['vol'], self.sums.n)
+        amount = window_sum(columns['amount'], self.sums.n)
+        out = np.full(len(vol), NAN)
+        ok = amount > 0
+        out[ok] = vol[ok] / amount[ok]
+        return out
+
+INDICATORS = {'ema': EMA, 'sma': SMA, 'std': StdDev, 'boll': Bollinger,
+              'macd': MACD, 'rsi': RSI, 'atr': ATR, 'vwap': VWAP}
+
+# 名称 -> (类型, 参数)
+DEFAULT_INDICATORS = {
+    'ema20': ('ema', 20),
+    'sma20': ('sma', 20),
+    'std20': ('std', 20),
+    'boll': ('boll', 20, 2.0),
+    'macd': ('macd', 12, 26, 9),
+    'rsi14': ('rsi', 14),
+    'atr14': ('atr', 14),
+    'vwap20': ('vwap', 20),
+}
+
+def create(spec):
+    return INDICATORS[spec[0]](*spec[1:])
+
+def compute(columns, specs=DEFAULT_INDICATORS):
+    """
+    批量计算一组指标的全部历史
+    """
+    return dict((name, create(spec).batch(columns)) for name, spec in specs.items())
+
+# 一个交易对一个周期的一组指标
+class IndicatorSet:
+    def __init__(self, specs=DEFAULT_INDICATORS):
+        self.indicators = dict((name, create(spec)) for name, spec in specs.items())
+
+    def update(self, bar):
+        for indicator in self.indicators.values():
+            indicator.update(bar)
+
+    def warm_up(self, columns):
+        for row in kline_resample.to_documents(columns):
+            self.update(kline_common.Tick(**row))
+
+    def get(self, name):
+        return self.indicators[name].value
+
+    def values(self):
+        return dict((name, indicator.value) for name, indicator in self.indicators.items())
+
+# 按 (交易对, 周期) 保存指标，由tick和K线提交事件驱动
+class IndicatorCache:
+    def __init__(self, db_conn, periods, specs=DEFAULT_INDICATORS):
+        self.db_conn = db_conn
+        self.periods = periods
+        self.specs = dict(specs)
+        self.sets = {}
+
+    def get(self, coin, period):
+        return self.sets.get((coin, period))
+
+    def get_value(self, coin, period, name):
+        indicators = self.sets.get((coin, period))
+        if indicators is None:
+            return NAN
+        return indicators.get(name)
+
+    def update(self, bar):
+        if bar.period not in self.periods:
+            return
+        key = (bar.symbol, bar.period)
+        indicators = self.sets.get(key)
+        if indicators is None:
+            indicators = IndicatorSet(self.specs)
+            self.sets[key] = indicators
+        indicators.update(bar)
+
+    def warm_up(self, symbols, count=None):
+        """
+        并发读取每个集合最近count根K线，按时间顺序送入实时模式
+        """
+        if count is None:
+            count = kline_config.IndicatorWarmUpBars
+        infos = dict(zip(symbols, self.db_conn.hgetall_many(symbols)))
+
+        def load(coin, period):
+            indicators = IndicatorSet(self.specs)
+            cursor = infos[coin].get(b'cur_time_' + period.encode('utf-8'))
+            if cursor is not None:
+                start = int(cursor) - count * kline_resample.get_period_step(period)
+                indicators.warm_up(kline_archive.load_history(self.db_conn, coin, period, start))
+            return indicators
+
+        futures = {}
+        with ThreadPoolExecutor(max_workers=kline_config.WarmUpWorkers) as executor:
+            for coin in symbols:
+                for period in self.periods:
+                    futures[(coin, period)] = executor.submit(load, coin, period)
+
+        for key, future in futures.items():
+            self.sets[key] = future.result()
+
+def check(columns, specs=DEFAULT_INDICATORS):
+    """
+    对比实时模式与批量模式的结果，返回不一致的指标名称
+    """
+    batch = compute(columns, specs)
+    live = dict((name, []) for name in specs)
+    indicators = IndicatorSet(specs)
+    for row in kline_resample.to_documents(columns):
+        indicators.update(kline_common.Tick(**row))
+        for name, value in indicators.values().items():
+            live[name].append(value)
+
+    bad = []
+    for name in specs:
+        expected = np.array(batch[name], dtype=np.float64)
+        actual = np.array(live[name], dtype=np.float64)
+        if expected.ndim > 1:
+            actual = actual.T
+        if expected.tobytes() != actual.tobytes():
+            bad.append(name)
+    return bad
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_indicator', True)
+
+    if len(sys.argv) < 2:
+        print('usage: kline_indicator.py symbol [period]')
+        sys.exit(1)
+
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+
+    symbol = sys.argv[1]
+    period = sys.argv[2] if len(sys.argv) > 2 else '1min'
+    columns = kline_resample.load_bars(db_conn.get_collection(symbol + '_' + period))
+
+    start_time = time.time()
+    result = compute(columns)
+    logging.info('[indicator] batch %s_%s:%d time : %f' % (symbol, period, len(columns['id']), time.time() - start_time))
+
+    bad = check(columns)
+    logging.info('[indicator] check %s_%s mismatch : %s' % (symbol, period, bad))
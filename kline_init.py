@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # author: shubo
 
+import sys
 import time
 import redis
 import logging
@@ -61,48 +62,60 @@ class Main:
 					   {'symbol':'cvcusdt','init_time':'2018-01-11 00:00:00'}, 
 					   {'symbol':'gntusdt','init_time':'2018-01-08 00:00:00'}]
 		  
-		#将数据设置相关的redis数据
-		self.db_conn.ltrim('symbols',-1, 0)
-		for item in tradesymbols:
-			try:
-				symbol = item['symbol']
-				self.db_conn.rpush('symbols',str(symbol))
-			except Exception as e:
-				logging.error("[init] 1 " + str(e))
+		#将数据设置相关的redis数据，所有写入合并到一次往返
+		symbols = [item['symbol'] for item in tradesymbols]
+		try:
+			pipe = self.db_conn.pipeline()
+			pipe.ltrim('symbols',-1, 0)
+			pipe.rpush('symbols',*symbols)
+			pipe.execute()
+		except Exception as e:
+			logging.error("[init] 1 " + str(e))
 		
 		cur_times = ['cur_time_1min', 'cur_time_5min', 
 					 'cur_time_15min', 'cur_time_30min', 'cur_time_60min', 
 					 'cur_time_1day', 'cur_time_1week']
-				
-		for item in tradesymbols:
+
+		#一次读取所有交易对已有的设置
+		infos = self.db_conn.hgetall_many(symbols)
+		pipe = self.db_conn.pipeline()
+		
+		for item, info in zip(tradesymbols, infos):
 			try:
 				symbol = item['symbol']
 				init_time = item['init_time']
 				#设置这个交易对的Kline初始时间
-				self.db_conn.hset(symbol,'init_time',init_time)
+				mapping = {'init_time': init_time}
 				#如果当前Kline时间不存在就设置这个交易对的当前Kline时间为初始时间                
 				for cur_time_key in cur_times:
-					if not self.db_conn.hexists(symbol,cur_time_key) or overwrite:
+					if cur_time_key.encode('utf-8') not in info or overwrite:
 						time_t = time.strptime(init_time, "%Y-%m-%d %H:%M:%S")
 						cur_time = int(time.mktime(time_t))
-						self.db_conn.hset(symbol,cur_time_key, cur_time)
+						mapping[cur_time_key] = cur_time
 				
 				#添加一个开关方便动态进行数据获取
 				if overwrite:
-					 self.db_conn.hset(symbol,'enabled',1)
-				elif not self.db_conn.hexists(symbol,'enabled'):
-					self.db_conn.hset(symbol,'enabled',0)
+					mapping['enabled'] = 1
+				elif b'enabled' not in info:
+					mapping['enabled'] = 0
+
+				pipe.hset(symbol, mapping=mapping)
 
 			except Exception as e:
 				logging.error("[init] 2 " + str(e))
 
+		try:
+			pipe.execute()
+		except Exception as e:
+			logging.error("[init] 3 " + str(e))
+
 if __name__ == "__main__":
 	
 	overwrite = False
 
-    if len(sys.argv) > 1:
-        if sys.argv[1] == 'overwrite':
-            overwrite = True
+	if len(sys.argv) > 1:
+		if sys.argv[1] == 'overwrite':
+			overwrite = True
 
 	kline_common.init_logging('kline_init', True)
 	main = Main()
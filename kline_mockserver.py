@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import gzip
+import json
+import zlib
+import math
+import logging
+
+import tornado
+import tornado.web
+import tornado.websocket
+from tornado import ioloop
+
+import kline_common
+import kline_resample
+
+# 本地模拟的火币行情websocket服务，用于离线压测 kline_runtime 和 kline_storager
+# 把 kline_config.WSUrl 改成 ws://localhost:<port>/ws 即可连接
+#
+# 用法: python kline_mockserver.py [port] [symbol_count] [msg_rate] [initredis]
+#   msg_rate 为所有连接每秒推送的tick总数
+#   initredis 会把模拟的交易对写入redis，覆盖原有的交易对列表
+
+PERIODS = ['1min', '5min', '15min', '30min', '60min', '1day', '1week']
+
+# 单次req最多返回的K线数量，与交易所一致
+MAX_REQ_COUNT = 300
+
+# DataConnection._check_alive 每5秒检查一次，要求最近一次ping在1秒以内
+PING_INTERVAL = 500
+
+PUSH_INTERVAL = 10
+
+def create_symbols(count):
+    return ['mock%04dusdt' % i for i in range(count)]
+
+def _noise(symbol, period, bar_id):
+    # 由交易对和时间决定的伪随机数，范围[-1, 1)，保证同一根K线每次生成的结果一致
+    value = zlib.crc32(('%s_%s_%d' % (symbol, period, bar_id)).encode('utf-8'))
+    return value / 2147483648.0 - 1
+
+def create_bar(symbol, period, bar_id):
+    base = 100 + zlib.crc32(symbol.encode('utf-8')) % 1000
+    step = kline_resample.get_period_step(period)
+    price = base * (1 + 0.1 * math.sin(bar_id / 86400.0))
+    open_price = price * (1 + 0.002 * _noise(symbol, period, bar_id))
+    close_price = price * (1 + 0.002 * _noise(symbol, period, bar_id + step))
+    high = max(open_price, close_price) * (1 + 0.001 * abs(_noise(symbol, period, bar_id + 1)))
+    low = min(open_price, close_price) * (1 - 0.001 * abs(_noise(symbol, period, bar_id + 2)))
+    amount = (step / 60) * (10 + 5 * _noise(symbol, period, bar_id + 3))
+    return {'id': bar_id, 'open': round(open_price, 4), 'close': round(close_price, 4),
+            'low': round(low, 4), 'high': round(high, 4), 'amount': round(amount, 4),
+            'vol': round(amount * price, 4), 'count': int(amount * 3)}
+
+class MockMarket:
+    def __init__(self, symbols, msg_rate):
+        self.symbols = set(symbols)
+        self.msg_rate = msg_rate
+        self.handlers = set()
+        self.ticks = {}
+        self.push_count = 0
+        self.push_credit = 0.0
+        self.next_index = 0
+
+    def start(self):
+        ioloop.PeriodicCallback(self._push, PUSH_INTERVAL).start()
+        ioloop.PeriodicCallback(self._report, 10000).start()
+
+    def parse_channel(self, ch):
+        # market.<symbol>.kline.<period>
+        sp = ch.split('.')
+        if len(sp) != 4 or sp[0] != 'market' or sp[2] != 'kline':
+            return None, None
+        if sp[1] not in self.symbols or sp[3] not in PERIODS:
+            return None, None
+        return sp[1], sp[3]
+
+    def get_bars(self, symbol, period, from_time, to_time):
+        step = kline_resample.get_period_step(period)
+        bar_id = kline_resample.get_bar_time(from_time + step - 1, period)
+        now = int(time.time())
+        bars = []
+        while bar_id <= to_time and bar_id <= now and len(bars) < MAX_REQ_COUNT:
+            bars.append(create_bar(symbol, period, bar_id))
+            bar_id += step
+        return bars
+
+    def _next_tick(self, symbol, period):
+        now = int(time.time())
+        bar_id = kline_resample.get_bar_time(now, period)
+        tick = self.ticks.get((symbol, period))
+        if tick is None or tick['id'] != bar_id:
+            bar = create_bar(symbol, period, bar_id)
+            tick = {'id': bar_id, 'open': bar['open'], 'close': bar['open'], 'low': bar['open'],
+                    'high': bar['open'], 'amount': 0.0, 'vol': 0.0, 'count': 0}
+            self.ticks[(symbol, period)] = tick
+
+        # 在这根K线的范围内随机游走
+        price = tick['close'] * (1 + 0.0005 * _noise(symbol, period, self.push_count))
+        tick['close'] = round(price, 4)
+        tick['high'] = max(tick['high'], tick['close'])
+        tick['low'] = min(tick['low'], tick['close'])
+        tick['amount'] = round(tick['amount'] + 0.1, 4)
+        tick['vol'] = round(tick['vol'] + 0.1 * price, 4)
+        tick['count'] += 1
+        return tick
+
+    def _push(self):
+        channels = []
+        for handler in self.handlers:
+            for ch in handler.subs:
+                channels.append((handler, ch))
+        if len(channels) == 0:
+            return
+
+        self.push_credit += self.msg_rate * PUSH_INTERVAL / 1000.0
+        count = int(self.push_credit)
+        self.push_credit -= count
+
+        ts = int(time.time() * 1000)
+        for i in range(count):
+            handler, ch = channels[self.next_index % len(channels)]
+            self.next_index += 1
+            symbol, period = handler.subs[ch]
+            tick = self._next_tick(symbol, period)
+            handler.send({'ch': ch, 'ts': ts, 'tick': tick})
+            self.push_count += 1
+
+    def _report(self):
+        logging.info('[mock] connections:%d pushed:%d' % (len(self.handlers), self.push_count))
+
+class MockHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, market):
+        self.market = market
+        self.subs = {}
+        self.ping_callback = None
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        logging.info('[mock] open')
+        self.market.handlers.add(self)
+        self.ping_callback = ioloop.PeriodicCallback(self._ping, PING_INTERVAL)
+        self.ping_callback.start()
+
+    def on_close(self):
+        logging.info('[mock] close')
+        self.market.handlers.discard(self)
+        if self.ping_callback is not None:
+            self.ping_callback.stop()
+
+    def send(self, data):
+        try:
+            message = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            self.write_message(gzip.compress(message, 1), binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def _ping(self):
+        self.send({'ping': int(time.time() * 1000)})
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            logging.warning('[mock] bad message : ' + str(message))
+            return
+
+        if 'pong' in data:
+            return
+
+        request_id = data.get('id', '')
+        ts = int(time.time() * 1000)
+
+        if 'sub' in data:
+            symbol, period = self.market.parse_channel(data['sub'])
+            if symbol is None:
+                self._send_error(request_id, 'invalid topic ' + data['sub'])
+                return
+            self.subs[data['sub']] = (symbol, period)
+            self.send({'id': request_id, 'status': 'ok', 'subbed': data['sub'], 'ts': ts})
+
+        elif 'unsub' in data:
+            self.subs.pop(data['unsub'], None)
+            self.send({'id': request_id, 'status': 'ok', 'unsubbed': data['unsub'], 'ts': ts})
+
+        elif 'req' in data:
+            symbol, period = self.market.parse_channel(data['req'])
+            if symbol is None:
+                self._send_error(request_id, 'invalid topic ' + data['req'])
+                return
+            bars = self.market.get_bars(symbol, period, int(data.get('from', 0)), int(data.get('to', ts // 1000)))
+            self.send({'id': request_id, 'status': 'ok', 'rep': data['req'], 'ts': ts, 'data': bars})
+
+        else:
+            self._send_error(request_id, 'unknown request')
+
+    def _send_error(self, request_id, msg):
+        self.send({'id': request_id, 'status': 'error', 'err-code': 'bad-request',
+                   'err-msg': msg, 'ts': int(time.time() * 1000)})
+
+def init_redis(symbols):
+    # 让 kline_runtime 和 kline_storager 直接使用模拟的交易对，从一小时前开始抓取
+    db_conn = kline_common.DBConnection()
+    db_conn.start(True, False)
+    start_time = int(time.time()) - 60 * 60
+    pipe = db_conn.pipeline()
+    pipe.ltrim('symbols', -1, 0)
+    pipe.rpush('symbols', *symbols)
+    for symbol in symbols:
+        mapping = {'enabled': 2}
+        for period in PERIODS:
+            mapping['cur_time_' + period] = kline_resample.get_bar_time(start_time, period)
+        pipe.hset(symbol, mapping=mapping)
+    pipe.execute()
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_mockserver', True)
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    symbol_count = int(sys.argv[2]) if len(sys.argv) > 2 else 43
+    msg_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    symbols = create_symbols(symbol_count)
+    if len(sys.argv) > 4 and sys.argv[4] == 'initredis':
+        init_redis(symbols)
+
+    market = MockMarket(symbols, msg_rate)
+    app = tornado.web.Application([(r'/ws', MockHandler, {'market': market})])
+    app.listen(port)
+    market.start()
+
+    logging.info('[mock] listen %d symbols:%d rate:%f' % (port, symbol_count, msg_rate))
+    try:
+        ioloop.IOLoop.instance().start()
+    except KeyboardInterrupt:
+        logging.error('[mock] exit .')
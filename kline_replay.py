@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import logging
+
+import kline_common
+
+# 读取FrameRecorder记录的数据帧，文件末尾不完整的记录会被忽略
+class FrameReader:
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        header_size = kline_common.FRAME_HEADER.size
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(header_size)
+                if len(header) < header_size:
+                    break
+                recv_time, length = kline_common.FRAME_HEADER.unpack(header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    break
+                yield recv_time, frame
+
+# 把记录的数据帧按原始节奏的speed倍(0为不限速)送给DataConnection._on_message
+class ReplayDriver:
+    def __init__(self, path, speed=1.0, receive_raw=False):
+        self.reader = FrameReader(path)
+        self.speed = speed
+        self.data_conn = kline_common.DataConnection()
+        self.data_conn._receive_raw = receive_raw
+        self.report_interval = 10
+
+    def run(self, on_message):
+        self.data_conn.on_message = on_message
+
+        frames = 0
+        size = 0
+        first_time = None
+        start_time = time.time()
+        report_time = start_time
+
+        for recv_time, frame in self.reader:
+            if first_time is None:
+                first_time = recv_time
+
+            if self.speed > 0:
+                delay = (recv_time - first_time) / self.speed - (time.time() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.data_conn._on_message(frame)
+            frames += 1
+            size += len(frame)
+
+            now = time.time()
+            if now - report_time > self.report_interval:
+                report_time = now
+                self._report(frames, size, now - start_time)
+
+        self._report(frames, size, time.time() - start_time)
+        return frames, time.time() - start_time
+
+    def _report(self, frames, size, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        logging.info('[replay] frames:%d size:%d time:%f frames/s:%f MB/s:%f'
+                     % (frames, size, elapsed, frames / elapsed, size / elapsed / 1024 / 1024))
+
+def replay_analysis(path, speed):
+    import kline_analysis
+    main = kline_analysis.Main()
+    main.db_conn.start()
+    main._load_plan()
+
+    def on_message(data):
+        if 'tick' in data:
+            main._process_tick(kline_common.Tick.from_message(data, time.time()))
+
+    return ReplayDriver(path, speed).run(on_message)
+
+def replay_runtime(path, speed):
+    import kline_runtime
+    main = kline_runtime.Main()
+    main.db_conn.start(True, main.assembler is not None)
+    if main.writer is not None:
+        main.writer.start()
+    return ReplayDriver(path, speed, not main.binary).run(main.on_message)
+
+def replay_storager(path, speed):
+    import kline_storager
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+    driver = ReplayDriver(path, speed)
+    producer = kline_storager.KlineTaskProducer(db_conn, driver.data_conn)
+    producer.writer.start()
+
+    start_time = time.time()
+    result = driver.run(producer.on_message)
+
+    # 等待写入线程处理完所有数据
+    producer.writer.stop()
+    for thread in producer.writer.threads:
+        thread.join()
+    logging.info('[replay] storager write done time : %f' % (time.time() - start_time))
+    return result
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[2] not in ('analysis', 'runtime', 'storager'):
+        print('usage: kline_replay.py frames_file analysis|runtime|storager [speed|max]')
+        sys.exit(1)
+
+    kline_common.init_logging('kline_replay', True)
+
+    path = sys.argv[1]
+    speed = 1.0
+    if len(sys.argv) > 3:
+        speed = 0 if sys.argv[3] == 'max' else float(sys.argv[3])
+
+    if sys.argv[2] == 'analysis':
+        replay_analysis(path, speed)
+    elif sys.argv[2] == 'runtime':
+        replay_runtime(path, speed)
+    else:
+        replay_storager(path, speed)
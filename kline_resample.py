@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import logging
+import pymongo
+import numpy as np
+
+import kline_common
+
+# K线字段，id为这根K线的开始时间
+FIELDS = ['id', 'open', 'close', 'low', 'high', 'amount', 'vol', 'count']
+
+# 可以由1min数据合成的周期
+DERIVED_PERIODS = ['5min', '15min', '30min', '60min', '1day', '1week']
+
+DAY = 60 * 60 * 24
+WEEK = DAY * 7
+# 东八区偏移
+TZ_OFFSET = 60 * 60 * 8
+# 1970-01-01是周四，偏移3天让每周从周一开始
+WEEK_OFFSET = DAY * 3
+
+def get_period_step(period):
+    if period == '1min':
+        return 60
+    elif period == '5min':
+        return 60 * 5
+    elif period == '15min':
+        return 60 * 15
+    elif period == '30min':
+        return 60 * 30
+    elif period == '60min':
+        return 60 * 60
+    elif period == '1day':
+        return DAY
+    elif period == '1week':
+        return WEEK
+    else:
+        raise Exception('unkonwn period ' + period)
+
+def get_bar_time(t, period):
+    """
+    计算时间t所在K线的开始时间，日线周线按东八区划分，支持numpy数组
+    """
+    if period == '1day':
+        return (t + TZ_OFFSET) // DAY * DAY - TZ_OFFSET
+    elif period == '1week':
+        return (t + TZ_OFFSET + WEEK_OFFSET) // WEEK * WEEK - TZ_OFFSET - WEEK_OFFSET
+    else:
+        step = get_period_step(period)
+        return t // step * step
+
+def load_bars(collection, start=None, end=None):
+    """
+    按id范围读取K线，返回按id排序的列数组，包含start不包含end
+    """
+    cond = {}
+    if start is not None:
+        cond['$gte'] = int(start)
+    if end is not None:
+        cond['$lt'] = int(end)
+    query = {'id': cond} if cond else {}
+
+    docs = list(collection.find(query, {'_id': 0}).sort('id', pymongo.ASCENDING))
+    return to_columns(docs)
+
+def to_columns(docs):
+    columns = {}
+    columns['id'] = np.array([d['id'] for d in docs], dtype=np.int64)
+    for field in FIELDS[1:-1]:
+        columns[field] = np.array([d.get(field, 0) for d in docs], dtype=np.float64)
+    columns['count'] = np.array([d.get('count', 0) for d in docs], dtype=np.int64)
+    return columns
+
+def to_documents(columns):
+    lists = [columns[field].tolist() for field in FIELDS]
+    return [dict(zip(FIELDS, row)) for row in zip(*lists)]
+
+def resample(columns, period):
+    """
+    把按id排序的1min列数组合成为period周期的K线
+    """
+    ids = columns['id']
+    if len(ids) == 0:
+        return to_columns([])
+
+    bar_times = get_bar_time(ids, period)
+    # 数据已排序，每个新周期的第一根K线位置
+    starts = np.flatnonzero(np.r_[True, bar_times[1:] != bar_times[:-1]])
+    ends = np.r_[starts[1:], len(ids)] - 1
+
+    result = {}
+    result['id'] = bar_times[starts]
+    result['open'] = columns['open'][starts]
+    result['close'] = columns['close'][ends]
+    result['low'] = np.minimum.reduceat(columns['low'], starts)
+    result['high'] = np.maximum.reduceat(columns['high'], starts)
+    result['amount'] = np.add.reduceat(columns['amount'], starts)
+    result['vol'] = np.add.reduceat(columns['vol'], starts)
+    result['count'] = np.add.reduceat(columns['count'], starts)
+    return result
+
+def write_bars(collection, docs):
+    # 合成的K线可能是未走完的，用覆盖写入保证后续更新能够生效
+    if len(docs) == 0:
+        return
+    if hasattr(collection, 'replace_bars'):
+        # 分桶存储，同一个桶的K线一次更新
+        collection.replace_bars(docs)
+        return
+    requests = [pymongo.ReplaceOne({'id': doc['id']}, doc, upsert=True) for doc in docs]
+    collection.bulk_write(requests, ordered=False)
+
+class BarState:
+    def __init__(self, bar_time):
+        self.id = bar_time
+        self.last_id = -1
+        self.open = 0
+        self.close = 0
+        self.low = 0
+        self.high = 0
+        self.amount = 0
+        self.vol = 0
+        self.count = 0
+
+    def add(self, bar):
+        if self.last_id < 0:
+            self.open = bar['open']
+            self.low = bar['low']
+            self.high = bar['high']
+        else:
+            self.low = min(self.low, bar['low'])
+            self.high = max(self.high, bar['high'])
+        self.close = bar['close']
+        self.amount += bar.get('amount', 0)
+        self.vol += bar.get('vol', 0)
+        self.count += bar.get('count', 0)
+        self.last_id = bar['id']
+
+    def to_document(self):
+        return {'id': self.id, 'open': self.open, 'close': self.close,
+                'low': self.low, 'high': self.high, 'amount': self.amount,
+                'vol': self.vol, 'count': self.count}
+
+# 根据新写入的1min K线增量更新各个合成周期
+class KlineResampler:
+    def __init__(self, db_conn, periods=DERIVED_PERIODS, publisher=None):
+        self.db_conn = db_conn
+        self.periods = periods
+        self.publisher = publisher
+        self.states = {}
+
+    def on_bars(self, symbol, bars):
+        """
+        bars为按id排序的1min K线，返回每个周期更新后的K线
+        """
+        committed = {}
+        pipe = self.db_conn.pipeline()
+        for period in self.periods:
+            key = symbol + '_' + period
+            state = self.states.get(key)
+            touched = []
+            for bar in bars:
+                bar_time = get_bar_time(bar['id'], period)
+                if state is None or state.id != bar_time:
+                    if state is not None and bar_time < state.id:
+                        continue
+                    state = self._load_state(symbol, period, bar_time, bar['id'])
+                    touched.append(state)
+                elif bar['id'] <= state.last_id:
+                    continue
+                elif bar['id'] > state.last_id + 60:
+                    # 中间的数据由其他进程写入或者有缺失，从库里重新读取这个周期
+                    if len(touched) > 0 and touched[-1] is state:
+                        touched.pop()
+                    state = self._load_state(symbol, period, bar_time, bar['id'])
+                    touched.append(state)
+                elif len(touched) == 0 or touched[-1] is not state:
+                    touched.append(state)
+                state.add(bar)
+            self.states[key] = state
+
+            if len(touched) == 0:
+                continue
+
+            docs = [item.to_document() for item in touched]
+            write_bars(self.db_conn.get_collection(key), docs)
+            self.db_conn.hset_max(symbol, 'cur_time_' + period, docs[-1]['id'] + 1, pipe)
+            if self.publisher is not None:
+                self.publisher.publish(pipe, symbol, period, docs)
+            committed[period] = docs
+
+        # 所有周期的游标和K线提交事件一次写入
+        pipe.execute()
+        return committed
+
+    def reload(self, symbol, start, end):
+        """
+        [start, end]之间的1min数据由其他方式补齐后，丢弃这个交易对缓存的状态并重建覆盖这段区间的K线
+        """
+        for period in self.periods:
+            self.states.pop(symbol + '_' + period, None)
+        committed = rebuild_range(self.db_conn, symbol, start, end, self.periods)
+        if self.publisher is not None:
+            pipe = self.db_conn.pipeline()
+            for period, docs in committed.items():
+                self.publisher.publish(pipe, symbol, period, docs)
+            pipe.execute()
+        return committed
+
+    def _load_state(self, symbol, period, bar_time, bar_id):
+        # 新周期开始时从库里补齐这个周期已有的1min数据，保证重启后结果正确
+        state = BarState(bar_time)
+        if bar_id > bar_time:
+            collection = self.db_conn.get_collection(symbol + '_1min')
+            for doc in collection.find({'id': {'$gte': bar_time, '$lt': bar_id}}).sort('id', pymongo.ASCENDING):
+                state.add(doc)
+        return state
+
+def rebuild(db_conn, symbol, periods=DERIVED_PERIODS):
+    """
+    由全部1min历史数据批量合成各个周期，并更新游标
+    """
+    import kline_archive
+    start_time = time.time()
+    # 已归档的部分从本地读取
+    columns = kline_archive.load_history(db_conn, symbol, '1min')
+    if len(columns['id']) == 0:
+        logging.warning('[resample] %s no 1min data.' % symbol)
+        return
+
+    pipe = db_conn.pipeline()
+    for period in periods:
+        result = resample(columns, period)
+        docs = to_documents(result)
+        collection = db_conn.get_collection(symbol + '_' + period)
+        for i in range(0, len(docs), 1000):
+            write_bars(collection, docs[i:i + 1000])
+        db_conn.hset_max(symbol, 'cur_time_' + period, docs[-1]['id'] + 1, pipe)
+    pipe.execute()
+
+    logging.info('[resample] rebuild %s:%d time : %f' % (symbol, len(columns['id']), time.time() - start_time))
+
+def rebuild_range(db_conn, symbol, start, end, periods=DERIVED_PERIODS):
+    """
+    重新合成覆盖[start, end]这段1min数据的各周期K线，用于补齐缺口之后，返回每个周期写入的K线
+    """
+    load_start = min(get_bar_time(start, period) for period in periods)
+    load_end = max(get_bar_time(end, period) + get_period_step(period) for period in periods)
+    columns = load_bars(db_conn.get_collection(symbol + '_1min'), load_start, load_end)
+
+    committed = {}
+    for period in periods:
+        result = resample(columns, period)
+        keep = (result['id'] >= get_bar_time(start, period)) & (result['id'] <= end)
+        docs = to_documents({field: result[field][keep] for field in FIELDS})
+        write_bars(db_conn.get_collection(symbol + '_' + period), docs)
+        committed[period] = docs
+    return committed
+
+def verify(db_conn, symbol, period, start=None, end=None):
+    """
+    用本地合成结果与交易所拉取的数据做对比，返回 (对比数量, 不一致数量)
+    """
+    step = get_period_step(period)
+    source = load_bars(db_conn.get_collection(symbol + '_1min'), start, end)
+    derived = resample(source, period)
+    stored = load_bars(db_conn.get_collection(symbol + '_' + period), start, end)
+
+    # 只对比1min数据完整覆盖的K线
+    if len(source['id']) == 0:
+        return 0, 0
+    full = (derived['id'] >= source['id'][0]) & (derived['id'] + step <= source['id'][-1] + 60)
+
+    common, di, si = np.intersect1d(derived['id'][full], stored['id'], return_indices=True)
+    mismatch = np.zeros(len(common), dtype=bool)
+    for field in FIELDS[1:]:
+        a = derived[field][full][di]
+        b = stored[field][si]
+        mismatch |= ~np.isclose(a, b, rtol=1e-6)
+
+    for i in np.flatnonzero(mismatch)[:10]:
+        logging.warning('[resample] %s_%s mismatch at %d' % (symbol, period, common[i]))
+
+    return len(common), int(mismatch.sum())
+
+def _get_symbols(db_conn):
+    return [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+
+if __name__ == "__main__":
+    kline_common.init_logging('kline_resample', True)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('rebuild', 'verify'):
+        print('usage: kline_resample.py rebuild [symbol ...]')
+        print('       kline_resample.py verify symbol [period ...]')
+        sys.exit(1)
+
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+
+    if sys.argv[1] == 'rebuild':
+        symbols = sys.argv[2:] or _get_symbols(db_conn)
+        for symbol in symbols:
+            rebuild(db_conn, symbol)
+    else:
+        symbol = sys.argv[2]
+        for period in sys.argv[3:] or DERIVED_PERIODS:
+            total, bad = verify(db_conn, symbol, period)
+            logging.info('[resample] verify %s_%s total:%d mismatch:%d' % (symbol, period, total, bad))
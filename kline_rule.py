@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import ast
+import sys
+import json
+import math
+import logging
+import operator
+import numpy as np
+
+import kline_common
+import kline_config
+
+# 声明式买入规则，规则文件格式:
+# {
+#   "define": {"high": "max(high('1min', 10), high('60min', 4))"},
+#   "rules": [{"name": "in up", "when": "close < high * 0.75"}]
+# }
+# define中的名称在规则里按表达式展开，规则条件支持:
+#   数值与 + - * /，比较(可以连写)，and or not，max min abs
+#   close open         当前tick
+#   day_open           东八区当天开盘价
+#   up_ratio ad_line above_ratio  市场宽度统计
+#   high(period, n) low(period, n)  最近n根K线的最高价/最低价
+#   ema sma std rsi atr vwap(period, n)
+#   macd macd_signal macd_hist(period, fast=12, slow=26, signal=9)
+#   boll_mid boll_upper boll_lower(period, n=20, k=2)
+#
+# 所有规则编译成一个计划，相同的子表达式只计算一次，每个tick的计算量与不同子表达式的数量有关
+
+VALUES = ['close', 'open', 'day_open', 'up_ratio', 'ad_line', 'above_ratio']
+
+WINDOWS = ['high', 'low']
+
+# 函数名 -> (kline_indicator类型, 默认参数, 多值指标的下标)
+INDICATORS = {
+    'ema': ('ema', (), None),
+    'sma': ('sma', (), None),
+    'std': ('std', (), None),
+    'rsi': ('rsi', (), None),
+    'atr': ('atr', (), None),
+    'vwap': ('vwap', (), None),
+    'macd': ('macd', (12, 26, 9), 0),
+    'macd_signal': ('macd', (12, 26, 9), 1),
+    'macd_hist': ('macd', (12, 26, 9), 2),
+    'boll_mid': ('boll', (20, 2.0), 0),
+    'boll_upper': ('boll', (20, 2.0), 1),
+    'boll_lower': ('boll', (20, 2.0), 2),
+}
+
+# kline_indicator类型 -> 各参数的要求，n为正整数的K线数量，k为正数的倍数
+INDICATOR_ARGS = {
+    'ema': ('n',),
+    'sma': ('n',),
+    'std': ('n',),
+    'rsi': ('n',),
+    'atr': ('n',),
+    'vwap': ('n',),
+    'macd': ('n', 'n', 'n'),
+    'boll': ('n', 'k'),
+}
+
+PERIODS = ['1min', '5min', '15min', '30min', '60min', '1day', '1week']
+
+# 单个tick与整条时间线使用相同的nan/inf规则，与numpy一致:
+#   除以0得到inf，0/0得到nan，max min中有nan时结果为nan
+def _div(a, b):
+    if b == 0:
+        if a == 0 or a != a:
+            return float('nan')
+        return math.copysign(float('inf'), a) * math.copysign(1.0, b)
+    return a / b
+
+def _max(*args):
+    for a in args:
+        if a != a:
+            return float('nan')
+    return max(args)
+
+def _min(*args):
+    for a in args:
+        if a != a:
+            return float('nan')
+    return min(args)
+
+def _vector_div(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.divide(a, b)
+
+# 单个tick的计算
+SCALAR_OPS = {
+    'add': operator.add, 'sub': operator.sub, 'mul': operator.mul, 'div': _div, 'neg': operator.neg,
+    'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge,
+    'eq': operator.eq, 'ne': operator.ne,
+    'and': lambda *args: all(args), 'or': lambda *args: any(args), 'not': operator.not_,
+    'max': _max, 'min': _min, 'abs': abs,
+}
+
+# 整条时间线的向量化计算
+VECTOR_OPS = {
+    'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': _vector_div, 'neg': np.negative,
+    'lt': np.less, 'le': np.less_equal, 'gt': np.greater, 'ge': np.greater_equal,
+    'eq': np.equal, 'ne': np.not_equal,
+    'and': lambda *args: np.logical_and.reduce(args), 'or': lambda *args: np.logical_or.reduce(args),
+    'not': np.logical_not,
+    'max': lambda *args: np.maximum.reduce(args), 'min': lambda *args: np.minimum.reduce(args),
+    'abs': np.abs,
+}
+
+# 参数顺序无关的运算，排序后可以合并更多相同的子表达式
+COMMUTATIVE = set(['add', 'mul', 'eq', 'ne', 'and', 'or', 'max', 'min'])
+
+# python3.6的数值字面量是ast.Num，3.8之后是ast.Constant
+NUMBER_NODES = tuple(getattr(ast, name) for name in ('Constant', 'Num') if hasattr(ast, name))
+
+BIN_OPS = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div'}
+CMP_OPS = {ast.Lt: 'lt', ast.LtE: 'le', ast.Gt: 'gt', ast.GtE: 'ge', ast.Eq: 'eq', ast.NotEq: 'ne'}
+
+class RuleError(Exception):
+    pass
+
+def indicator_name(spec):
+    return '_'.join(str(p) for p in spec)
+
+# 编译后的计算计划
+#   leaves  数据项 [(槽位, 数据项)]，数据项为 ('value', 名称) ('window', high/low, 周期, n)
+#           或 ('indicator', 周期, 指标名称, 下标)
+#   steps   [(槽位, 运算, 参数槽位)]，按依赖顺序排列
+#   rules   [(规则名称, 槽位)]
+class RulePlan:
+    def __init__(self):
+        self.slots = {}
+        self.init = []
+        self.leaves = []
+        self.steps = []
+        self.rules = []
+        self.indicators = {}
+
+    def get_periods(self):
+        periods = set(leaf[2] for slot, leaf in self.leaves if leaf[0] == 'window')
+        periods |= set(leaf[1] for slot, leaf in self.leaves if leaf[0] == 'indicator')
+        return sorted(periods, key=PERIODS.index)
+
+    def get_window_counts(self):
+        """
+        每个周期需要缓存的K线数量
+        """
+        counts = {}
+        for slot, leaf in self.leaves:
+            if leaf[0] == 'window':
+                counts[leaf[2]] = max(counts.get(leaf[2], 0), leaf[3])
+        return counts
+
+    def evaluate(self, resolve):
+        """
+        resolve(数据项)返回当前tick的数值，返回满足条件的规则名称
+        """
+        values = list(self.init)
+        for slot, leaf in self.leaves:
+            values[slot] = resolve(leaf)
+        for slot, op, args in self.steps:
+            values[slot] = SCALAR_OPS[op](*[values[a] for a in args])
+        return [name for name, slot in self.rules if values[slot]]
+
+    def evaluate_batch(self, resolve, length):
+        """
+        resolve(数据项)返回整条时间线的数组，返回 规则名称 -> 每个位置是否满足条件
+        """
+        values = [np.full(length, v) if v is not None else None for v in self.init]
+        for slot, leaf in self.leaves:
+            values[slot] = np.asarray(resolve(leaf))
+        for slot, op, args in self.steps:
+            values[slot] = VECTOR_OPS[op](*[values[a] for a in args])
+        return dict((name, values[slot].astype(bool)) for name, slot in self.rules)
+
+class RuleCompiler:
+    def __init__(self, defines=None):
+        self.defines = {}
+        self.plan = RulePlan()
+        for name, text in (defines or {}).items():
+            self.defines[name] = self._parse(text)
+
+    def add_rule(self, name, text):
+        slot = self._compile(self._parse(text), [])
+        self.plan.rules.append((name, slot))
+
+    def _parse(self, text):
+        try:
+            return ast.parse(text, mode='eval').body
+        except SyntaxError as e:
+            raise RuleError('bad expression %s : %s' % (text, e))
+
+    def _slot(self, key):
+        slot = self.plan.slots.get(key)
+        if slot is not None:
+            return slot
+        slot = len(self.plan.init)
+        self.plan.slots[key] = slot
+        if key[0] == 'const':
+            self.plan.init.append(key[1])
+        else:
+            self.plan.init.append(None)
+            if key[0] == 'op':
+                self.plan.steps.append((slot, key[1], key[2]))
+            else:
+                self.plan.leaves.append((slot, key[1]))
+        return slot
+
+    def _op(self, op, args):
+        if op in COMMUTATIVE:
+            args = sorted(args)
+        return self._slot(('op', op, tuple(args)))
+
+    def _compile(self, node, stack):
+        value = self._number(node)
+        if value is not None:
+            return self._slot(('const', value))
+
+        if isinstance(node, ast.Name):
+            if node.id in self.defines:
+                if node.id in stack:
+                    raise RuleError('recursive define ' + node.id)
+                return self._compile(self.defines[node.id], stack + [node.id])
+            if node.id in VALUES:
+                return self._slot(('leaf', ('value', node.id)))
+            raise RuleError('unknown name ' + node.id)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BIN_OPS:
+            return self._op(BIN_OPS[type(node.op)], [self._compile(node.left, stack), self._compile(node.right, stack)])
+
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.USub):
+                return self._op('neg', [self._compile(node.operand, stack)])
+            if isinstance(node.op, ast.Not):
+                return self._op('not', [self._compile(node.operand, stack)])
+
+        if isinstance(node, ast.BoolOp):
+            op = 'and' if isinstance(node.op, ast.And) else 'or'
+            return self._op(op, [self._compile(v, stack) for v in node.values])
+
+        if isinstance(node, ast.Compare):
+            # a < b < c 拆成 a < b and b < c
+            items = [self._compile(node.left, stack)] + [self._compile(c, stack) for c in node.comparators]
+            parts = []
+            for i, op in enumerate(node.ops):
+                if type(op) not in CMP_OPS:
+                    raise RuleError('unsupported compare ' + ast.dump(op))
+                parts.append(self._op(CMP_OPS[type(op)], [items[i], items[i + 1]]))
+            if len(parts) == 1:
+                return parts[0]
+            return self._op('and', parts)
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return self._compile_call(node.func.id, node, stack)
+
+        raise RuleError('unsupported expression ' + ast.dump(node))
+
+    def _number(self, node):
+        if not isinstance(node, NUMBER_NODES):
+            return None
+        value = node.value if hasattr(node, 'value') else node.n
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return float(value)
+
+    def _compile_call(self, func, node, stack):
+        if func in ('max', 'min', 'abs'):
+            args = [self._compile(a, stack) for a in node.args]
+            if len(args) == 0 or (func == 'abs' and len(args) != 1):
+                raise RuleError('bad arguments for ' + func)
+            if len(args) == 1 and func != 'abs':
+                return args[0]
+            return self._op(func, args)
+
+        params = [self._literal(a) for a in node.args]
+        if len(params) == 0 or params[0] not in PERIODS:
+            raise RuleError('%s needs a period as the first argument' % func)
+        period = params[0]
+
+        if func in WINDOWS:
+            if len(params) != 2 or not isinstance(params[1], int) or params[1] <= 0:
+                raise RuleError('%s(period, n) needs a positive bar count' % func)
+            return self._slot(('leaf', ('window', func, period, params[1])))
+
+        if func in INDICATORS:
+            kind, defaults, index = INDICATORS[func]
+            args = tuple(params[1:]) + defaults[len(params) - 1:]
+            self._check_args(func, INDICATOR_ARGS[kind], args)
+            spec = (kind,) + args
+            name = indicator_name(spec)
+            self.plan.indicators[name] = spec
+            return self._slot(('leaf', ('indicator', period, name, index)))
+
+        raise RuleError('unknown function ' + func)
+
+    def _check_args(self, func, kinds, args):
+        if len(args) != len(kinds):
+            raise RuleError('%s(period, %s) got %d arguments' % (func, ', '.join(kinds), len(args)))
+        for kind, arg in zip(kinds, args):
+            if isinstance(arg, bool) or not isinstance(arg, (int, float)) or not arg > 0:
+                raise RuleError('%s arguments must be positive : %r' % (func, arg))
+            if kind == 'n' and not isinstance(arg, int):
+                raise RuleError('%s window must be an integer bar count : %r' % (func, arg))
+
+    def _literal(self, node):
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            raise RuleError('function arguments must be literals : ' + ast.dump(node))
+
+def compile_rules(config):
+    """
+    config为规则文件解析后的字典，返回RulePlan
+    """
+    compiler = RuleCompiler(config.get('define'))
+    for rule in config.get('rules', []):
+        compiler.add_rule(rule['name'], rule['when'])
+    return compiler.plan
+
+def load_config(db_conn=None):
+    """
+    按kline_config.RuleSource从文件或redis读取规则
+    """
+    if kline_config.RuleSource == 'redis':
+        text = db_conn.get(kline_config.RuleKey)
+        if text is None:
+            raise RuleError('no rules in redis key ' + kline_config.RuleKey)
+        return json.loads(text)
+    with open(kline_config.RulePath, 'r') as f:
+        return json.load(f)
+
+def load_plan(db_conn=None):
+    plan = compile_rules(load_config(db_conn))
+    logging.info('[rule] %d rules, %d leaves, %d steps'
+                 % (len(plan.rules), len(plan.leaves), len(plan.steps)))
+    return plan
+
+if __name__ == "__main__":
+    # python kline_rule.py [rules_file] 检查规则文件并打印计算计划
+    # python kline_rule.py upload rules_file 把规则文件写入redis
+    kline_common.init_logging('kline_rule', True)
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'upload':
+        with open(sys.argv[2], 'r') as f:
+            text = f.read()
+        compile_rules(json.loads(text))
+        db_conn = kline_common.DBConnection()
+        db_conn.start(True, False)
+        db_conn.set(kline_config.RuleKey, text)
+        logging.info('[rule] upload %s to %s' % (sys.argv[2], kline_config.RuleKey))
+        sys.exit(0)
+
+    path = sys.argv[1] if len(sys.argv) > 1 else kline_config.RulePath
+    with open(path, 'r') as f:
+        plan = compile_rules(json.load(f))
+    for slot, leaf in plan.leaves:
+        print('%3d %s' % (slot, leaf))
+    for slot, op, args in plan.steps:
+        print('%3d %s %s' % (slot, op, args))
+    for name, slot in plan.rules:
+        print('%s -> %d' % (name, slot))
@@ -1,47 +1,279 @@
 # -*- coding: utf-8 -*-
 # author: shubo
 
+import json
 import time
 import logging
 import tornado
+from tornado import ioloop
 import kline_common
+import kline_config
+import kline_resample
+import kline_storager
+
+# 单个订阅的状态
+class ChannelState:
+    def __init__(self, symbol, period):
+        self.symbol = symbol
+        self.period = period
+        self.sub_time = 0
+        self.subbed = False
+        self.update_time = 0
+        # 推送间隔的指数平均
+        self.interval = None
+        self.resub_count = 0
+        self.stale = False
+
+# 按交易对跟踪推送是否中断，只对中断的订阅重新订阅，不受其他交易对推送频率的影响
+# 中断阈值根据这个交易对自己的推送间隔计算，成交少的交易对阈值更长
+class StalenessTracker:
+    def __init__(self, resub):
+        self.resub = resub
+        self.channels = {}
+
+    def reset(self, symbols, periods):
+        self.channels = {}
+        for symbol in symbols:
+            for period in periods:
+                self.channels['market.%s.kline.%s' % (symbol, period)] = ChannelState(symbol, period)
+
+    def on_subbed(self, ch):
+        state = self.channels.get(ch)
+        if state is not None:
+            state.subbed = True
+
+    def on_update(self, ch, now):
+        state = self.channels.get(ch)
+        if state is None:
+            return
+        if state.update_time > 0:
+            delta = now - state.update_time
+            if state.interval is None:
+                state.interval = delta
+            else:
+                state.interval += 0.1 * (delta - state.interval)
+        state.update_time = now
+        state.subbed = True
+        if state.stale:
+            state.stale = False
+            logging.info('[runtime] %s recovered after %d resub' % (ch, state.resub_count))
+
+    def get_threshold(self, state):
+        if state.interval is None:
+            return kline_config.StaleMaxSeconds
+        return min(max(state.interval * kline_config.StaleFactor, kline_config.StaleMinSeconds),
+                   kline_config.StaleMaxSeconds)
+
+    def get_age(self, state, now):
+        return now - max(state.update_time, state.sub_time)
+
+    def check(self, now):
+        """
+        找出中断的订阅并重新订阅，每次最多处理StaleResubMax个
+        """
+        count = 0
+        for ch, state in self.channels.items():
+            if count >= kline_config.StaleResubMax:
+                break
+            if not state.subbed:
+                # 订阅请求没有得到确认
+                if now - state.sub_time < kline_config.SubAckTimeout:
+                    continue
+            elif self.get_age(state, now) < self.get_threshold(state):
+                continue
+
+            if not state.stale:
+                logging.warning('[runtime] %s stale, age : %f' % (ch, self.get_age(state, now)))
+            state.stale = True
+            state.resub_count += 1
+            state.sub_time = now
+            state.subbed = False
+            self.resub(state)
+            count += 1
+        return count
+
+    def report(self, now):
+        fields = {}
+        stale = 0
+        for ch, state in self.channels.items():
+            stale += int(state.stale)
+            fields[state.symbol + '_' + state.period] = json.dumps({
+                'age': round(self.get_age(state, now), 3),
+                'interval': round(state.interval, 3) if state.interval is not None else None,
+                'threshold': round(self.get_threshold(state), 3),
+                'resub': state.resub_count,
+                'stale': state.stale})
+        return stale, fields
+
+# 由订阅推送合成1min K线，K线id变化或者K线结束一段时间后提交到写入线程
+# 提交的K线与上一根之间有缺口时把缺口写入redis列表，由存储模块补拉
+class BarAssembler:
+    def __init__(self, db_conn, writer):
+        self.db_conn = db_conn
+        self.writer = writer
+        self.grace = kline_config.LiveBarGrace
+        # 每个交易对还没走完的K线
+        self.bars = {}
+        # 每个交易对已提交的最后一根K线id
+        self.committed = {}
+        self.commits = 0
+        self.gaps = 0
+
+    def load_cursors(self, symbols):
+        infos = self.db_conn.hgetall_many(symbols)
+        for symbol, info in zip(symbols, infos):
+            cursor = info.get(b'cur_time_1min')
+            if cursor is not None:
+                self.committed[symbol] = max(self.committed.get(symbol, -1), int(cursor) - 1)
+
+    def on_tick(self, tick):
+        if tick.period != '1min':
+            return
+        self._update(tick.symbol, tick.id, tick)
+
+    def on_raw(self, symbol, bar_id, msg):
+        """
+        原始文本模式只记录每根K线最后一条推送，提交时才解析
+        """
+        self._update(symbol, bar_id, msg)
+
+    def _update(self, symbol, bar_id, source):
+        if bar_id <= self.committed.get(symbol, -1):
+            # 已提交K线的迟到推送
+            return
+
+        bar = self.bars.get(symbol)
+        if bar is not None:
+            if bar_id < bar[0]:
+                return
+            if bar_id > bar[0]:
+                self._commit(symbol, bar)
+
+        self.bars[symbol] = (bar_id, source)
+
+    def flush(self, now):
+        # 没有成交的交易对收不到下一根K线的推送，结束后超过grace秒直接提交
+        for symbol, bar in list(self.bars.items()):
+            if now >= bar[0] + 60 + self.grace:
+                self._commit(symbol, bar)
+
+    def _commit(self, symbol, bar):
+        del self.bars[symbol]
+        bar_id, tick = bar
+        if isinstance(tick, str):
+            tick = kline_common.Tick.from_message(json.loads(tick), time.time())
+        last = self.committed.get(symbol, -1)
+        if last >= 0 and bar_id > last + 60:
+            self.gaps += 1
+            self.db_conn.rpush(kline_config.KlineGapList, json.dumps(
+                {'symbol': symbol, 'start': last + 60, 'end': bar_id - 60}))
+        self.committed[symbol] = bar_id
+        self.commits += 1
+        data = {'id': tick.id, 'open': tick.open, 'close': tick.close, 'low': tick.low, 'high': tick.high,
+                'amount': tick.amount, 'vol': tick.vol, 'count': tick.count}
+        # 存储模块可能已经写入了这根K线未走完时的数据，用覆盖写入保证保存的是最终数据
+        self.writer.put(kline_storager.KlinePage('live', symbol, '1min', [data], upsert=True))
 
 class Main:
     def __init__(self):
         self.db_conn = kline_common.DBConnection()
         self.data_conn = kline_common.DataConnection()
-        self.sub_time = 0
+        self.publisher = kline_common.TickPublisher(self.db_conn)
+        # binary模式下解析一次后发布定长二进制记录
+        self.binary = kline_config.TickEncoding == 'binary'
+        self.codec = kline_common.TickCodec(kline_common.SymbolTable(self.db_conn))
+        self.periods = ['1min']
+        self.tracker = StalenessTracker(self.resub)
         self.count = 0
-        
+        self.assembler = None
+        self.writer = None
+        if kline_config.LiveBars:
+            resampler = None
+            if kline_config.KlinePeriodSource == 'local':
+                resampler = kline_resample.KlineResampler(self.db_conn, publisher=kline_common.BarPublisher(self.db_conn))
+            self.writer = kline_storager.KlineWriter(self.db_conn, resampler)
+            self.assembler = BarAssembler(self.db_conn, self.writer)
+
     def start(self):
-        self.db_conn.start(True,False)
-        
+        self.db_conn.start(True, self.assembler is not None)
+        if self.assembler is not None:
+            self.writer.start()
+            ioloop.PeriodicCallback(self.flush_bars, 1000).start()
+            if self.writer.resampler is not None:
+                ioloop.PeriodicCallback(self.reload_repaired, 1000).start()
+
         self.data_conn.on_open = self.on_open
         self.data_conn.on_message = self.on_message
-        self.data_conn.on_message_stop = self.sub_symbols
-        self.data_conn.start(True)
+        if kline_config.CapturePath != '':
+            self.data_conn.capture(kline_config.CapturePath + 'kline_runtime_' + time.strftime('%Y_%m_%d_%H%M%S') + '.frames')
+        self.data_conn.start(not self.binary)
+
+        ioloop.PeriodicCallback(self.check_staleness, kline_config.StaleCheckInterval * 1000).start()
+        ioloop.PeriodicCallback(self.report_staleness, kline_config.StaleReportInterval * 1000).start()
 
     def on_open(self):
 
         self.sub_symbols()
-    
+
     def sub_symbols(self):
-        
-        if time.time() - self.sub_time < 30:
-            return
-        self.sub_time = time.time()
+        # 连接建立后订阅所有交易对，之后只对中断的订阅单独处理
         self.count += 1
 
-        logging.info('[runtime] resub : ' + str(self.count))
-        
+        logging.info('[runtime] sub : ' + str(self.count))
+
         symbols = self._get_symbols()
-        period = '1min'
+        self.tracker.reset(symbols, self.periods)
+        if self.assembler is not None:
+            self.assembler.load_cursors(symbols)
 
-        for symbol in symbols:
-            request = """{"sub": "market.%s.kline.%s","id": "%s"}""" \
-                    % (symbol, period, symbol + '_' + period)
+        now = time.time()
+        for state in self.tracker.channels.values():
+            state.sub_time = now
+            self._send('sub', state)
+
+    def resub(self, state):
+        self._send('unsub', state)
+        self._send('sub', state)
+
+    def _send(self, action, state):
+        request = """{"%s": "market.%s.kline.%s","id": "%s"}""" \
+                % (action, state.symbol, state.period, state.symbol + '_' + state.period)
+
+        self.data_conn.send(request)
 
-            self.data_conn.send(request)
+    def flush_bars(self):
+        self.assembler.flush(time.time())
+
+    def reload_repaired(self):
+        # 存储模块补齐的缺口交给写入线程重建合成周期，与这个交易对的K线提交保持顺序
+        for item in self.db_conn.lpop_all(kline_config.KlineRepairList):
+            gap = json.loads(item)
+            self.writer.put(kline_storager.KlinePage('repair', gap['symbol'], '1min', [],
+                                                     repair=(gap['start'], gap['end'])))
+
+    def check_staleness(self):
+        if not self.data_conn.is_connected():
+            return
+        count = self.tracker.check(time.time())
+        if count > 0:
+            logging.info('[runtime] resub stale : ' + str(count))
+
+    def report_staleness(self):
+        stale, fields = self.tracker.report(time.time())
+        logging.info('[runtime] staleness channels:%d stale:%d' % (len(fields), stale))
+        if self.assembler is not None:
+            logging.info('[runtime] live bars commits:%d gaps:%d' % (self.assembler.commits, self.assembler.gaps))
+        if len(fields) > 0:
+            pipe = self.db_conn.pipeline()
+            pipe.delete(kline_config.StalenessHash)
+            pipe.hset(kline_config.StalenessHash, mapping=fields)
+            pipe.execute()
+
+        # 交易对列表有变化时重新订阅
+        symbols = set(self._get_symbols())
+        if symbols != set(state.symbol for state in self.tracker.channels.values()):
+            logging.info('[runtime] symbols changed.')
+            self.sub_symbols()
 
     def _get_symbols(self):
         symbols = self.db_conn.lrange('symbols', 0, -1)
@@ -51,7 +283,57 @@ class Main:
         return symbols_ret
 
     def on_message(self, msg):
-        self.db_conn.publish('tick_data', msg)
+        if not self.binary:
+            ch = self._track_raw(msg)
+            self.publisher.publish(msg)
+            if self.assembler is not None and ch is not None and ch.endswith('.1min'):
+                bar_id = self._find_bar_id(msg)
+                if bar_id is not None:
+                    self.assembler.on_raw(ch.split('.')[1], bar_id, msg)
+            return
+
+        if 'tick' not in msg:
+            if 'subbed' in msg:
+                self.tracker.on_subbed(msg['subbed'])
+            return
+        self.tracker.on_update(msg['ch'], time.time())
+        tick = kline_common.Tick.from_message(msg, time.time())
+        self.publisher.publish(self.codec.encode(tick))
+        if self.assembler is not None:
+            self.assembler.on_tick(tick)
+
+    def _track_raw(self, msg):
+        """
+        原始文本只截取频道名称，不做完整解析，返回推送的频道名称
+        """
+        start = msg.find('"ch":"')
+        if start >= 0:
+            start += 6
+            ch = msg[start:msg.find('"', start)]
+            self.tracker.on_update(ch, time.time())
+            return ch
+        start = msg.find('"subbed":"')
+        if start >= 0:
+            start += 10
+            self.tracker.on_subbed(msg[start:msg.find('"', start)])
+        return None
+
+    def _find_bar_id(self, msg):
+        # tick中的K线id
+        start = msg.find('"tick":')
+        if start < 0:
+            return None
+        start = msg.find('"id":', start)
+        if start < 0:
+            return None
+        start += 5
+        end = start
+        while end < len(msg) and msg[end] not in ',}':
+            end += 1
+        try:
+            return int(msg[start:end])
+        except ValueError:
+            return None
 
 if __name__ == "__main__":
     kline_common. init_logging('kline_runtime')
@@ -61,15 +343,3 @@ if __name__ == "__main__":
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         logging.error('[runtime] exit .')
-    
-
-
-
-
-
-
-
-
-
-
-
@@ -2,17 +2,23 @@
 # author: shubo
 
 import sys
+import json
+import math
 import time
 import enum
 import random
 import queue
 import pymongo
+import zlib
 import threading
 import traceback
 import tornado
 import logging
 
 import kline_common
+import kline_config
+import kline_resample
+import kline_gap
 
 class TaskType(enum.Enum):
     GetData = 1
@@ -26,43 +32,473 @@ class KlineTask:
         self.period = period
         self.start_time = start_time
         self.end_time = end_time
+        self.request_id = self.symbol + '_' + self.period
+        self.send_time = 0
+        self.deadline = 0
+        self.retry = 0
+        # 补拉实时K线的缺口
+        self.repair = False
 
     def get_kline_request(self):
-        id = self.symbol + '_' + self.period
         request = """{"req": "market.%s.kline.%s","id": "%s","from": %d,"to": %d}""" \
-                % (self.symbol, self.period, id, self.start_time + 1,self.end_time )
+                % (self.symbol, self.period, self.request_id, self.start_time + 1,self.end_time )
         return request
 
+# 按请求id跟踪已发出的任务，超时重发
+# 并发数根据响应延迟和错误情况按AIMD方式增减
+class KlineTaskWindow:
+    def __init__(self, send_func):
+        self.send_func = send_func
+        self.min_size = kline_config.TaskWindowMin
+        self.max_size = kline_config.TaskWindowMax
+        self.timeout = kline_config.TaskTimeout
+        self.max_retry = kline_config.TaskMaxRetry
+        self.latency_target = kline_config.TaskLatencyTarget
+        self.size = float(self.min_size)
+        self.srtt = None
+        self.last_decrease = 0
+        self.seq = 0
+        self.tasks = {}
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, task):
+        with self.cond:
+            while len(self.tasks) >= int(self.size) and not self.closed:
+                self._check_timeout()
+                self.cond.wait(0.5)
+
+            if self.closed:
+                return False
+
+            self.seq += 1
+            task.request_id = '%s_%s_%d' % (task.symbol, task.period, self.seq)
+            task.retry = 0
+            self.tasks[task.request_id] = task
+            self._send(task)
+            return True
+
+    def complete(self, request_id, ok):
+        with self.cond:
+            task = self.tasks.pop(request_id, None)
+            if task is None:
+                # 超时被丢弃的任务或者未知的响应
+                return None
+
+            if ok:
+                self._on_success(time.time() - task.send_time)
+            else:
+                self._on_error()
+
+            self.cond.notify_all()
+            return task
+
+    def get(self, request_id):
+        with self.cond:
+            return self.tasks.get(request_id)
+
+    def resend_all(self):
+        # 重连之后之前发出的请求都已经丢失，全部重新发送
+        with self.cond:
+            for task in self.tasks.values():
+                self._send(task)
+            logging.info('[window] resend %d tasks' % len(self.tasks))
+
+    def sleep(self, seconds):
+        end_time = time.time() + seconds
+        with self.cond:
+            while not self.closed:
+                self._check_timeout()
+                left = end_time - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(min(left, 0.5))
+
+    def wait_idle(self):
+        with self.cond:
+            while len(self.tasks) > 0 and not self.closed:
+                self._check_timeout()
+                self.cond.wait(0.5)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get_size(self):
+        return int(self.size)
+
+    def get_inflight(self):
+        return len(self.tasks)
+
+    def _send(self, task):
+        task.send_time = time.time()
+        task.deadline = task.send_time + self.timeout
+        # 发送失败的任务留在窗口里，等待超时或者重连后重发
+        self.send_func(task.get_kline_request())
+
+    def _check_timeout(self):
+        now = time.time()
+        for request_id in list(self.tasks.keys()):
+            task = self.tasks[request_id]
+            if task.deadline > now:
+                continue
+
+            self._on_error()
+            task.retry += 1
+            if task.retry > self.max_retry:
+                logging.error('[window] %s timeout, drop.' % request_id)
+                del self.tasks[request_id]
+                self.cond.notify_all()
+            else:
+                logging.warning('[window] %s timeout, retry %d.' % (request_id, task.retry))
+                self._send(task)
+
+    def _on_success(self, latency):
+        if self.srtt is None:
+            self.srtt = latency
+        else:
+            self.srtt = self.srtt * 0.875 + latency * 0.125
+
+        if latency > self.latency_target:
+            self._decrease()
+        else:
+            # 每个窗口的响应累计增加1
+            self.size = min(self.max_size, self.size + 1.0 / self.size)
+
+    def _on_error(self):
+        self._decrease()
+
+    def _decrease(self):
+        # 一个往返时间内只减小一次，避免同一批请求把窗口连续减半
+        now = time.time()
+        rtt = self.srtt if self.srtt is not None else self.timeout
+        if now - self.last_decrease < rtt:
+            return
+        self.last_decrease = now
+        self.size = max(self.min_size, self.size * 0.5)
+
+class KlinePage:
+    def __init__(self, request_id, symbol, period, datas, upsert=False, repair=None):
+        self.request_id = request_id
+        self.symbol = symbol
+        self.period = period
+        self.datas = datas
+        # 覆盖写入已存在的K线
+        self.upsert = upsert
+        # 补齐的1min区间 (start, end)，不经过增量合成，写入后按区间重建合成周期
+        self.repair = repair
+        self.recv_time = time.time()
+
+# 异步写库，收到的K线数据交给写入线程写入mongodb和redis
+# 同一个交易对总是由同一个线程写入，保证写入顺序
+# 队列满的时候put会阻塞，形成反压
+class KlineWriter:
+    def __init__(self, db_conn, resampler=None, on_written=None):
+        self.db_conn = db_conn
+        self.resampler = resampler
+        self.on_written = on_written
+        self.bar_publisher = kline_common.BarPublisher(db_conn)
+        self.workers = kline_config.WriterWorkers
+        self.report_interval = kline_config.WriterReportInterval
+        self.queues = [queue.Queue(maxsize=kline_config.WriterQueueSize) for i in range(self.workers)]
+        self.threads = []
+
+        self.stats_lock = threading.Lock()
+        self._reset_stats()
+        self.report_time = time.time()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(self.queues[i],))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+
+    def put(self, page):
+        index = zlib.crc32(page.symbol.encode('utf-8')) % self.workers
+        self.queues[index].put(page)
+
+    def get_depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['depth'] = self.get_depth()
+        return stats
+
+    def _run(self, q):
+        while True:
+            page = q.get()
+            if page is None:
+                break
+            try:
+                self._write(page)
+            except BaseException as e:
+                msg = traceback.format_exc()
+                logging.error(msg)
+            self._report()
+
+    def _write(self, page):
+        db_name = page.symbol + '_' + page.period
+        start_time = time.time()
+
+        collection = self.db_conn.get_collection(db_name)
+
+        if len(page.datas) == 0:
+            # 只需要重建合成周期
+            inserted, duplicate, failed, max_id = 0, 0, 0, None
+        elif page.upsert:
+            inserted, duplicate, failed, max_id = self._replace_datas(db_name, collection, page.datas)
+        else:
+            inserted, duplicate, failed, max_id = self._insert_datas(db_name, collection, page.datas)
+        # 一次性把游标推进到已写入数据的最大时间，同时发布K线提交事件
+        if max_id is not None:
+            pipe = self.db_conn.pipeline()
+            self.db_conn.hset_max(page.symbol, 'cur_time_' + page.period, max_id + 1, pipe)
+            if failed == 0:
+                self.bar_publisher.publish(pipe, page.symbol, page.period, page.datas)
+            pipe.execute()
+
+        if self.resampler is not None and page.period == '1min' and failed == 0:
+            try:
+                if page.repair is not None:
+                    # 缺口数据只有这一段1min，增量合成会用它覆盖已有的完整K线
+                    self.resampler.reload(page.symbol, page.repair[0], page.repair[1])
+                else:
+                    self.resampler.on_bars(page.symbol, page.datas)
+            except BaseException as e:
+                logging.error("[Task] %s resample Error : %s" % (db_name, str(e)))
+
+        end_time = time.time()
+
+        logging.info("[Task] insert %s:%d inserted:%d duplicate:%d failed:%d time : %f wait : %f" \
+                % (db_name, len(page.datas), inserted, duplicate, failed,
+                   end_time - start_time, start_time - page.recv_time))
+
+        with self.stats_lock:
+            self.stats['pages'] += 1
+            self.stats['bars'] += len(page.datas)
+            self.stats['failed'] += failed
+            self.stats['write_time'] += end_time - start_time
+            self.stats['write_max'] = max(self.stats['write_max'], end_time - start_time)
+            self.stats['wait_time'] += start_time - page.recv_time
+            self.stats['wait_max'] = max(self.stats['wait_max'], start_time - page.recv_time)
+
+        if self.on_written is not None:
+            self.on_written(page, failed)
+
+    def _replace_datas(self, db_name, collection, datas):
+        try:
+            kline_resample.write_bars(collection, datas)
+        except BaseException as e:
+            logging.error("[Task] %s Replace Error : %s" % (db_name, str(e)))
+            return 0, 0, len(datas), None
+        return len(datas), 0, 0, max(data['id'] for data in datas)
+
+    def _insert_datas(self, db_name, collection, datas):
+        # 无序批量写入，重复数据不影响其他数据的写入
+        inserted = len(datas)
+        duplicate = 0
+        failed_ids = set()
+        try:
+            collection.insert_many(datas, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    duplicate += 1
+                else:
+                    failed_ids.add(datas[error['index']]['id'])
+                    logging.error("[Task] %s Insert Error : %s" % (db_name, error.get('errmsg')))
+        except BaseException as e:
+            # ToDo : 可能是数据库掉线了
+            logging.error("[Task] %s InsertMany Error : %s" % (db_name, str(e)))
+            return 0, 0, len(datas), None
+
+        max_id = None
+        for single_data in datas:
+            if single_data['id'] not in failed_ids:
+                max_id = single_data['id']
+
+        return inserted, duplicate, len(failed_ids), max_id
+
+    def _reset_stats(self):
+        self.stats = {'pages': 0, 'bars': 0, 'failed': 0, 'write_time': 0, 'write_max': 0,
+                      'wait_time': 0, 'wait_max': 0}
+
+    def _report(self):
+        with self.stats_lock:
+            now = time.time()
+            if now - self.report_time < self.report_interval:
+                return
+            self.report_time = now
+            stats = self.stats
+            self._reset_stats()
+
+        pages = max(stats['pages'], 1)
+        logging.info("[writer] depth:%d pages:%d bars:%d failed:%d write avg:%f max:%f wait avg:%f max:%f" \
+                % (self.get_depth(), stats['pages'], stats['bars'], stats['failed'],
+                   stats['write_time'] / pages, stats['write_max'],
+                   stats['wait_time'] / pages, stats['wait_max']))
+
+# 哈希时间轮，每格一秒，任务按到期秒数放入对应的格子，超过一圈的任务留在格子里等下一圈
+class TimerWheel:
+    def __init__(self, size=3600):
+        self.size = size
+        self.slots = [[] for i in range(size)]
+        self.current = None
+
+    def add(self, due_time, item):
+        due = int(math.ceil(due_time))
+        if self.current is not None and due <= self.current:
+            due = self.current + 1
+        self.slots[due % self.size].append((due, item))
+
+    def advance(self, now):
+        """
+        推进到now，返回到期的任务
+        """
+        now = int(now)
+        if self.current is None:
+            self.current = now - 1
+        due = []
+        # 落后超过一圈时每格只需要检查一次
+        for t in range(self.current + 1, min(now, self.current + self.size) + 1):
+            slot = self.slots[t % self.size]
+            if len(slot) == 0:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[0] <= now:
+                    due.append(entry[1])
+                else:
+                    keep.append(entry)
+            self.slots[t % self.size] = keep
+        self.current = max(self.current, now)
+        return due
+
+    def next_time(self):
+        # 下一格的时间
+        if self.current is None:
+            return time.time()
+        return self.current + 1
+
+class ScheduleJob:
+    def __init__(self, symbol, period):
+        self.symbol = symbol
+        self.period = period
+        self.due_time = 0
+        self.deadline = 0
+        # 按交易对分散到K线结束后的不同时刻，避免所有请求同时发出
+        self.jitter = zlib.crc32((symbol + '_' + period).encode('utf-8')) % 1000 / 1000.0 * kline_config.SchedulerJitter
+
+# 按每个周期真实的K线结束时间调度 (交易对, 周期) 的拉取任务
+# 任务在K线结束后 SchedulerDelay + jitter 秒执行，超过deadline才执行的记为延迟
+class BarCloseScheduler:
+    def __init__(self, periods):
+        self.periods = periods
+        self.wheel = TimerWheel()
+        self.jobs = {}
+        self.runs = 0
+        self.late = 0
+        self.late_max = 0
+        self.delay_total = 0
+        self.report_time = time.time()
+
+    def update_symbols(self, symbols, now):
+        for symbol in symbols:
+            for period in self.periods:
+                key = (symbol, period)
+                if key not in self.jobs:
+                    job = ScheduleJob(symbol, period)
+                    self.jobs[key] = job
+                    # 新加入的任务马上执行一次，补齐启动前的数据
+                    self._schedule(job, now)
+
+    def remove(self, job):
+        self.jobs.pop((job.symbol, job.period), None)
+
+    def poll(self, now):
+        return [job for job in self.wheel.advance(now) if self.jobs.get((job.symbol, job.period)) is job]
+
+    def on_run(self, job, now):
+        lateness = now - job.due_time
+        self.runs += 1
+        self.delay_total += max(lateness, 0)
+        if now > job.deadline:
+            self.late += 1
+            self.late_max = max(self.late_max, lateness)
+        self._schedule(job, self._get_next_due(job, now))
+
+    def next_time(self):
+        return self.wheel.next_time()
+
+    def report(self, now):
+        if now - self.report_time < kline_config.SchedulerReportInterval:
+            return
+        self.report_time = now
+        runs = max(self.runs, 1)
+        logging.info('[scheduler] jobs:%d runs:%d late:%d delay avg:%f late max:%f'
+                     % (len(self.jobs), self.runs, self.late, self.delay_total / runs, self.late_max))
+        self.runs = 0
+        self.late = 0
+        self.late_max = 0
+        self.delay_total = 0
+
+    def _get_next_due(self, job, now):
+        step = kline_resample.get_period_step(job.period)
+        close_time = kline_resample.get_bar_time(int(now), job.period) + step
+        return close_time + kline_config.SchedulerDelay + job.jitter
+
+    def _schedule(self, job, due_time):
+        job.due_time = due_time
+        job.deadline = due_time + kline_config.SchedulerLateLimit
+        self.wheel.add(due_time, job)
+
 class KlineTaskProducer:
-    def __init__(self, db_conn, data_conn, init_run=False):
+    def __init__(self, db_conn, data_conn, init_run=False, repair_run=False):
         self.periods = ['1min','5min','15min','30min','60min','1day','1week']
         # self.periods = ['1min']
         self.init_run = init_run
+        self.repair_run = repair_run
         self.db_conn = db_conn
         self.symbols = None
         #self.task_queue = queue.Queue(maxsize = 12)            
         self.data_conn = data_conn        
-        self.task_max = 2
-        self.task_sem = threading.BoundedSemaphore(self.task_max)
+        self.window = KlineTaskWindow(self.data_conn.send)
+        # 其他周期由1min数据在本地合成时只需要拉取1min数据
+        self.local_periods = kline_config.KlinePeriodSource == 'local'
+        resampler = None
+        if self.local_periods:
+            self.periods = ['1min']
+            if not init_run and not repair_run:
+                resampler = kline_resample.KlineResampler(self.db_conn, publisher=kline_common.BarPublisher(self.db_conn))
+        self.writer = KlineWriter(self.db_conn, resampler, self._on_written)
         
     def start(self):
+        self.writer.start()
         self.thread = threading.Thread(target=self._run)
         self.running = True
         self.thread.start()
     
     def stop(self):
-        self.release_all()
         self.running = False
+        self.window.close()
+        self.writer.stop()
     
-    def release_all(self):
-        try:
-            for x in range(0, self.task_max):
-                self.task_sem.release()
-        except ValueError as e:
-            pass
+    def resend_all(self):
+        self.window.resend_all()
         
     def _run(self):
-        if not self.init_run:
+        if self.repair_run:
+            self._run_by_repair()
+        elif not self.init_run:
             self._run_in_runtime()
         else :
             self._run_by_init()
@@ -72,17 +508,18 @@ class KlineTaskProducer:
             logging.error('[init] data_conn.is_connected = False')
             return
 
-        self._get_symbols()
+        infos = self._get_symbol_infos()
         start_time = time.time()
         
         for symbol in self.symbols:
-            enabled = self.db_conn.hget(symbol, 'enabled')
+            info = infos[symbol]
+            enabled = info.get(b'enabled', 0)
 
             if int(enabled) == 0:
                 continue
             
             for period in self.periods:
-                self._post_task_by_init(symbol, period)
+                self._post_task_by_init(symbol, period, int(info[b'cur_time_' + period.encode('utf-8')]))
 
             if not self.data_conn.is_connected():
                 break
@@ -96,57 +533,103 @@ class KlineTaskProducer:
         end_time = time.time()
         logging.info('[init] total_time = ' + str(end_time - start_time))
 
+    def _run_by_repair(self):
+        if not self.data_conn.is_connected():
+            logging.error('[repair] data_conn.is_connected = False')
+            return
+
+        infos = self._get_symbol_infos()
+        start_time = time.time()
+
+        symbols = []
+        for symbol in self.symbols:
+            enabled = infos[symbol].get(b'enabled', 0)
+            if int(enabled) != 0:
+                symbols.append(symbol)
+
+        # 扫描游标之前的数据缺口，按合并后的区间补拉
+        results = kline_gap.scan(self.db_conn, symbols, self.periods)
+        for result in results:
+            for start, end in result.tasks:
+                task = KlineTask(TaskType.GetData, result.symbol, result.period, start, end)
+                self._put_task(task)
+
+            if not self.data_conn.is_connected():
+                break
+
+        self.window.wait_idle()
+
+        if self.local_periods:
+            for result in results:
+                for start, end in result.tasks:
+                    kline_resample.rebuild_range(self.db_conn, result.symbol, start + 1, end)
+
+        task = KlineTask(TaskType.Stop)
+        self._put_task(task)
+
+        end_time = time.time()
+        logging.info('[repair] total_time = ' + str(end_time - start_time))
+
     def _run_in_runtime(self):
+        scheduler = BarCloseScheduler(self.periods)
+        refresh_time = 0
+
         while self.running:
             if not self.data_conn.is_connected():
                 time.sleep(5)
                 logging.warning('[running] wait data_conn')
                 continue
 
-            start_time = time.time()
-            
-            self._get_symbols()
-            
-            cur_minute = int(start_time / 60)
-
-            for symbol in self.symbols:
-                
-                enabled = self.db_conn.hget(symbol, 'enabled')
-                if int(enabled) != 2:
-                    continue
-                
-                if not self.data_conn.is_connected():
-                    break
-
-                self._post_task(symbol,'1min')
-                
-                if cur_minute % 5 == 1:
-                    self._post_task(symbol,'5min')
-
-                if cur_minute % 5 == 2:
-                    self._post_task(symbol,'15min')
-
-                if cur_minute % 5 == 2:
-                    self._post_task(symbol,'30min')
-
-                if cur_minute % 5 == 3:
-                    self._post_task(symbol,'60min')
+            now = time.time()
+            # 定期刷新交易对列表，新启用的交易对加入调度
+            if now - refresh_time >= 60:
+                refresh_time = now
+                infos = self._get_symbol_infos()
+                scheduler.update_symbols([s for s in self.symbols if int(infos[s].get(b'enabled', 0)) == 2], now)
+
+            # 实时模块合成1min K线时发现的缺口
+            if kline_config.LiveBars:
+                self._post_gap_tasks()
+
+            jobs = scheduler.poll(now)
+            if len(jobs) > 0:
+                self._run_jobs(scheduler, jobs)
+
+            scheduler.report(time.time())
+            self.window.sleep(max(scheduler.next_time() - time.time(), 0))
+
+    def _run_jobs(self, scheduler, jobs):
+        # 同一时刻到期的任务一次读取游标
+        symbols = sorted(set(job.symbol for job in jobs))
+        infos = dict(zip(symbols, self.db_conn.hgetall_many(symbols)))
+
+        for job in jobs:
+            info = infos[job.symbol]
+            if int(info.get(b'enabled', 0)) != 2 or not self.data_conn.is_connected():
+                scheduler.remove(job)
+                continue
 
-                if cur_minute % 5 == 3:
-                    self._post_task(symbol,'1day')
+            scheduler.on_run(job, time.time())
 
-                if cur_minute % 5 == 4:
-                    self._post_task(symbol,'1week')
+            # 1min K线由实时模块合成，只在游标落后太多时(实时模块没有运行)才拉取
+            if job.period == '1min' and kline_config.LiveBars and \
+                    time.time() - int(info[b'cur_time_1min']) <= kline_config.LiveBarLagLimit:
+                continue
+            self._post_task(job.symbol, job.period, info)
 
-            end_time = time.time()
-            #计算代码时间并休息一段时间保证是一分钟运行一次
-            total_time = 60 - (end_time - start_time)
-            if total_time > 0:
-                time.sleep(total_time)
+    def _post_gap_tasks(self):
+        for item in self.db_conn.lpop_all(kline_config.KlineGapList):
+            gap = json.loads(item)
+            for start, end in kline_gap.plan_tasks([(gap['start'], gap['end'])], 60):
+                task = KlineTask(TaskType.GetData, gap['symbol'], '1min', start, end)
+                task.repair = True
+                self._put_task(task)
 
     def _put_task(self, task):
-        self.task_sem.acquire()
-        self._process_task(task)
+        if task.task_type == TaskType.GetData:
+            self.window.put(task)
+        else:
+            self._process_task(task)
     
     def _get_symbols(self):
         symbols = self.db_conn.lrange('symbols', 0, -1)
@@ -154,15 +637,21 @@ class KlineTaskProducer:
         for s in symbols:
             self.symbols.append(s.decode('utf-8'))
 
-    def _post_task(self, symbol, period):
+    def _get_symbol_infos(self):
+        self._get_symbols()
+        infos = self.db_conn.hgetall_many(self.symbols)
+        return dict(zip(self.symbols, infos))
+
+    def _post_task(self, symbol, period, info):
         
         #开始时间设置为当前数据写入到的时间
-        start_time = int(self.db_conn.hget(symbol, 'cur_time_' + period))
-        end_time = cur_time = int( time.time() )
+        start_time = int(info[b'cur_time_' + period.encode('utf-8')])
 
         time_step = self._create_time_step(period, 1)
-        
-        if (end_time - start_time) < time_step:
+        # 只拉取已经结束的K线，未走完的K线写入后游标越过它，之后的重复数据不会再覆盖
+        end_time = int(kline_resample.get_bar_time(int(time.time()), period)) - time_step
+
+        if end_time < start_time:
             #logging.info('[post_task] no need send task : ' + symbol + ' - ' + period)
             return        
         #计算拉取的数量，大于300的不处理，需要由init过程单独完成
@@ -174,12 +663,11 @@ class KlineTaskProducer:
         task = KlineTask(TaskType.GetData, symbol, period, start_time, end_time)
         self._put_task(task)
     
-    def _post_task_by_init(self, symbol, period):
+    def _post_task_by_init(self, symbol, period, start_time):
         
         time_step = self._create_time_step(period, 300)
         
         #开始时间设置为当前数据写入到的时间
-        start_time = int(self.db_conn.hget(symbol, 'cur_time_' + period))
         end_time = start_time
 
         run = True
@@ -222,37 +710,37 @@ class KlineTaskProducer:
     def _process_task(self, task):
 
         if task.task_type == TaskType.Stop:
+            # 等待所有已发出的请求完成
+            self.window.wait_idle()
             logging.info('[Task] Stop.')
-            self.task_sem.release()
             self.running = False
 
             self.data_conn.on_message = None
             self.data_conn.stop()
 
         elif task.task_type == TaskType.EndASymbol:
+            if self.local_periods:
+                # 1min数据拉取完成后批量合成其他周期
+                self.window.wait_idle()
+                kline_resample.rebuild(self.db_conn, task.symbol)
             self.db_conn.hset(task.symbol, 'enabled', 2)
-            self.task_sem.release()
-
-        elif task.task_type == TaskType.GetData:
-            request = task.get_kline_request()
-            # 如果发送失败 释放任务名额
-            
-            if not self.data_conn.send(request):
-                self.task_sem.release()
 
     def on_message(self, message):
-        
+
+        request_id = message.get('id', '')
+
         if message['status'] != 'ok':
             logging.error("[Task] status != ok -> " + str(message))
-            self.task_sem.release()
+            self.window.complete(request_id, False)
             return
 
-        db_name = message['id']
+        sp = request_id.split('_')
+        db_name = sp[0] + '_' + sp[1]
 
         data_count = len(message['data'])            
         if data_count <= 0:
             logging.info("[Task] %s Task Stop 1001." % (db_name))             
-            self.task_sem.release() 
+            self.window.complete(request_id, True)
             return
 
         datas = message['data']
@@ -260,31 +748,26 @@ class KlineTaskProducer:
         if data_count > 1:
             datas.sort(key = lambda x:x['id'], reverse=False)
         
-        start_time = time.time()
-
-        collection = self.db_conn.get_collection(db_name)
-        sp = db_name.split('_')
-
-        for single_data in datas: 
-            try:
-                collection.insert_one(single_data)                                
-                self.db_conn.hset(sp[0], 'cur_time_' + sp[1], single_data['id'] + 1)
-            except pymongo.errors.DuplicateKeyError as e:
-                self.db_conn.hset(sp[0], 'cur_time_' + sp[1], single_data['id'] + 1)
-                logging.warning("[Task] insert %s DuplicateKeyError." % (db_name))
-            except BaseException as e:
-                # ToDo : 可能是数据库掉线了
-                logging.error("[Task] %s InsertOne Error : %s" % (db_name, str(e)))
-        
-        end_time = time.time()
-        
-        logging.info("[Task] insert %s:%d time : %f" % (db_name,len(message['data']),end_time - start_time))
-        
-        self.task_sem.release()
+        repair = None
+        task = self.window.get(request_id)
+        if task is not None and task.repair:
+            repair = (task.start_time + 1, task.end_time)
+
+        # 写库交给写入线程，IOLoop线程只负责收包和解析
+        page = KlinePage(request_id, sp[0], sp[1], datas, repair=repair)
+        self.writer.put(page)
+
+    def _on_written(self, page, failed):
+        if page.repair is not None and failed == 0 and self.local_periods:
+            # 实时模块的合成状态缺少这段数据，通知它重新加载
+            self.db_conn.rpush(kline_config.KlineRepairList, json.dumps(
+                {'symbol': page.symbol, 'start': page.repair[0], 'end': page.repair[1]}))
+        self.window.complete(page.request_id, failed == 0)
 
 class Main:
-    def __init__(self, is_init):
+    def __init__(self, is_init, is_repair=False):
         self.is_init = is_init
+        self.is_repair = is_repair
         self.db_conn = kline_common.DBConnection()
         self.data_conn = kline_common.DataConnection()
         self.data_conn.stop_check_time = 60
@@ -296,6 +779,8 @@ class Main:
         try:
             self.db_conn.start()
             self.data_conn.on_open = self.on_open
+            if kline_config.CapturePath != '':
+                self.data_conn.capture(kline_config.CapturePath + 'kline_storager_' + time.strftime('%Y_%m_%d_%H%M%S') + '.frames')
             self.data_conn.start()
 
         except Exception as e:
@@ -311,12 +796,12 @@ class Main:
         try:
             if self.first_open:
                 self.first_open = False
-                self.producer = KlineTaskProducer(self.db_conn,self.data_conn,self.is_init)
+                self.producer = KlineTaskProducer(self.db_conn,self.data_conn,self.is_init,self.is_repair)
                 self.data_conn.on_message = self.producer.on_message
                 self.producer.start()
             else:
                 self.data_conn.on_message = self.producer.on_message
-                self.producer.release_all()
+                self.producer.resend_all()
         except Exception as e:
             msg = traceback.format_exc() # 方式1  
             logging.error(msg)
@@ -324,16 +809,21 @@ class Main:
 if __name__ == "__main__":
     
     init_run = False
+    repair_run = False
 
     if len(sys.argv) > 1:
         if sys.argv[1] == 'init':
             init_run = True
+        elif sys.argv[1] == 'repair':
+            repair_run = True
     suffix = 'init'
-    if not init_run:
+    if repair_run:
+        suffix = 'repair'
+    elif not init_run:
         suffix = 'runtime'
-    kline_common.init_logging('kline_storager_' + suffix, init_run)#init_run
+    kline_common.init_logging('kline_storager_' + suffix, init_run or repair_run)#init_run
     
-    main = Main(init_run)
+    main = Main(init_run, repair_run)
     main.start()
     
     try:
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import sys
+import time
+import logging
+import bson
+import pymongo
+import numpy as np
+
+import kline_codec
+import kline_common
+import kline_config
+import kline_resample
+
+# 分桶存储：所有交易对所有周期的K线放在一个集合中，每个文档保存一个交易对一个周期一天或一周的K线
+#   {'symbol': 'btcusdt', 'period': '1min', 'start': 桶开始时间,
+#    'bars': {'相对start的秒数': [open, close, low, high, amount, vol, count]}}
+# (symbol, period, start) 上建唯一索引，范围读取每个桶只读一个文档
+# 已经结束的桶可以压缩，bars换成kline_codec编码的packed字段，之后写入的K线仍然写在bars中并覆盖packed
+# BucketCollection 模拟原来每个 <symbol>_<period> 集合用到的接口，调用方不需要修改
+
+# 各周期的分桶长度
+BUCKET_SPANS = {'1min': '1day', '5min': '1week', '15min': '1week', '30min': '1week',
+                '60min': '1week', '1day': '1week', '1week': '1week'}
+
+VALUE_FIELDS = kline_resample.FIELDS[1:]
+
+class BarCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        self.docs.sort(key=lambda d: d[key], reverse=direction == pymongo.DESCENDING)
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+class BucketCollection:
+    def __init__(self, collection, symbol, period):
+        self.collection = collection
+        self.symbol = symbol
+        self.period = period
+        self.span = BUCKET_SPANS[period]
+
+    def _key(self, start):
+        return {'symbol': self.symbol, 'period': self.period, 'start': start}
+
+    def _range(self, query):
+        """
+        把 {'id': ...} 查询转换成 [start, end) 范围
+        """
+        cond = (query or {}).get('id')
+        if cond is None:
+            return None, None
+        if not isinstance(cond, dict):
+            return int(cond), int(cond) + 1
+        start = end = None
+        if '$gte' in cond:
+            start = int(cond['$gte'])
+        if '$gt' in cond:
+            start = int(cond['$gt']) + 1
+        if '$lt' in cond:
+            end = int(cond['$lt'])
+        if '$lte' in cond:
+            end = int(cond['$lte']) + 1
+        return start, end
+
+    def _load_buckets(self, start, end, direction=pymongo.ASCENDING):
+        query = {'symbol': self.symbol, 'period': self.period}
+        cond = {}
+        if start is not None:
+            cond['$gte'] = int(kline_resample.get_bar_time(start, self.span))
+        if end is not None:
+            cond['$lt'] = end
+        if cond:
+            query['start'] = cond
+        return self.collection.find(query, {'_id': 0, 'start': 1, 'bars': 1, 'packed': 1}).sort('start', direction)
+
+    def _get_bars(self, bucket):
+        """
+        桶中的K线 {相对start的秒数: 数值列表}
+        """
+        bars = {}
+        if 'packed' in bucket:
+            columns = kline_codec.decode(bucket['packed'])
+            lists = [(columns['id'] - bucket['start']).tolist()] + [columns[f].tolist() for f in VALUE_FIELDS]
+            for row in zip(*lists):
+                bars[row[0]] = list(row[1:])
+        for k, v in bucket.get('bars', {}).items():
+            bars[int(k)] = v
+        return bars
+
+    def _iter_bars(self, start, end, direction=pymongo.ASCENDING):
+        for bucket in self._load_buckets(start, end, direction):
+            base = bucket['start']
+            for offset, values in sorted(self._get_bars(bucket).items(), reverse=direction == pymongo.DESCENDING):
+                bar_id = base + offset
+                if (start is None or bar_id >= start) and (end is None or bar_id < end):
+                    yield bar_id, values
+
+    def find(self, query=None, projection=None):
+        start, end = self._range(query)
+        docs = []
+        for bar_id, values in self._iter_bars(start, end):
+            doc = dict(zip(VALUE_FIELDS, values))
+            doc['id'] = bar_id
+            docs.append(doc)
+        return BarCursor(docs)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        """
+        sort只支持按id排序，逐个桶读取，找到第一根K线就停止
+        """
+        start, end = self._range(query)
+        direction = sort[0][1] if sort else pymongo.ASCENDING
+        for bar_id, values in self._iter_bars(start, end, direction):
+            doc = dict(zip(VALUE_FIELDS, values))
+            doc['id'] = bar_id
+            return doc
+        return None
+
+    def load_ids(self, start=None, end=None):
+        ids = [bar_id for bar_id, values in self._iter_bars(start, end)]
+        return np.array(ids, dtype=np.int64)
+
+    def _bar_key(self, bar_id):
+        start = int(kline_resample.get_bar_time(bar_id, self.span))
+        return start, 'bars.%d' % (bar_id - start)
+
+    def insert_many(self, docs, ordered=False):
+        """
+        与集合的insert_many一致，已存在的K线按重复键报错，错误下标与docs对应
+        """
+        if len(docs) == 0:
+            return 0
+        ids = [doc['id'] for doc in docs]
+        # 先读取涉及的桶，已压缩的桶中的K线也能识别为重复
+        existing = set(self.load_ids(min(ids), max(ids) + 1).tolist())
+        errors = []
+        pending = []
+        for i, bar_id in enumerate(ids):
+            if bar_id in existing:
+                errors.append({'index': i, 'code': 11000, 'errmsg': 'duplicate bar %d' % bar_id})
+            else:
+                pending.append(i)
+
+        inserted = 0
+        for attempt in range(kline_config.KlineBucketRetry):
+            if len(pending) == 0:
+                break
+            requests = []
+            for i in pending:
+                start, field = self._bar_key(ids[i])
+                query = self._key(start)
+                query[field] = {'$exists': False}
+                # K线已存在时条件不成立，upsert插入新的桶与唯一索引冲突
+                requests.append(pymongo.UpdateOne(
+                    query, {'$set': {field: [docs[i].get(f, 0) for f in VALUE_FIELDS]}}, upsert=True))
+            try:
+                result = self.collection.bulk_write(requests, ordered=False)
+                inserted += result.upserted_count + result.modified_count
+                pending = []
+                break
+            except pymongo.errors.BulkWriteError as e:
+                inserted += e.details.get('nUpserted', 0) + e.details.get('nModified', 0)
+                conflicts = []
+                for error in e.details.get('writeErrors', []):
+                    i = pending[error['index']]
+                    if error.get('code') == 11000:
+                        conflicts.append(i)
+                    else:
+                        errors.append(dict(error, index=i))
+                if len(conflicts) == 0:
+                    pending = []
+                    break
+                # 重复键也可能是另一个写入者同时创建了这个桶，K线本身不存在时重试
+                existing = set(self.load_ids(min(ids[i] for i in conflicts),
+                                             max(ids[i] for i in conflicts) + 1).tolist())
+                pending = []
+                for i in conflicts:
+                    if ids[i] in existing:
+                        errors.append({'index': i, 'code': 11000, 'errmsg': 'duplicate bar %d' % ids[i]})
+                    else:
+                        pending.append(i)
+
+        for i in pending:
+            errors.append({'index': i, 'code': 0, 'errmsg': 'bucket upsert conflict %d' % ids[i]})
+        if len(errors) > 0:
+            errors.sort(key=lambda error: error['index'])
+            raise pymongo.errors.BulkWriteError({'nInserted': inserted, 'writeErrors': errors})
+        return inserted
+
+    def replace_bars(self, docs):
+        """
+        覆盖写入，同一个桶的K线合并成一次更新
+        """
+        updates = {}
+        for doc in docs:
+            start, field = self._bar_key(doc['id'])
+            updates.setdefault(start, {})[field] = [doc.get(f, 0) for f in VALUE_FIELDS]
+        requests = [pymongo.UpdateOne(self._key(start), {'$set': fields}, upsert=True)
+                    for start, fields in updates.items()]
+        if len(requests) > 0:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def compact(self, before):
+        """
+        压缩在before之前结束的桶，返回压缩的桶数量
+        """
+        span = kline_resample.get_period_step(self.span)
+        query = {'symbol': self.symbol, 'period': self.period, 'start': {'$lt': before - span},
+                 'bars': {'$exists': True}}
+        count = 0
+        for bucket in self.collection.find(query, {'_id': 0, 'start': 1, 'bars': 1, 'packed': 1}):
+            bars = self._get_bars(bucket)
+            offsets = sorted(bars)
+            columns = {'id': np.array(offsets, dtype=np.int64) + bucket['start']}
+            for i, field in enumerate(VALUE_FIELDS):
+                columns[field] = np.array([bars[o][i] for o in offsets],
+                                          dtype=np.int64 if field == 'count' else np.float64)
+            data = kline_codec.encode(columns)
+            # 解码结果与原数据不一致时保留bars
+            if not kline_codec.same_columns(columns, kline_codec.decode(data)):
+                logging.error('[store] %s_%s compact %d round trip mismatch' % (self.symbol, self.period, bucket['start']))
+                continue
+            # bars没有被其他进程修改时才替换
+            result = self.collection.update_one(
+                {'symbol': self.symbol, 'period': self.period, 'start': bucket['start'], 'bars': bucket['bars']},
+                {'$set': {'packed': bson.Binary(data)}, '$unset': {'bars': ''}})
+            count += result.modified_count
+        return count
+
+def ensure_index(collection):
+    collection.create_index([('symbol', pymongo.ASCENDING), ('period', pymongo.ASCENDING),
+                             ('start', pymongo.ASCENDING)], unique=True)
+
+def parse_name(name):
+    """
+    <symbol>_<period> 集合名称拆成 (symbol, period)，不是K线集合时返回None
+    """
+    symbol, _, period = name.rpartition('_')
+    if symbol == '' or period not in BUCKET_SPANS:
+        return None
+    return symbol, period
+
+def migrate(db_conn, symbol, period, chunk=100000):
+    """
+    把 <symbol>_<period> 集合中的K线写入分桶集合，返回写入的数量
+    """
+    source = db_conn.db[symbol + '_' + period]
+    target = BucketCollection(db_conn.db[kline_config.KlineBucketCollection], symbol, period)
+
+    total = 0
+    last = -1
+    # 按id分段读取，避免一次读入全部历史
+    while True:
+        docs = list(source.find({'id': {'$gt': last}}, {'_id': 0}).sort('id', pymongo.ASCENDING).limit(chunk))
+        if len(docs) == 0:
+            break
+        for i in range(0, len(docs), 5000):
+            target.replace_bars(docs[i:i + 5000])
+        total += len(docs)
+        last = docs[-1]['id']
+    return total
+
+if __name__ == "__main__":
+    # python kline_store.py migrate [symbol ...] 把按交易对周期分开的集合迁移到分桶集合
+    # python kline_store.py check symbol [period ...] 对比两种存储的K线数量
+    # python kline_store.py compact [symbol ...] 压缩一天之前已经结束的桶
+    kline_common.init_logging('kline_store', True)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('migrate', 'check', 'compact'):
+        print('usage: kline_store.py migrate [symbol ...]')
+        print('       kline_store.py check symbol [period ...]')
+        print('       kline_store.py compact [symbol ...]')
+        sys.exit(1)
+
+    db_conn = kline_common.DBConnection()
+    db_conn.start()
+    ensure_index(db_conn.db[kline_config.KlineBucketCollection])
+
+    if sys.argv[1] == 'migrate':
+        symbols = sys.argv[2:] or [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+        for symbol in symbols:
+            for period in BUCKET_SPANS:
+                start_time = time.time()
+                count = migrate(db_conn, symbol, period)
+                logging.info('[store] migrate %s_%s:%d time : %f' % (symbol, period, count, time.time() - start_time))
+    elif sys.argv[1] == 'compact':
+        symbols = sys.argv[2:] or [s.decode('utf-8') for s in db_conn.lrange('symbols', 0, -1)]
+        before = int(time.time()) - kline_resample.DAY
+        for symbol in symbols:
+            for period in BUCKET_SPANS:
+                start_time = time.time()
+                target = BucketCollection(db_conn.db[kline_config.KlineBucketCollection], symbol, period)
+                count = target.compact(before)
+                logging.info('[store] compact %s_%s:%d time : %f' % (symbol, period, count, time.time() - start_time))
+    else:
+        symbol = sys.argv[2]
+        for period in sys.argv[3:] or list(BUCKET_SPANS):
+            source = db_conn.db[symbol + '_' + period].count_documents({})
+            target = BucketCollection(db_conn.db[kline_config.KlineBucketCollection], symbol, period)
+            start_time = time.time()
+            count = len(target.load_ids())
+            logging.info('[store] check %s_%s collection:%d bucket:%d time : %f'
+                         % (symbol, period, source, count, time.time() - start_time))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import kline_analysis
+
+def test_rolling_max_append():
+    rolling = kline_analysis.RollingMax(3)
+    result = []
+    for v in [1, 5, 3, 2, 4, 1, 0]:
+        rolling.append(v)
+        result.append(rolling.get())
+    assert result == [1, 5, 5, 5, 4, 4, 4]
+
+def test_rolling_max_replace_down():
+    rolling = kline_analysis.RollingMax(3)
+    for v in [5, 3, 10]:
+        rolling.append(v)
+    rolling.replace_last(4)
+    assert rolling.get() == 5
+    rolling.append(1)
+    assert rolling.get() == 4
+    rolling.replace_last(0)
+    assert rolling.get() == 4
+
+def test_rolling_min_replace_up():
+    rolling = kline_analysis.RollingMax(3, -1)
+    for v in [2, 4, 1]:
+        rolling.append(v)
+    rolling.replace_last(6)
+    assert rolling.get() == 2
+    rolling.replace_last(-1)
+    assert rolling.get() == -1
+
+class FakeDB:
+    def get_collection(self, name):
+        return None
+
+class Bar:
+    def __init__(self, id, high, low):
+        self.id = id
+        self.open = self.close = (high + low) / 2.0
+        self.high = high
+        self.low = low
+        self.amount = self.vol = 0
+
+def test_value_cache_corrected_bar():
+    cache = kline_analysis.ValueCache(FakeDB(), 'btcusdt', '60min', cur_time=0, values=[])
+    for i, (high, low) in enumerate([(5, 4), (3, 2), (10, 1)]):
+        cache.on_bar(Bar(i * 3600, high, low))
+    assert (cache.get_high_in_past(), cache.get_low_in_past()) == (10, 1)
+    # 最后一根K线的修正
+    cache.on_bar(Bar(7200, 4, 3))
+    assert (cache.get_high_in_past(), cache.get_low_in_past()) == (5, 2)
+    # 更早K线的修正
+    cache.on_bar(Bar(10800, 1, 1))
+    cache.on_bar(Bar(0, 2, 2))
+    assert (cache.get_high_in_past(), cache.get_low_in_past()) == (4, 1)
+    assert cache.get_high(2) == 4
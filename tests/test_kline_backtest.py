@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import numpy as np
+
+import kline_analysis
+import kline_backtest
+import kline_resample
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return self
+
+class FakeCollection:
+    # 所有K线都通过on_bar提交，缺口补读时库里没有更多数据
+    def find(self, query):
+        return FakeCursor()
+
+class FakeDB:
+    def get_collection(self, name):
+        return FakeCollection()
+
+class Bar:
+    def __init__(self, doc):
+        for key, value in doc.items():
+            setattr(self, key, value)
+
+def make_bars(count, seed=0, start=1500000000):
+    rng = np.random.default_rng(seed)
+    # 中间去掉一些K线模拟缺失
+    ids = start + np.flatnonzero(rng.random(count * 2) > 0.3)[:count] * 60
+    close = 100 + np.cumsum(rng.normal(0, 1, count))
+    return {'id': ids, 'open': close, 'close': close, 'high': close + rng.random(count),
+            'low': close - rng.random(count), 'amount': np.ones(count), 'vol': np.ones(count),
+            'count': np.ones(count, dtype=np.int64)}
+
+def live_windows(columns, period, n):
+    """
+    按实时模块的方式逐分钟计算：先用已提交的K线取值，再提交这一分钟的K线
+    """
+    cache = kline_analysis.ValueCache(FakeDB(), 'btcusdt', period, cur_time=0, values=[], count=n)
+    state = None
+    highs = []
+    lows = []
+    for doc in kline_resample.to_documents(columns):
+        highs.append(cache.get_high(n))
+        lows.append(cache.get_low(n))
+        bar_time = kline_resample.get_bar_time(doc['id'], period)
+        if state is None or state.id != bar_time:
+            state = kline_resample.BarState(bar_time)
+        state.add(doc)
+        cache.on_bar(Bar(state.to_document()))
+    return highs, lows
+
+def test_window_matches_value_cache():
+    columns = make_bars(600)
+    for period in ('1min', '5min', '15min', '60min'):
+        for n in (1, 2, 3, 5, 10):
+            highs, lows = live_windows(columns, period, n)
+            assert kline_backtest.window_max(columns['id'], columns['high'], period, n).tolist() == highs, (period, n)
+            assert kline_backtest.window_max(columns['id'], columns['low'], period, n, -1).tolist() == lows, (period, n)
+
+def test_window_excludes_current_bar():
+    ids = np.arange(8) * 60
+    high = np.array([1.0, 2, 3, 10, 4, 5, 1, 1])
+    assert kline_backtest.window_max(ids, high, '1min', 2).tolist() == [-1, 1, 2, 3, 10, 10, 5, 5]
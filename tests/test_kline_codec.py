@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import numpy as np
+
+import kline_codec
+import kline_store
+import kline_resample
+
+def make_columns(ids, values=None, counts=None):
+    ids = np.asarray(ids, dtype=np.int64)
+    columns = {'id': ids}
+    for i, field in enumerate(kline_resample.FIELDS[1:-1]):
+        columns[field] = np.asarray(values if values is not None else ids * 0.01 + i, dtype=np.float64)
+    columns['count'] = np.asarray(counts if counts is not None else ids % 7, dtype=np.int64)
+    return columns
+
+def round_trip(columns):
+    result = kline_codec.decode(kline_codec.encode(columns))
+    assert kline_codec.same_columns(columns, result)
+    return result
+
+def test_empty():
+    result = round_trip(make_columns([]))
+    assert len(result['id']) == 0
+
+def test_single_row():
+    round_trip(make_columns([1500000000], [6543.21], [3]))
+
+def test_nan_and_negative_zero():
+    columns = make_columns([0, 60, 120, 180], [np.nan, -0.0, 0.0, 1.5])
+    result = round_trip(columns)
+    assert np.signbit(result['open'][1])
+    assert np.isnan(result['open'][0])
+
+def test_inf_and_large_values():
+    round_trip(make_columns([0, 60, 120], [np.inf, -np.inf, 1e300]))
+
+def test_id_gaps():
+    ids = np.r_[np.arange(0, 6000, 60), np.arange(90000, 96000, 60), [10 ** 12]]
+    round_trip(make_columns(ids))
+
+def test_scaled_prices():
+    rng = np.random.default_rng(1)
+    prices = np.round(6000 + np.cumsum(rng.normal(0, 2, 10000)), 2)
+    columns = make_columns(np.arange(10000) * 60, prices)
+    data = kline_codec.encode(columns)
+    round_trip(columns)
+    methods = dict((field, (method, k)) for field, method, k, size in kline_codec.describe(data))
+    assert methods['open'] == (kline_codec.METHOD_SCALED, 2)
+    assert len(data) < kline_codec.raw_size(columns) / 3
+
+def test_random_floats():
+    rng = np.random.default_rng(2)
+    round_trip(make_columns(np.arange(5000) * 60, rng.random(5000) * 1000))
+
+def test_varint_edges():
+    values = np.array([0, 1, 127, 128, 2 ** 63, 2 ** 64 - 1], dtype=np.uint64)
+    result = kline_codec.varint_decode(kline_codec.varint_encode(values), len(values))
+    assert result.tolist() == values.tolist()
+
+def test_zigzag():
+    values = np.array([0, -1, 1, -2 ** 63, 2 ** 63 - 1], dtype=np.int64)
+    assert kline_codec.unzigzag(kline_codec.zigzag(values)).tolist() == values.tolist()
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return self
+
+class FakeResult:
+    def __init__(self, count):
+        self.modified_count = count
+
+class FakeBuckets:
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def find(self, query, projection=None):
+        # compact只读取还有bars的桶
+        return FakeCursor(dict(b) for b in self.buckets if 'bars' in b or 'bars' not in query)
+
+    def update_one(self, query, update):
+        for bucket in self.buckets:
+            if bucket['start'] == query['start'] and bucket.get('bars') == query['bars']:
+                bucket.update(update['$set'])
+                for key in update['$unset']:
+                    bucket.pop(key)
+                return FakeResult(1)
+        return FakeResult(0)
+
+def test_compact_round_trip():
+    bars = {'0': [1.5, 2.0, 1.0, 3.0, 4.25, 5.0, 6], '60': [float('nan'), -0.0, 1.0, 3.0, 4.0, 5.0, 7]}
+    store = kline_store.BucketCollection(FakeBuckets([{'start': 57600, 'bars': dict(bars)}]), 'btcusdt', '1min')
+    before = list(store.find())
+    assert store.compact(57600 * 10) == 1
+    assert 'bars' not in store.collection.buckets[0]
+    after = list(store.find())
+    assert [d['id'] for d in after] == [57600, 57660]
+    assert repr(after) == repr(before)
+
+def test_compact_keeps_bars_on_mismatch(monkeypatch):
+    store = kline_store.BucketCollection(FakeBuckets([{'start': 57600, 'bars': {'0': [1.5, 2, 1, 3, 4, 5, 6]}}]),
+                                         'btcusdt', '1min')
+    monkeypatch.setattr(kline_codec, 'decode', lambda data: make_columns([]))
+    assert store.compact(57600 * 10) == 0
+    assert 'bars' in store.collection.buckets[0]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import kline_common
+
+class FakeDB:
+    def __init__(self, table):
+        self.table = table
+        self.reloads = 0
+
+    def hgetall(self, hash):
+        self.reloads += 1
+        return dict((k.encode('utf-8'), str(v).encode('utf-8')) for k, v in self.table.items())
+
+def test_unknown_symbol_id_reload_limited(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(kline_common.time, 'time', lambda: now[0])
+    db = FakeDB({'btcusdt': 1})
+    table = kline_common.SymbolTable(db)
+    assert table.get_symbol(1) == 'btcusdt'
+    assert db.reloads == 1
+    for i in range(100):
+        assert table.get_symbol(2) is None
+    assert db.reloads == 2
+
+    # 间隔之后新分配的编号可以被加载
+    db.table['ethusdt'] = 2
+    now[0] += kline_common.kline_config.SymbolReloadInterval
+    assert table.get_symbol(2) == 'ethusdt'
+    assert db.reloads == 3
+    assert table.get_symbol(2) == 'ethusdt'
+    assert db.reloads == 3
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import time
+import numpy as np
+
+import kline_gap
+
+def test_find_runs_between_bars():
+    ids = np.array([0, 60, 240, 300, 420])
+    assert kline_gap.find_runs(ids, 60) == [(120, 180), (360, 360)]
+
+def test_find_runs_head():
+    ids = np.array([600, 660, 780])
+    assert kline_gap.find_runs(ids, 60, 0) == [(0, 540), (720, 720)]
+    assert kline_gap.find_runs(ids, 60, 600) == [(720, 720)]
+    assert kline_gap.find_runs(ids, 60, 720) == [(720, 720)]
+    assert kline_gap.find_runs(ids, 60, 780) == []
+
+def test_first_id():
+    init_time = '2018-01-01 00:00:30'
+    t = int(time.mktime(time.strptime(init_time, '%Y-%m-%d %H:%M:%S')))
+    assert kline_gap.get_first_id('1min', init_time) == t + 30
+    assert kline_gap.get_first_id('1min', init_time, t + 600) == t + 630
+    assert kline_gap.get_first_id('1min') is None
+
+class FakeCollection:
+    def __init__(self, ids):
+        self.ids = np.array(ids, dtype=np.int64)
+
+    def load_ids(self, start, end):
+        ids = self.ids
+        if start is not None:
+            ids = ids[ids >= start]
+        return ids[ids < end]
+
+class FakeDB:
+    def __init__(self, ids):
+        self.collection = FakeCollection(ids)
+
+    def get_collection(self, name):
+        return self.collection
+
+def test_scan_head_gap():
+    init_time = '2018-01-01 00:00:00'
+    t = int(time.mktime(time.strptime(init_time, '%Y-%m-%d %H:%M:%S')))
+    result = kline_gap.scan_collection(FakeDB([t + 600, t + 660]), 'btcusdt', '1min', t + 720, init_time=init_time)
+    assert result.runs == [(t, t + 540)]
+    assert result.missing == 10
+    assert result.tasks == [(t - 1, t + 540)]
+
+    result = kline_gap.scan_collection(FakeDB([]), 'btcusdt', '1min', t + 720, init_time=init_time)
+    assert result.runs == [(t, t + 660)]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import os
+import json
+import numpy as np
+
+import kline_rule
+
+def evaluate_both(text, values):
+    """
+    同一条规则分别用单个tick和整条时间线计算，返回两种结果
+    """
+    plan = kline_rule.compile_rules({'rules': [{'name': 'r', 'when': text}]})
+    length = len(next(iter(values.values())))
+    batch = plan.evaluate_batch(lambda leaf: np.asarray(values[leaf[1]], dtype=np.float64), length)['r']
+    scalar = [plan.evaluate(lambda leaf: float(values[leaf[1]][i])) == ['r'] for i in range(length)]
+    return scalar, batch.tolist()
+
+def test_default_rules_compile():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'kline_rules.json'), 'r') as f:
+        plan = kline_rule.compile_rules(json.load(f))
+    assert [name for name, slot in plan.rules] == ['in up', 'in down']
+
+def test_division_by_zero_matches_batch():
+    values = {'close': [1.0, -1.0, 0.0, 2.0], 'open': [0.0, 0.0, 0.0, 1.0]}
+    for text in ('close / open > 1', 'close / open < -1', 'not (close / open > 0)', 'close / open == close / open'):
+        scalar, batch = evaluate_both(text, values)
+        assert scalar == batch, text
+
+def test_nan_in_max_min_matches_batch():
+    nan = float('nan')
+    values = {'close': [nan, 1.0, 2.0, nan], 'open': [1.0, nan, 1.0, nan]}
+    for text in ('max(close, open) > 0', 'max(open, close) > 0', 'min(close, open) < 3', 'min(open, close) < 3'):
+        scalar, batch = evaluate_both(text, values)
+        assert scalar == batch, text
+
+def test_numeric_literals():
+    plan = kline_rule.compile_rules({'rules': [{'name': 'r', 'when': 'close < 2 and close > -1.5'}]})
+    assert plan.evaluate(lambda leaf: 1.0) == ['r']
+    assert plan.evaluate(lambda leaf: 3.0) == []
+
+def test_bad_indicator_args():
+    for text in ("sma('1min', 0) > 1", "sma('1min', -3) > 1", "sma('1min', 2.5) > 1", "sma('1min') > 1",
+                 "sma('1min', 2, 3) > 1", "sma('2min', 5) > 1", "boll_upper('1min', 20, 0) > 1",
+                 "macd('1min', 12, 26.0, 9) > 0", "ema('1min', True) > 1", "high('1min', 0) > 1"):
+        try:
+            kline_rule.compile_rules({'rules': [{'name': 'r', 'when': text}]})
+        except kline_rule.RuleError:
+            continue
+        raise AssertionError(text)
+
+def test_indicator_args():
+    plan = kline_rule.compile_rules({'rules': [{'name': 'r', 'when': "boll_upper('5min', 20, 2.5) > sma('5min', 20)"},
+                                               {'name': 's', 'when': "macd_hist('1min') > 0"}]})
+    assert len(plan.indicators) == 3
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# author: shubo
+
+import kline_resample
+import kline_storager
+
+class FakePipe:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append(message)
+
+    def execute(self):
+        return []
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    def insert_many(self, datas, ordered=True):
+        self.docs.extend(datas)
+
+class FakeDB:
+    def __init__(self):
+        self.collections = {}
+        self.cursors = {}
+
+    def get_collection(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def pipeline(self):
+        return FakePipe()
+
+    def hset_max(self, hash, key, value, pipe=None):
+        self.cursors[(hash, key)] = max(self.cursors.get((hash, key), 0), value)
+
+    def get_symbol_id(self, hash, symbol):
+        return 1
+
+class FakeResampler:
+    def __init__(self):
+        self.calls = []
+
+    def on_bars(self, symbol, bars):
+        self.calls.append(('on_bars', symbol, [bar['id'] for bar in bars]))
+
+    def reload(self, symbol, start, end):
+        self.calls.append(('reload', symbol, start, end))
+
+def make_bar(id):
+    return {'id': id, 'open': 1.0, 'close': 1.0, 'low': 1.0, 'high': 1.0, 'amount': 0, 'vol': 0, 'count': 0}
+
+def test_gap_page_skips_incremental_resample():
+    db = FakeDB()
+    resampler = FakeResampler()
+    written = []
+    writer = kline_storager.KlineWriter(db, resampler, lambda page, failed: written.append(failed))
+
+    writer._write(kline_storager.KlinePage('btcusdt_1min_1', 'btcusdt', '1min', [make_bar(60)]))
+    writer._write(kline_storager.KlinePage('btcusdt_1min_2', 'btcusdt', '1min', [make_bar(180), make_bar(240)],
+                                           repair=(180, 300)))
+    # 实时模块收到通知后只重建合成周期
+    writer._write(kline_storager.KlinePage('repair', 'btcusdt', '1min', [], repair=(180, 300)))
+
+    assert resampler.calls == [('on_bars', 'btcusdt', [60]), ('reload', 'btcusdt', 180, 300),
+                               ('reload', 'btcusdt', 180, 300)]
+    assert [d['id'] for d in db.collections['btcusdt_1min'].docs] == [60, 180, 240]
+    assert written == [0, 0, 0]
+
+def test_resampler_reload_drops_state(monkeypatch):
+    calls = []
+    monkeypatch.setattr(kline_resample, 'rebuild_range',
+                        lambda db_conn, symbol, start, end, periods: calls.append((symbol, start, end)) or {})
+    resampler = kline_resample.KlineResampler(FakeDB())
+    resampler.states['btcusdt_60min'] = kline_resample.BarState(0)
+    resampler.states['ethusdt_60min'] = kline_resample.BarState(0)
+    resampler.reload('btcusdt', 180, 300)
+    assert list(resampler.states) == ['ethusdt_60min']
+    assert calls == [('btcusdt', 180, 300)]